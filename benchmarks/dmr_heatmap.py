@@ -0,0 +1,67 @@
+"""
+Time of the DMR heatmap ordering for 1k, 100k and 500k selected DMRs, before and after dmr_heatmap.
+
+Synthetic mCGFrac-like values with some NaN, same shape as the cell type DMR browser heatmap.
+The old ordering is the pandas groupby mean, SimpleImputer, MiniBatchKMeans and ward linkage of each refresh.
+
+Run in the app environment from the repo root (importing omb.apps loads the dataset):
+    python benchmarks/dmr_heatmap.py [n_subtypes]
+"""
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from scipy.cluster.hierarchy import dendrogram, linkage
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.impute import SimpleImputer
+
+from omb.apps.dmr_heatmap import fill_column_mean, ordered_heatmap_data, ward_column_order
+
+
+def old_ordered_ave_dmr_df(data, row_k=10, max_rows=500):
+    if data.shape[0] > max_rows:
+        ave = data.groupby(data.index // (data.shape[0] // 500 + 1)).mean()
+    else:
+        ave = data
+    ave = pd.DataFrame(SimpleImputer().fit_transform(ave), columns=ave.columns)
+    row_cluster = MiniBatchKMeans(n_clusters=row_k, random_state=0, batch_size=6)
+    row_cluster.fit(ave)
+    row_order = np.argsort(row_cluster.labels_)
+    col_linkage = linkage(ave.T, method='ward')
+    col_order = list(map(int, dendrogram(col_linkage, no_plot=True)['ivl']))
+    return ave.iloc[row_order, col_order].copy().reset_index(drop=True)
+
+
+def make_data(n_dmr, n_subtypes, rng):
+    values = rng.beta(2, 5, size=(n_dmr, n_subtypes)).astype(np.float32)
+    values[rng.rand(n_dmr, n_subtypes) < 0.01] = np.nan
+    return pd.DataFrame(values, columns=[f'Subtype_{i}' for i in range(n_subtypes)])
+
+
+def timeit(func, *args, repeat=3, **kwargs):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main(n_subtypes=150):
+    rng = np.random.RandomState(0)
+    # column order is cached per color type and subtypes, time its first computation separately
+    sample = fill_column_mean(make_data(10000, n_subtypes, rng).values)
+    print(f'subtype ward order on 10000 sampled DMRs: {timeit(ward_column_order, sample, repeat=1):.3f}s (once)')
+    col_order = ward_column_order(sample)
+
+    for n_dmr in [1000, 100000, 500000]:
+        data = make_data(n_dmr, n_subtypes, rng)
+        old = timeit(old_ordered_ave_dmr_df, data)
+        new = timeit(ordered_heatmap_data, data, col_order)
+        print(f'{n_dmr} DMRs: old {old:.3f}s, new {new:.3f}s, {old / new:.1f}x')
+    return
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,50 @@
+"""
+Time of the DMR score filters of query_dmr on the full DMR dataset with 1, 2, 4 and 8 worker processes.
+
+Usage: python benchmarks/dmr_query.py [n_subtypes]
+The query use the first n_subtypes (default 5) subtypes with "any" logic and default cutoffs.
+"""
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import xarray as xr
+
+from omb.backend.dmr import filter_dmr_by_score, filter_dmr_by_score_parallel, load_dmr_index
+from omb.backend.ingest import DMR_DATASET, DMR_INDEX_PATH, DMR_QUERY_CHUNK_SIZE
+
+
+def main(n_subtypes=5, reptile_cutoff=0.5, delta_to_robust_mean=0.3):
+    index = load_dmr_index(DMR_DATASET, DMR_INDEX_PATH)
+    cluster_of_interest = index.subtypes[:n_subtypes].tolist()
+    positions = index.query(cluster_of_interest, 1, number_of_dms=1)
+    print(f'{index.n_dmr} DMRs, {positions.size} candidates from {n_subtypes} subtypes')
+
+    with xr.open_dataset(DMR_DATASET) as ds:
+        start = time.perf_counter()
+        expected = filter_dmr_by_score(ds, positions, cluster_of_interest, 1,
+                                       reptile_cutoff=reptile_cutoff,
+                                       delta_to_robust_mean=delta_to_robust_mean,
+                                       chunk_size=DMR_QUERY_CHUNK_SIZE)
+        print(f'in process: {time.perf_counter() - start:.2f}s, {expected.size} hits')
+
+    for n_jobs in [1, 2, 4, 8]:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            # first query open the dataset in the workers, time the second one as in a running server
+            times = []
+            for _ in range(2):
+                start = time.perf_counter()
+                hits = filter_dmr_by_score_parallel(executor, DMR_DATASET, positions, cluster_of_interest, 1,
+                                                    reptile_cutoff=reptile_cutoff,
+                                                    delta_to_robust_mean=delta_to_robust_mean,
+                                                    n_jobs=n_jobs,
+                                                    chunk_size=DMR_QUERY_CHUNK_SIZE)
+                times.append(time.perf_counter() - start)
+        assert np.array_equal(hits, expected)
+        print(f'{n_jobs} workers: first {times[0]:.2f}s, warm {times[1]:.2f}s')
+    return
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,72 @@
+"""
+Payload size and serialization time of the scatter figures, before and after compact_figure.
+
+Synthetic 10k cells with float16 coords and gene rates, same figures as the gene browser
+(colored cells plus a gray background trace), serialized with the JSON encoder dash uses.
+
+Run in the app environment from the repo root (importing omb.apps loads the dataset):
+    python benchmarks/scatter_payload.py [n_cells]
+"""
+import json
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import plotly
+import plotly.express as px
+import plotly.graph_objects as go
+
+from omb.apps import utilities
+
+
+def make_figure(n_cells):
+    rng = np.random.RandomState(0)
+    data = pd.DataFrame({'x': rng.randn(n_cells).astype(np.float16) * 10,
+                         'y': rng.randn(n_cells).astype(np.float16) * 10,
+                         'Gene mCH': rng.lognormal(0, 0.3, n_cells).astype(np.float16),
+                         'SubType': rng.choice([f'SubType {i}' for i in range(100)], n_cells)})
+    fig = px.scatter(data, x='x', y='y', color='Gene mCH', range_color=(0.5, 1.5),
+                     color_continuous_scale='Viridis', hover_name='SubType', hover_data=['Gene mCH'])
+    fig.add_trace(go.Scattergl(x=data['x'], y=data['y'], mode='markers',
+                               marker_color='rgba(200, 200, 200, .5)', hoverinfo='skip'))
+    return fig
+
+
+def measure(func, repeat=5):
+    times = []
+    payload = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        payload = func()
+        times.append(time.perf_counter() - start)
+    return len(payload.encode()), min(times)
+
+
+def main(n_cells=10000):
+    fig = make_figure(n_cells)
+
+    def original():
+        return json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder)
+
+    def compact(binary):
+        def _func():
+            utilities.BINARY_TRACE_DATA = binary
+            return json.dumps(utilities.compact_figure(fig), cls=plotly.utils.PlotlyJSONEncoder)
+        return _func
+
+    default_binary = utilities.BINARY_TRACE_DATA
+    print(f'{n_cells} cells, bundled plotly.js {".".join(map(str, utilities._bundled_plotlyjs_version()))}, '
+          f'binary trace data {"enabled" if default_binary else "disabled"}')
+    print(f'{"method":<24}{"bytes":>12}{"ms":>10}')
+    for name, func in [('original', original),
+                       ('compact, rounded JSON', compact(False)),
+                       ('compact, base64 binary', compact(True))]:
+        n_bytes, seconds = measure(func)
+        print(f'{name:<24}{n_bytes:>12}{seconds * 1000:>10.1f}')
+    utilities.BINARY_TRACE_DATA = default_binary
+    return
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
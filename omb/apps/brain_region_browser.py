@@ -10,7 +10,7 @@ from dash.dependencies import Input, Output, State
 
 from .default_values import *
 from .sunburst import create_sunburst
-from .utilities import n_cell_to_marker_size
+from .utilities import compact_figure, n_cell_to_marker_size
 from ..app import app, APP_ROOT_NAME
 
 
@@ -494,18 +494,15 @@ def make_3d_brain_mesh_figure(background_names, roi_names, background_opacity):
 @lru_cache()
 def _get_active_and_background_data(coord_name, region_name, region_level, cell_type_level, max_cells=7500):
     dissection_regions = dataset.region_label_to_dissection_region_dict[region_name]
-    data = dataset.get_coords(coord_name)
-    cell_meta = dataset.get_variables(list({'RegionName', region_level, cell_type_level})) \
-        .reindex(data.index).astype(str)
-    data = pd.concat([data, cell_meta], axis=1)
-
-    active_data = data[data['RegionName'].isin(dissection_regions)]
-    if active_data.shape[0] > max_cells:
-        active_data = active_data.sample(max_cells, random_state=0)
-
-    background_data = data[~data['RegionName'].isin(dissection_regions)]
-    if background_data.shape[0] > max_cells:
-        background_data = background_data.sample(max_cells, random_state=0)
+    cell_meta = dataset.get_variables(list({'RegionName', region_level, cell_type_level})).astype(str)
+    region_judge = cell_meta['RegionName'].isin(dissection_regions)
+
+    data_list = []
+    for judge in [region_judge, ~region_judge]:
+        cells = dataset.downsample_cells(coord_name, max_cells, mask=judge)
+        data = pd.concat([dataset.get_coords(coord_name, cells), cell_meta.reindex(cells)], axis=1)
+        data_list.append(data)
+    active_data, background_data = data_list
     return active_data, background_data
 
 
@@ -570,7 +567,7 @@ def update_region_umap_figure(coord_name, region_level, region_name, cell_type_l
         hue=region_level,
         hover_name=region_level,
         hover_text=cell_type_level)
-    return fig
+    return compact_figure(fig)
 
 
 @app.callback(
@@ -593,7 +590,7 @@ def update_cell_type_umap_figure(coord_name, cell_type_level, region_name, regio
         hue=cell_type_level,
         hover_name=cell_type_level,
         hover_text=region_level)
-    return fig
+    return compact_figure(fig)
 
 
 @app.callback(
@@ -1,3 +1,5 @@
+from functools import lru_cache
+
 import dash_bootstrap_components as dbc
 import dash_html_components as html
 
@@ -5,12 +7,14 @@ from .default_values import *
 from .home import LIU_2020_URL
 from ..app import APP_ROOT_NAME
 
-brain_region_df = dataset.brain_region_table.reset_index()
-
 COLUMNS_ORDER = ['Region Name', 'Sub-Region', 'Major Region',
                  'Slice', 'Number of total cells', 'Dissection Region ID',
                  'Detail Region', 'Potential Overlap']
-brain_region_df = brain_region_df[COLUMNS_ORDER].copy()
+
+
+@lru_cache()
+def _brain_region_df():
+    return dataset.brain_region_table.reset_index()[COLUMNS_ORDER].copy()
 
 
 # Turn brain region name into links
@@ -35,6 +39,7 @@ def prepare_row(row):
 
 
 def create_brain_table_layout():
+    brain_region_df = _brain_region_df()
     # prepare table
     table_header = [
         html.Thead(
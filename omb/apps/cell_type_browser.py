@@ -6,41 +6,47 @@ import dash_table
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
+from dash import callback_context, no_update
 from dash.dependencies import Input, Output, State
 from dash.exceptions import PreventUpdate
 from plotly.subplots import make_subplots
 
 from .default_values import *
+from .raster import SCATTER_MODE_OPTIONS, get_raster_ranges, raster_scatter_fig
 from .sunburst import create_sunburst
-from .utilities import n_cell_to_marker_size
+from .utilities import compact_figure, n_cell_to_marker_size, update_scatter_layout
 from ..app import app, APP_ROOT_NAME
 
-CELL_TYPE_NAME_TO_FORMAL = dataset.cell_type_table['FormalName'].to_dict()
 
+@lru_cache()
+def cell_type_name_to_formal():
+    return dataset.cell_type_table['FormalName'].to_dict()
 
-def _get_split_plot_df(coord_base, variable_name, selected_cells):
-    hue_palette = dataset.get_palette(variable_name)
-    plot_df = dataset.get_coords(coord_base)
 
-    # some coords do not have all cell so selected index need to be updated
-    selected_cell_index = selected_cells & plot_df.index
+def _get_split_plot_df(coord_base, variable_name, selected_cells, downsample=True):
+    hue_palette = dataset.get_palette(variable_name)
+    n_cells = DOWN_SAMPLE if downsample else dataset.n_cells
+    # some coords do not have all cell, cells not in the coords are ignored by downsample_cells
+    is_selected = pd.Series(True, index=selected_cells)
+    selected_cell_index = dataset.downsample_cells(coord_base, n_cells, mask=is_selected)
     if len(selected_cell_index) == 0:
         raise PreventUpdate
-    unselected_cell_index = plot_df.index[~plot_df.index.isin(selected_cell_index)]
-
-    plot_df[variable_name] = dataset.get_variables(variable_name).astype(str)
-    if variable_name != 'SubType':
-        plot_df['SubType'] = dataset.get_variables('SubType').astype(str)
-
-    # selected
-    selected_plot_df = plot_df.loc[selected_cell_index]
-    unselected_plot_df = plot_df.loc[unselected_cell_index]
+    unselected_cell_index = dataset.downsample_cells(coord_base, n_cells, exclude=selected_cells)
+
+    plot_dfs = []
+    for cells in [selected_cell_index, unselected_cell_index]:
+        plot_df = dataset.get_coords(coord_base, cells)
+        plot_df[variable_name] = dataset.get_variables(variable_name, cells).astype(str)
+        if variable_name != 'SubType':
+            plot_df['SubType'] = dataset.get_variables('SubType', cells).astype(str)
+        plot_dfs.append(plot_df)
+    selected_plot_df, unselected_plot_df = plot_dfs
     return selected_plot_df, unselected_plot_df, hue_palette
 
 
 def _make_cell_type_url_markdown(name, total_url):
     new_url = total_url.split('?')[0] + f'?ct={name.replace(" ", "%20")}'
-    markdown = f'[{CELL_TYPE_NAME_TO_FORMAL[name]}]({new_url})'
+    markdown = f'[{cell_type_name_to_formal()[name]}]({new_url})'
     return markdown
 
 
@@ -99,27 +105,13 @@ def _prepare_cell_type_markdown(cell_type_name, total_url):
     return cell_type_markdown
 
 
-def _determine_default_dmg_comparison(cell_type_name):
-    cluster_level = dataset.cluster_name_to_level[cell_type_name]
-    if cluster_level == 'CellClass':
-        dmg_level = 'MajorType'
-        hypo_clusters = dataset.parent_to_children_list[cell_type_name]
-        hyper_clusters = []
-        for sibling in ['Exc', 'Inh']:
-            if sibling != cell_type_name:
-                hyper_clusters += dataset.parent_to_children_list[sibling]
-    else:
-        dmg_level = cluster_level
-        hypo_clusters = [cell_type_name]
-        parent = dataset.child_to_parent[cell_type_name]
-        hyper_clusters = [ct for ct in dataset.parent_to_children_list[parent]
-                          if ct != cell_type_name]
-    return dmg_level, hypo_clusters, hyper_clusters
+@lru_cache()
+def total_gene_options():
+    return [{'label': gene_name, 'value': gene_int}
+            for gene_int, gene_name in
+            dataset.gene_meta_table['gene_name'].iteritems()]
 
 
-TOTAL_GENE_OPTIONS = [{'label': gene_name, 'value': gene_int}
-                      for gene_int, gene_name in
-                      dataset.gene_meta_table['gene_name'].iteritems()]
 DMG_COLUMNS = {
     'gene_name': 'Name',
     'gene_id': 'Ensembl ID',
@@ -150,7 +142,7 @@ def create_cell_type_browser_layout(cell_type_name, total_url):
                                  if x.startswith('L3UMAP')][0]  # should only have one choice
 
     # default dmg comparison
-    dmg_level, hypo_clusters, hyper_clusters = _determine_default_dmg_comparison(cell_type_name)
+    dmg_level, hypo_clusters, hyper_clusters = dataset.default_dmg_comparison(cell_type_name)
     cell_type_markdown = _prepare_cell_type_markdown(cell_type_name, total_url)
 
     # default gene mC type
@@ -167,7 +159,7 @@ def create_cell_type_browser_layout(cell_type_name, total_url):
                 [
                     dbc.Jumbotron(
                         [
-                            html.H1(children=CELL_TYPE_NAME_TO_FORMAL[cell_type_name],
+                            html.H1(children=cell_type_name_to_formal()[cell_type_name],
                                     id='formal-cell-type-name'),
                             html.H1(children=cell_type_name, id='cell_type_name', hidden=True),
                             dcc.Markdown(cell_type_markdown, id='cell_mark_down')
@@ -283,6 +275,17 @@ def create_cell_type_browser_layout(cell_type_name, total_url):
                     dbc.FormText('Coordinates of both scatter plots.')
                 ]
             ),
+            dbc.FormGroup(
+                [
+                    dbc.Label('Scatter Mode'),
+                    dbc.RadioItems(
+                        id='cell-type-scatter-mode-radio',
+                        options=SCATTER_MODE_OPTIONS,
+                        value='scatter',
+                        inline=True),
+                    dbc.FormText('Plot downsampled cells, or an image of all cells that re-renders on zoom.')
+                ]
+            ),
             dbc.FormGroup(
                 [
                     dbc.Label('Gene'),
@@ -636,7 +639,7 @@ def update_gene_options(search_value):
     if not search_value:
         raise PreventUpdate
 
-    this_options = [o for o in TOTAL_GENE_OPTIONS if search_value.lower() in o["label"].lower()]
+    this_options = [o for o in total_gene_options() if search_value.lower() in o["label"].lower()]
     if len(this_options) > 100:
         return [{'label': 'Keep typing...', 'value': 'NOT A GENE', 'disabled': True}]
     else:
@@ -652,12 +655,7 @@ def generate_cell_type_scatter(selected_plot_df, unselected_plot_df, hue, palett
                      color_discrete_map=palette,
                      hover_name=hover_name,
                      hover_data=['SubType'])
-    fig.update_layout(showlegend=False,
-                      margin=dict(t=15, l=0, r=0, b=15),
-                      xaxis=go.layout.XAxis(title='', showticklabels=False, showgrid=False, zeroline=False),
-                      yaxis=go.layout.YAxis(title='', showticklabels=False, showgrid=False, zeroline=False),
-                      plot_bgcolor='rgba(0,0,0,0)',
-                      paper_bgcolor='rgba(0,0,0,0)')
+    update_scatter_layout(fig)
 
     # update marker size and hover template
     fig.update_traces(mode='markers',
@@ -693,12 +691,7 @@ def generate_gene_scatter(plot_df, hue, hue_norm, hover_name):
                      color_continuous_scale='Viridis',
                      hover_name=hover_name,
                      hover_data=[hue])
-    fig.update_layout(showlegend=False,
-                      margin=dict(t=15, l=0, r=0, b=15),
-                      xaxis=go.layout.XAxis(title='', showticklabels=False, showgrid=False, zeroline=False),
-                      yaxis=go.layout.YAxis(title='', showticklabels=False, showgrid=False, zeroline=False),
-                      plot_bgcolor='rgba(0,0,0,0)',
-                      paper_bgcolor='rgba(0,0,0,0)')
+    update_scatter_layout(fig)
 
     # update marker size and hover template
     fig.update_traces(mode='markers',
@@ -708,7 +701,7 @@ def generate_gene_scatter(plot_df, hue, hue_norm, hover_name):
     return fig
 
 
-def _prepare_for_both_scatter(coord_base, cell_type_name):
+def _prepare_for_both_scatter(coord_base, cell_type_name, downsample=True):
     if not coord_base:
         raise PreventUpdate
     if coord_base.startswith('L3'):
@@ -721,21 +714,31 @@ def _prepare_for_both_scatter(coord_base, cell_type_name):
     selected_plot_df, unselected_plot_df, palette = _get_split_plot_df(
         coord_base=coord_base,
         variable_name=cell_type_level,
-        selected_cells=selected_cells)
-
-    if selected_plot_df.shape[0] > DOWN_SAMPLE:
-        selected_plot_df = selected_plot_df.sample(DOWN_SAMPLE, random_state=0)
-    if unselected_plot_df.shape[0] > DOWN_SAMPLE:
-        unselected_plot_df = unselected_plot_df.sample(DOWN_SAMPLE, random_state=0)
+        selected_cells=selected_cells,
+        downsample=downsample)
     return selected_plot_df, unselected_plot_df, cell_type_level, palette
 
 
 @app.callback(
     Output('scatter_plot_1', 'figure'),
-    [Input('cell-type-coords-dropdown', 'value')],
+    [Input('cell-type-coords-dropdown', 'value'),
+     Input('cell-type-scatter-mode-radio', 'value'),
+     Input('scatter_plot_1', 'relayoutData')],
     [State('cell_type_name', 'children')]
 )
-def update_scatter_plot_1(coord, cell_type_name):
+def update_scatter_plot_1(coord, scatter_mode, relayout_data, cell_type_name):
+    x_range, y_range = get_raster_ranges(scatter_mode, relayout_data, 'scatter_plot_1')
+    if scatter_mode == 'raster':
+        selected_plot_df, unselected_plot_df, cell_type_level, palette = _prepare_for_both_scatter(
+            coord, cell_type_name, downsample=False)
+        fig = raster_scatter_fig(selected_plot_df,
+                                 hue=cell_type_level,
+                                 palette=palette,
+                                 background_data=unselected_plot_df,
+                                 x_range=x_range, y_range=y_range, uirevision=coord)
+        update_scatter_layout(fig)
+        return compact_figure(fig)
+
     selected_plot_df, unselected_plot_df, cell_type_level, palette = _prepare_for_both_scatter(
         coord, cell_type_name)
     # make figure
@@ -745,7 +748,7 @@ def update_scatter_plot_1(coord, cell_type_name):
         hue=cell_type_level,
         palette=palette,
         hover_name=cell_type_level)
-    return fig
+    return compact_figure(fig)
 
 
 @app.callback(
@@ -755,26 +758,46 @@ def update_scatter_plot_1(coord, cell_type_name):
     [Input('cell-type-coords-dropdown', 'value'),
      Input('dynamic-gene-dropdown', 'value'),
      Input('mc_type_dropdown', 'value'),
-     Input('mc_range_slider', 'value')],
+     Input('mc_range_slider', 'value'),
+     Input('cell-type-scatter-mode-radio', 'value'),
+     Input('scatter_plot_2', 'relayoutData')],
     [State('cell_type_name', 'children')]
 )
-def update_scatter_plot_2(coord, gene_int, mc_type, hue_norm, cell_type_name):
+def update_scatter_plot_2(coord, gene_int, mc_type, hue_norm, scatter_mode, relayout_data, cell_type_name):
     gene_name = dataset.gene_meta_table.loc[gene_int, 'gene_name']
     hue_name = f'{gene_name} {"mCH" if mc_type == "CHN" else "mCG"}'
     if not gene_int:
         raise PreventUpdate
-    selected_plot_df, unselected_plot_df, cell_type_level, palette = _prepare_for_both_scatter(
-        coord, cell_type_name)
-
+    x_range, y_range = get_raster_ranges(scatter_mode, relayout_data, 'scatter_plot_2')
     gene_data = dataset.get_gene_rate(gene_int=gene_int, mc_type=mc_type)
+
+    if scatter_mode == 'raster':
+        selected_plot_df, unselected_plot_df, cell_type_level, palette = _prepare_for_both_scatter(
+            coord, cell_type_name, downsample=False)
+        plot_df = pd.concat([selected_plot_df, unselected_plot_df])
+        plot_df[hue_name] = gene_data.reindex(plot_df.index)
+        scatter_fig = raster_scatter_fig(plot_df, hue=hue_name, cnorm=hue_norm,
+                                         x_range=x_range, y_range=y_range, uirevision=coord)
+        update_scatter_layout(scatter_fig)
+        if 'scatter_plot_2.relayoutData' in [t['prop_id'] for t in callback_context.triggered]:
+            # zoom only change the scatter
+            return no_update, scatter_fig, no_update
+        # cells are in the order of the coords permutation (see dataset.downsample_cells),
+        # so the first DOWN_SAMPLE rows are the cells of the downsampled tables
+        selected_plot_df = selected_plot_df.iloc[:DOWN_SAMPLE].copy()
+        unselected_plot_df = unselected_plot_df.iloc[:DOWN_SAMPLE].copy()
+    else:
+        selected_plot_df, unselected_plot_df, cell_type_level, palette = _prepare_for_both_scatter(
+            coord, cell_type_name)
     selected_plot_df[hue_name] = gene_data.reindex(selected_plot_df.index)
     unselected_plot_df[hue_name] = gene_data.reindex(unselected_plot_df.index)
 
-    scatter_fig = generate_gene_scatter(
-        pd.concat([selected_plot_df, unselected_plot_df]),
-        hue=hue_name,
-        hue_norm=hue_norm,
-        hover_name=cell_type_level)
+    if scatter_mode != 'raster':
+        scatter_fig = generate_gene_scatter(
+            pd.concat([selected_plot_df, unselected_plot_df]),
+            hue=hue_name,
+            hue_norm=hue_norm,
+            hover_name=cell_type_level)
 
     # update gene violin
     violin_fig = go.Figure()
@@ -804,7 +827,7 @@ def update_scatter_plot_2(coord, gene_int, mc_type, hue_norm, cell_type_name):
     # gene page url
     url = f'gene?gene={gene_name}'
 
-    return violin_fig, scatter_fig, url
+    return violin_fig, compact_figure(scatter_fig), url
 
 
 @app.callback(
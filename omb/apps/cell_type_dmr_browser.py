@@ -1,20 +1,14 @@
 import dash_bootstrap_components as dbc
 import dash_core_components as dcc
-import numpy as np
-import pandas as pd
 import plotly.graph_objects as go
 from dash.dependencies import Input, Output, State
 from dash.exceptions import PreventUpdate
 from plotly.subplots import make_subplots
-from scipy.cluster.hierarchy import linkage, dendrogram
-from sklearn.cluster import MiniBatchKMeans
-from sklearn.impute import SimpleImputer
 
 from .default_values import *
+from .dmr_heatmap import ordered_heatmap_data, subtype_order
 from ..app import app
-
-DMR_LENGTH_BINS = (0, 50, 100, 200, 300, 400, 500, 600, 700, 800, 900, 1000, 99999999999)
-DMS_BINS = (0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 99999999999)
+from ..backend.ingest import DMR_LENGTH_BINS, DMS_BINS
 
 
 def _bin_to_labels(bins):
@@ -23,41 +17,27 @@ def _bin_to_labels(bins):
             for i in range(len(new_bins) - 1)]
 
 
-def _get_dmr_bar_plots(selected_dmr):
-    length = dataset.dmr_ds['end'] - dataset.dmr_ds['start']
-    dmr_length = length.to_pandas()
-    dmr_length_dist_total = pd.cut(
-        dmr_length,
-        bins=DMR_LENGTH_BINS
-    ).value_counts().sort_index() / dmr_length.size * 100
-    dmr_length_dist_selected = pd.cut(
-        dmr_length.loc[selected_dmr],
-        bins=DMR_LENGTH_BINS
-    ).value_counts().sort_index() / selected_dmr.size * 100
-
-    dms = dataset.dmr_ds['number_of_dms'].to_pandas()
-    dms_dist_total = pd.cut(
-        dms,
-        bins=DMS_BINS
-    ).value_counts().sort_index() / dmr_length.size * 100
-    dms_dist_selected = pd.cut(
-        dms.loc[selected_dmr],
-        bins=DMS_BINS
-    ).value_counts().sort_index() / selected_dmr.size * 100
+def _get_dmr_bar_plots(selected_pos):
+    n_total = dataset.dmr_index.size
+    n_selected = max(selected_pos.size, 1)
+    dmr_length_dist_total = dataset.get_dmr_bin_counts('length') / n_total * 100
+    dmr_length_dist_selected = dataset.get_dmr_bin_counts('length', selected_pos) / n_selected * 100
+    dms_dist_total = dataset.get_dmr_bin_counts('dms') / n_total * 100
+    dms_dist_selected = dataset.get_dmr_bin_counts('dms', selected_pos) / n_selected * 100
 
     fig = make_subplots(rows=1, cols=2)
 
     fig.add_trace(go.Bar(name='Total',
                          legendgroup='Total',
                          x=list(range(len(DMR_LENGTH_BINS))),
-                         y=dmr_length_dist_total.values,
+                         y=dmr_length_dist_total,
                          marker_color='gray'),
                   row=1,
                   col=1)
     fig.add_trace(go.Bar(name='Selected DMRs',
                          legendgroup='Selected DMRs',
                          x=list(range(len(DMR_LENGTH_BINS))),
-                         y=dmr_length_dist_selected.values,
+                         y=dmr_length_dist_selected,
                          marker_color='salmon'),
                   row=1,
                   col=1)
@@ -65,7 +45,7 @@ def _get_dmr_bar_plots(selected_dmr):
                          legendgroup='Total',
                          showlegend=False,
                          x=list(range(len(DMS_BINS))),
-                         y=dms_dist_total.values,
+                         y=dms_dist_total,
                          marker_color='gray'),
                   row=1,
                   col=2)
@@ -73,7 +53,7 @@ def _get_dmr_bar_plots(selected_dmr):
                          legendgroup='Selected DMRs',
                          showlegend=False,
                          x=list(range(len(DMS_BINS))),
-                         y=dms_dist_selected.values,
+                         y=dms_dist_selected,
                          marker_color='salmon'),
                   row=1,
                   col=2)
@@ -94,33 +74,13 @@ def _get_dmr_bar_plots(selected_dmr):
     return fig
 
 
-def _ordered_ave_dmr_df(data, row_k=10, max_rows=500):
-    if data.shape[0] > max_rows:
-        # further ave to make plots, only ~500 rows will remain
-        ave = data.groupby(data.index // (data.shape[0] // 500 + 1)).mean()
-    else:
-        ave = data
-    # fill NA, if any
-    ave = pd.DataFrame(SimpleImputer().fit_transform(ave), columns=ave.columns)
-
-    # row order by kmeans
-    row_cluster = MiniBatchKMeans(n_clusters=row_k,
-                                  random_state=0,
-                                  batch_size=6)
-    row_cluster.fit(ave)
-    row_order = np.argsort(row_cluster.labels_)
-
-    # col order by ward clustering
-    col_linkage = linkage(ave.T, method='ward')
-    col_dendrogram = dendrogram(col_linkage, no_plot=True)
-    col_order = list(map(int, col_dendrogram['ivl']))
-
-    ordered_ave = ave.iloc[row_order, col_order].copy().reset_index(drop=True)
-    return ordered_ave
+def _ordered_ave_dmr_df(data, color_type, row_k=10, max_rows=500):
+    col_order = subtype_order(color_type, tuple(data.columns))
+    return ordered_heatmap_data(data, col_order, row_k=row_k, max_rows=max_rows)
 
 
 def _get_dmr_bar_heatmap(dmr_df, row_k, max_rows, color_type):
-    plot_data = _ordered_ave_dmr_df(dmr_df, row_k=row_k, max_rows=max_rows)
+    plot_data = _ordered_ave_dmr_df(dmr_df, color_type, row_k=row_k, max_rows=max_rows)
 
     fig = make_subplots(rows=2, cols=1,
                         row_heights=[0.3, 0.7],
@@ -280,8 +240,9 @@ def create_cell_type_dmr_layout():
     layout = html.Div(
         [
             # store of selected DMRs
+            # only the query token is sent to the client, the selected DMR positions stay in the server cache
             dcc.Store(id='selected-dmr-store',
-                      data={'selected_dmr': []}),
+                      data={'token': None, 'n_dmr': 0, 'query': None}),
 
             # first row is DMR basic info and control
             dbc.Row(
@@ -499,14 +460,17 @@ def select_dmr(_,
     if (coi is None) or (len(coi) == 0) or (not _valid_logic(coi_logic)) or (not _valid_logic(cte_logic)):
         raise PreventUpdate
 
-    selected_dmr = dataset.query_dmr(cluster_of_interest=tuple(coi) if isinstance(coi, list) else coi,
-                                     coi_logic=coi_logic,
-                                     cluster_to_exclude=tuple(cte) if isinstance(cte, list) else cte,
-                                     cte_logic=cte_logic,
-                                     number_of_dms=dms_cutoff,
-                                     reptile_cutoff=reptile_cutoff,
-                                     delta_to_robust_mean=effect_size_cutoff)
-    return {'selected_dmr': selected_dmr}
+    query = dict(cluster_of_interest=coi,
+                 coi_logic=coi_logic,
+                 cluster_to_exclude=cte,
+                 cte_logic=cte_logic,
+                 number_of_dms=dms_cutoff,
+                 reptile_cutoff=reptile_cutoff,
+                 delta_to_robust_mean=effect_size_cutoff)
+    selected_pos = dataset.query_dmr(**query)
+    return {'token': dataset.dmr_query_token(**query),
+            'n_dmr': int(selected_pos.size),
+            'query': query}
 
 
 @app.callback(
@@ -517,10 +481,15 @@ def select_dmr(_,
     prevent_initial_call=True
 )
 def get_figures(data, color_type):
-    selected_dmr = pd.Index(data['selected_dmr'])
+    if data['query'] is None:
+        raise PreventUpdate
+    selected_pos = dataset.get_dmr_selection(data['token'])
+    if selected_pos is None:
+        # token evicted from the shared cache, or the cache is disabled
+        selected_pos = dataset.query_dmr(**data['query'])
     # final data for plots
-    dmr_frac_df = dataset.dmr_ds[color_type].sel({'id': selected_dmr}).to_pandas().reset_index(drop=True)
-    fig_bar = _get_dmr_bar_plots(selected_dmr)
+    dmr_frac_df = dataset.dmr_ds[color_type].isel({'id': selected_pos}).to_pandas().reset_index(drop=True)
+    fig_bar = _get_dmr_bar_plots(selected_pos)
     fig_heatmap = _get_dmr_bar_heatmap(dmr_frac_df,
                                        row_k=10,
                                        max_rows=500,
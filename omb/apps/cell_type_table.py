@@ -1,25 +1,33 @@
+from functools import lru_cache
+
 import dash_bootstrap_components as dbc
 
 from .default_values import *
 from .home import LIU_2020_URL
 from ..app import APP_ROOT_NAME
 
-cell_type_df = dataset.cell_type_table.reset_index()
-
-formal_name_to_internal_name = {v: k for k, v in dataset.cell_type_table['FormalName'].items()}
-# Parent was internal name, turn it into formal names (have special character, etc.)
-cell_type_df['Parent'] = cell_type_df['Parent'].map(cell_type_df.set_index('UniqueName')['FormalName'])
-
 COLUMNS_ORDER = ['FormalName', 'Cluster Level', 'Parent',
                  'Signature Genes', 'Number of total cells', 'Description']
-cell_type_df = cell_type_df[COLUMNS_ORDER].copy()
+
+
+@lru_cache()
+def _formal_name_to_internal_name():
+    return {v: k for k, v in dataset.cell_type_table['FormalName'].items()}
+
+
+@lru_cache()
+def _cell_type_df():
+    cell_type_df = dataset.cell_type_table.reset_index()
+    # Parent was internal name, turn it into formal names (have special character, etc.)
+    cell_type_df['Parent'] = cell_type_df['Parent'].map(cell_type_df.set_index('UniqueName')['FormalName'])
+    return cell_type_df[COLUMNS_ORDER].copy()
 
 
 # Turn brain region name into links
 def name_to_link(name):
     if isinstance(name, float):
         return ''
-    internal_name = formal_name_to_internal_name[name].replace(' ', '%20')
+    internal_name = _formal_name_to_internal_name()[name].replace(' ', '%20')
     return html.A(name, href=f'/{APP_ROOT_NAME}cell_type?ct={internal_name}')
 
 
@@ -53,7 +61,7 @@ def create_cell_type_table_layout():
             )
         )
     ]
-    rows = cell_type_df.apply(prepare_row, axis=1).tolist()
+    rows = _cell_type_df().apply(prepare_row, axis=1).tolist()
     table_body = [html.Tbody(rows)]
 
     table = dbc.Table(table_header + table_body,
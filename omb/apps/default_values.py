@@ -1,13 +1,15 @@
+from functools import lru_cache
+
 import dash_html_components as html
 
 from ..backend import dataset
 
-N_CELLS = dataset.n_cells
-N_REGION = dataset.get_variables('Region').unique().size
-N_MAJOR_TYPE = dataset.get_variables('MajorType').unique().size
 
-_subtypes = dataset.get_variables('SubType')
-N_SUBTYPE = _subtypes[_subtypes.apply(lambda i: 'Outlier' not in i)].unique().size
+# values from the dataset tables are computed on first use, so importing the apps do not load the tables
+@lru_cache()
+def gene_meta_df():
+    return dataset.gene_meta_table
+
 
 DEFAULT_BRAIN_REGION_IMG_SRC = \
     f'https://raw.githubusercontent.com/lhqing/omb/master/omb/assets/dissection_region_img/brain_region_demo.jpg'
@@ -19,7 +21,6 @@ REGION_LEVELS = ['MajorRegion', 'SubRegion', 'RegionName']
 
 DOWN_SAMPLE = 10000
 
-GENE_META_DF = dataset.gene_meta_table
 MAX_TRACKS = 12
 CATEGORICAL_VAR = [
     'RegionName', 'MajorRegion', 'SubRegion', 'CellClass', 'MajorType',
@@ -0,0 +1,148 @@
+"""
+Row and column ordering of the DMR heatmap in the cell type DMR browser.
+
+The selected DMRs (rows) are averaged into at most max_rows blocks of neighbouring DMRs with numpy reshapes,
+then ordered by a KMeans with bounded iterations, so the cost of a refresh do not grow with the selection.
+The subtype (column) order is a ward clustering of a fixed sample of all DMRs, it only depends on
+the color type and the subtypes, so it is computed once and cached.
+"""
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+from scipy.cluster.hierarchy import leaves_list, linkage
+from sklearn.cluster import KMeans
+
+from .default_values import *
+
+# number of DMRs sampled from the whole dataset for the subtype ward clustering
+COLUMN_ORDER_SAMPLE = 10000
+# max iterations of the row KMeans, rows are at most max_rows
+ROW_KMEANS_MAX_ITER = 50
+
+
+def block_mean(values, max_rows=500):
+    """
+    Average every n consecutive rows of values, so at most max_rows rows remain. NaN are ignored.
+
+    Parameters
+    ----------
+    values
+        2D array, DMR by subtype
+    max_rows
+        Max number of rows returned
+
+    Returns
+    -------
+    float32 array, rows with all NaN values in a block stay NaN
+    """
+    values = np.asarray(values, dtype=np.float32)
+    n_rows, n_cols = values.shape
+    if n_rows <= max_rows:
+        return values
+    block_size = n_rows // max_rows + 1
+    n_full = n_rows // block_size
+    blocks = [values[:n_full * block_size].reshape(n_full, block_size, n_cols)]
+    if n_rows > n_full * block_size:
+        # the last block is shorter
+        blocks.append(values[n_full * block_size:][None])
+
+    ave = []
+    for block in blocks:
+        total = block.sum(axis=1)
+        count = np.full(total.shape, block.shape[1], dtype=np.float32)
+        # only the blocks contain NaN need the slower masked sum
+        has_na = np.isnan(total).any(axis=1)
+        if has_na.all():
+            has_na = slice(None)
+        if np.any(has_na):
+            na_block = block[has_na]
+            is_na = np.isnan(na_block)
+            total[has_na] = na_block.sum(axis=1, where=~is_na)
+            count[has_na] -= is_na.view(np.uint8).sum(axis=1, dtype=np.int32)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ave.append(total / count)
+    return np.concatenate(ave)
+
+
+def fill_column_mean(values):
+    """Fill NaN with the mean of its column, columns with all NaN are filled with the overall mean"""
+    values = np.array(values, dtype=np.float32)
+    is_na = np.isnan(values)
+    if not is_na.any():
+        return values
+    with np.errstate(invalid='ignore', divide='ignore'):
+        col_mean = np.nansum(values, axis=0) / (~is_na).sum(axis=0)
+    overall_mean = np.nanmean(values) if (~is_na).any() else 0
+    col_mean = np.where(np.isnan(col_mean), overall_mean, col_mean)
+    values[is_na] = np.take(col_mean, np.nonzero(is_na)[1])
+    return values
+
+
+def row_order(values, row_k=10):
+    """Row order by KMeans labels, values should not have NaN"""
+    n_clusters = min(row_k, values.shape[0])
+    if n_clusters <= 1:
+        return np.arange(values.shape[0])
+    row_cluster = KMeans(n_clusters=n_clusters,
+                         n_init=1,
+                         max_iter=ROW_KMEANS_MAX_ITER,
+                         random_state=0)
+    labels = row_cluster.fit_predict(values)
+    return np.argsort(labels, kind='stable')
+
+
+def ward_column_order(values):
+    """Column order by the leaves of ward clustering, values should not have NaN"""
+    if values.shape[1] <= 2:
+        return np.arange(values.shape[1])
+    return leaves_list(linkage(values.T, method='ward'))
+
+
+@lru_cache(maxsize=16)
+def subtype_order(color_type, subtypes):
+    """
+    Ward order of subtypes, computed on a fixed sample of all DMRs
+
+    Parameters
+    ----------
+    color_type
+        DMR dataset variable, e.g. mCGFrac
+    subtypes
+        Tuple of subtypes in the heatmap columns
+
+    Returns
+    -------
+    int array, positions of subtypes in the heatmap order
+    """
+    n_dmr = dataset.dmr_index.size
+    sample = np.random.RandomState(0).choice(n_dmr, min(COLUMN_ORDER_SAMPLE, n_dmr), replace=False)
+    profile = dataset.dmr_ds[color_type].isel(id=np.sort(sample)).sel(Subtype=list(subtypes))
+    profile = fill_column_mean(profile.transpose('id', 'Subtype').values)
+    return ward_column_order(profile)
+
+
+def ordered_heatmap_data(data, col_order, row_k=10, max_rows=500):
+    """
+    Block-averaged and ordered heatmap data
+
+    Parameters
+    ----------
+    data
+        Dataframe, selected DMR by subtype
+    col_order
+        Column positions in the heatmap order, None to order the columns of data by ward clustering
+    row_k
+        Number of row clusters
+    max_rows
+        Max number of rows in the heatmap
+
+    Returns
+    -------
+    Dataframe with the ordered columns of data and at most max_rows rows
+    """
+    values = fill_column_mean(block_mean(data.values, max_rows=max_rows))
+    if col_order is None:
+        col_order = ward_column_order(values)
+    values = values[np.ix_(row_order(values, row_k=row_k), col_order)]
+    return pd.DataFrame(values, columns=data.columns[col_order])
@@ -7,16 +7,21 @@ import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
 from dash import callback_context
-from dash.dependencies import Input, Output, State
+from dash.dependencies import ClientsideFunction, Input, Output, State
 from dash.exceptions import PreventUpdate
 
 from .default_values import *
-from .utilities import n_cell_to_marker_size
+from .raster import SCATTER_MODE_OPTIONS, get_raster_ranges, raster_scatter_fig
+from .utilities import compact_figure, n_cell_to_marker_size, to_json_list, update_scatter_layout
 from ..app import app, APP_ROOT_NAME
 
-CELL_TYPE_COUNTS = dataset.cell_type_table['Cluster Level'].value_counts().to_dict()
-CELL_TYPE_COUNTS.update(dataset.cell_type_table['Parent'].value_counts().to_dict())
-CELL_TYPE_COUNTS.update({'Sub-All': 161, 'Sub-Exc': 68, 'Sub-Inh': 77, 'Sub-NonN': 16})
+
+@lru_cache()
+def cell_type_counts():
+    counts = dataset.cell_type_table['Cluster Level'].value_counts().to_dict()
+    counts.update(dataset.cell_type_table['Parent'].value_counts().to_dict())
+    counts.update({'Sub-All': 161, 'Sub-Exc': 68, 'Sub-Inh': 77, 'Sub-NonN': 16})
+    return counts
 
 
 def get_gene_info_markdown(gene_int):
@@ -72,27 +77,22 @@ def get_gene_info_markdown(gene_int):
 def standardize_gene(gene):
     try:
         gene_int = int(gene)
-        gene_id = GENE_META_DF.loc[gene_int, 'gene_id']
-        gene_name = GENE_META_DF.loc[gene_int, 'gene_name']
+        gene_id = gene_meta_df().loc[gene_int, 'gene_id']
+        gene_name = gene_meta_df().loc[gene_int, 'gene_name']
     except ValueError:
         if gene in dataset.gene_name_to_int:
             gene_name = gene
             gene_int = dataset.gene_name_to_int[gene_name]
-            gene_id = GENE_META_DF.loc[gene_int, 'gene_id']
+            gene_id = gene_meta_df().loc[gene_int, 'gene_id']
         elif gene in dataset.gene_id_to_int:
             gene_id = gene
             gene_int = dataset.gene_id_to_int[gene_id]
-            gene_name = GENE_META_DF.loc[gene_int, 'gene_name']
+            gene_name = gene_meta_df().loc[gene_int, 'gene_name']
         else:
             return None, None, None
     return gene_int, gene_id, gene_name
 
 
-CELL_TYPES = dataset.cell_type_table
-CLUSTER_DICT = {parent: sub_df['Number of total cells']  # series of subtype cell numbers
-                for parent, sub_df in CELL_TYPES[CELL_TYPES['Cluster Level'] == 'SubType'].groupby('Parent')}
-
-
 def create_gene_browser_layout(gene):
     gene_int, gene_id, gene_name = standardize_gene(gene)
     if gene_int is None:
@@ -174,6 +174,18 @@ def create_gene_browser_layout(gene):
                     dbc.FormText('Coordinates of both scatter plots.')
                 ]
             ),
+            dbc.FormGroup(
+                [
+                    dbc.Label('Scatter Mode', html_for='gene-scatter-mode-radio'),
+                    dbc.RadioItems(
+                        id='gene-scatter-mode-radio',
+                        options=SCATTER_MODE_OPTIONS,
+                        value='scatter',
+                        inline=True
+                    ),
+                    dbc.FormText('Plot downsampled cells, or an image of all cells that re-renders on zoom.')
+                ]
+            ),
             dbc.FormGroup(
                 [
                     dbc.Label('Cell Metadata', html_for="cell-meta-dropdown"),
@@ -271,7 +283,12 @@ def create_gene_browser_layout(gene):
                                     dcc.Loading(
                                         [
                                             dcc.Graph(id='gene-scatter-plot',
-                                                      style={"height": "65vh", "width": "auto"})
+                                                      style={"height": "65vh", "width": "auto"}),
+                                            # coords only change with coords-dropdown, color with the gene,
+                                            # the figure is assembled in the browser, see scatter_script.js
+                                            dcc.Store(id='gene-scatter-coords-store'),
+                                            dcc.Store(id='gene-scatter-color-store'),
+                                            dcc.Store(id='gene-scatter-raster-store')
                                         ]
                                     )
                                 ]
@@ -417,13 +434,13 @@ def create_gene_browser_layout(gene):
                                             ),
                                             dbc.ButtonGroup(
                                                 [
-                                                    dbc.Button(f'ALL ({CELL_TYPE_COUNTS["MajorType"]})',
+                                                    dbc.Button(f'ALL ({cell_type_counts()["MajorType"]})',
                                                                id='btn-major-tracks'),
-                                                    dbc.Button(f'Exc ({CELL_TYPE_COUNTS["Exc"]})',
+                                                    dbc.Button(f'Exc ({cell_type_counts()["Exc"]})',
                                                                id='btn-major-exc-tracks'),
-                                                    dbc.Button(f'Inh ({CELL_TYPE_COUNTS["Inh"]})',
+                                                    dbc.Button(f'Inh ({cell_type_counts()["Inh"]})',
                                                                id='btn-major-inh-tracks'),
-                                                    dbc.Button(f'NonN ({CELL_TYPE_COUNTS["NonN"]})',
+                                                    dbc.Button(f'NonN ({cell_type_counts()["NonN"]})',
                                                                id='btn-major-non-tracks'),
                                                 ],
                                                 size='sm',
@@ -438,11 +455,11 @@ def create_gene_browser_layout(gene):
                                                     ),
                                             dbc.ButtonGroup(
                                                 [
-                                                    dbc.Button(f'Exc ({CELL_TYPE_COUNTS["Sub-Exc"]})',
+                                                    dbc.Button(f'Exc ({cell_type_counts()["Sub-Exc"]})',
                                                                id='btn-sub-exc-tracks'),
-                                                    dbc.Button(f'Inh ({CELL_TYPE_COUNTS["Sub-Inh"]})',
+                                                    dbc.Button(f'Inh ({cell_type_counts()["Sub-Inh"]})',
                                                                id='btn-sub-inh-tracks'),
-                                                    dbc.Button(f'NonN ({CELL_TYPE_COUNTS["Sub-NonN"]})',
+                                                    dbc.Button(f'NonN ({cell_type_counts()["Sub-NonN"]})',
                                                                id='btn-sub-non-tracks'),
                                                 ],
                                                 size='sm',
@@ -588,16 +605,31 @@ def toggle_collapse(n_clicks, active_clusters):
 @app.callback(
     Output('cell-meta-scatter-plot', 'figure'),
     [Input('cell-meta-dropdown', 'value'),
-     Input('coords-dropdown', 'value')]
+     Input('coords-dropdown', 'value'),
+     Input('gene-scatter-mode-radio', 'value'),
+     Input('cell-meta-scatter-plot', 'relayoutData')]
 )
-def get_cell_meta_scatter_fig(var_name, coord_name):
-    data = dataset.get_coords(coord_name)
-    data[var_name] = dataset.get_variables(var_name)
+def get_cell_meta_scatter_fig(var_name, coord_name, scatter_mode, relayout_data):
+    x_range, y_range = get_raster_ranges(scatter_mode, relayout_data, 'cell-meta-scatter-plot')
+    if scatter_mode == 'raster':
+        data = dataset.get_coords(coord_name)
+        data[var_name] = dataset.get_variables(var_name, data.index)
+        if var_name in CONTINUOUS_VAR:
+            fig_cell_meta = raster_scatter_fig(data, hue=var_name,
+                                               cnorm=CONTINUOUS_VAR_NORMS.get(var_name, None),
+                                               x_range=x_range, y_range=y_range, uirevision=coord_name)
+        else:
+            fig_cell_meta = raster_scatter_fig(data, hue=var_name,
+                                               palette=dataset.get_palette(var_name),
+                                               x_range=x_range, y_range=y_range, uirevision=coord_name)
+        update_scatter_layout(fig_cell_meta)
+        return compact_figure(fig_cell_meta)
+
+    cells = dataset.downsample_cells(coord_name, DOWN_SAMPLE)
+    _data = dataset.get_coords(coord_name, cells)
+    _data[var_name] = dataset.get_variables(var_name, cells)
     if var_name != 'SubType':
-        data['SubType'] = dataset.get_variables('SubType')
-
-    sample = 10000
-    _data = data if data.shape[0] <= sample else data.sample(sample, random_state=0)
+        _data['SubType'] = dataset.get_variables('SubType', cells)
 
     # cell meta figure
     if var_name in CONTINUOUS_VAR:
@@ -618,7 +650,6 @@ def get_cell_meta_scatter_fig(var_name, coord_name):
                                     hovertemplate='<b>%{hovertext}</b><br>'
                                                   f'<b>{var_name}: </b>%{{customdata[0]:.3f}}')
     else:
-        data[var_name] = data[var_name]
         fig_cell_meta = px.scatter(
             _data,
             x="x",
@@ -633,68 +664,86 @@ def get_cell_meta_scatter_fig(var_name, coord_name):
                                         _data.shape[0]),
                                     hovertemplate='<b>%{hovertext}</b><br>')
 
-    fig_cell_meta.update_layout(showlegend=False,
-                                margin=dict(t=15, l=0, r=0, b=15),
-                                xaxis=go.layout.XAxis(title='',
-                                                      showticklabels=False,
-                                                      showgrid=False,
-                                                      zeroline=False),
-                                yaxis=go.layout.YAxis(title='',
-                                                      showticklabels=False,
-                                                      showgrid=False,
-                                                      zeroline=False),
-                                plot_bgcolor='rgba(0,0,0,0)',
-                                paper_bgcolor='rgba(0,0,0,0)')
+    update_scatter_layout(fig_cell_meta)
+    return compact_figure(fig_cell_meta)
+
 
-    return fig_cell_meta
+def _gene_scatter_key(coord_name):
+    return f'{coord_name}-{DOWN_SAMPLE}'
 
 
 @app.callback(
-    Output('gene-scatter-plot', 'figure'),
+    Output('gene-scatter-coords-store', 'data'),
+    [Input('coords-dropdown', 'value')],
+    [State('gene-scatter-coords-store', 'data')]
+)
+def update_gene_scatter_coords(coord_name, cur_coords):
+    key = _gene_scatter_key(coord_name)
+    if (cur_coords is not None) and (cur_coords['key'] == key):
+        raise PreventUpdate
+
+    cells = dataset.downsample_cells(coord_name, DOWN_SAMPLE)
+    data = dataset.get_coords(coord_name, cells)
+    coords = {'key': key,
+              'x': to_json_list(data['x']),
+              'y': to_json_list(data['y']),
+              'text': dataset.get_variables('SubType', cells).astype(str).tolist(),
+              'marker_size': n_cell_to_marker_size(cells.size)}
+    return coords
+
+
+@app.callback(
+    Output('gene-scatter-color-store', 'data'),
     [Input('coords-dropdown', 'value'),
      Input('gene_int', 'children'),
      Input('mc-type-dropdown', 'value'),
-     Input('mc-range-slider', 'value')],
+     Input('gene-scatter-mode-radio', 'value')],
     [State('gene_name', 'children')]
 )
-def get_gene_scatter_fig(coord_name, gene_int, mc_type, cnorm, gene_name):
-    data = dataset.get_coords(coord_name)
-    data['SubType'] = dataset.get_variables('SubType')
+def update_gene_scatter_color(coord_name, gene_int, mc_type, scatter_mode, gene_name):
+    if scatter_mode == 'raster':
+        raise PreventUpdate
+    # same cells in the same order as the coords store
+    cells = dataset.downsample_cells(coord_name, DOWN_SAMPLE)
+    color = {'key': _gene_scatter_key(coord_name),
+             'name': f'{gene_name} m{mc_type[:-1]}',
+             'color': to_json_list(dataset.get_gene_rate(gene_int, mc_type).reindex(cells))}
+    return color
 
+
+@app.callback(
+    Output('gene-scatter-raster-store', 'data'),
+    [Input('coords-dropdown', 'value'),
+     Input('gene_int', 'children'),
+     Input('mc-type-dropdown', 'value'),
+     Input('mc-range-slider', 'value'),
+     Input('gene-scatter-mode-radio', 'value'),
+     Input('gene-scatter-plot', 'relayoutData')],
+    [State('gene_name', 'children')]
+)
+def update_gene_scatter_raster(coord_name, gene_int, mc_type, cnorm, scatter_mode, relayout_data, gene_name):
+    x_range, y_range = get_raster_ranges(scatter_mode, relayout_data, 'gene-scatter-plot')
+    if scatter_mode != 'raster':
+        raise PreventUpdate
     gene_col_name = f'{gene_name} m{mc_type[:-1]}'
-    data[gene_col_name] = dataset.get_gene_rate(gene_int, mc_type)
-
-    sample = 10000
-    _data = data if data.shape[0] <= sample else data.sample(sample, random_state=0)
-
-    # gene figure
-    fig_gene = px.scatter(data_frame=_data,
-                          x='x',
-                          y='y',
-                          color=gene_col_name,
-                          range_color=cnorm,
-                          color_continuous_scale='Viridis',
-                          hover_name='SubType',
-                          hover_data=[gene_col_name])
-    # update marker size and hover template
-    fig_gene.update_traces(mode='markers',
-                           marker_size=n_cell_to_marker_size(_data.shape[0]),
-                           hovertemplate='<b>%{hovertext}</b><br>'
-                                         f'<b>{gene_col_name}: </b>%{{customdata[0]:.3f}}')
-
-    fig_gene.update_layout(showlegend=False,
-                           margin=dict(t=15, l=0, r=0, b=15),
-                           xaxis=go.layout.XAxis(title='',
-                                                 showticklabels=False,
-                                                 showgrid=False,
-                                                 zeroline=False),
-                           yaxis=go.layout.YAxis(title='',
-                                                 showticklabels=False,
-                                                 showgrid=False,
-                                                 zeroline=False),
-                           plot_bgcolor='rgba(0,0,0,0)',
-                           paper_bgcolor='rgba(0,0,0,0)')
-    return fig_gene
+    data = dataset.get_coords(coord_name)
+    data[gene_col_name] = dataset.get_gene_rate(gene_int, mc_type).reindex(data.index)
+    fig_gene = raster_scatter_fig(data, hue=gene_col_name, cnorm=cnorm,
+                                  x_range=x_range, y_range=y_range, uirevision=coord_name)
+    update_scatter_layout(fig_gene)
+    return compact_figure(fig_gene)
+
+
+# color range change only re-color the figure in the browser, no server round trip
+app.clientside_callback(
+    ClientsideFunction(namespace='scatter', function_name='gene_scatter_figure'),
+    Output('gene-scatter-plot', 'figure'),
+    [Input('gene-scatter-coords-store', 'data'),
+     Input('gene-scatter-color-store', 'data'),
+     Input('mc-range-slider', 'value'),
+     Input('gene-scatter-mode-radio', 'value'),
+     Input('gene-scatter-raster-store', 'data')]
+)
 
 
 @app.callback(
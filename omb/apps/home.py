@@ -1,10 +1,12 @@
+from functools import lru_cache
+
 import dash_bootstrap_components as dbc
 import dash_core_components as dcc
 import dash_html_components as html
 from dash.dependencies import Input, Output
 from dash.exceptions import PreventUpdate
 
-from .cell_type_browser import TOTAL_GENE_OPTIONS
+from .cell_type_browser import total_gene_options
 from .default_values import *
 from ..app import app
 
@@ -29,10 +31,14 @@ BRAIN_REGION_BROWSER_TEXT = 'Explore the cell type composition of adult mouse br
 BRAIN_REGION_BROWSER_IMG_URL = 'http://neomorph.salk.edu/omb_static/dissection_region_img/' \
                                'home_brain_region.jpg'
 
-ALL_CELL_TYPES = []
-for col in ['CellClass', 'MajorType', 'SubType']:
-    ALL_CELL_TYPES += dataset.get_variables(col).unique().tolist()
-ALL_CELL_TYPES = sorted([i for i in ALL_CELL_TYPES if 'Outlier' not in i])
+
+@lru_cache()
+def all_cell_types():
+    cell_types = []
+    for col in ['CellClass', 'MajorType', 'SubType']:
+        cell_types += dataset.get_variables(col).unique().tolist()
+    return sorted([i for i in cell_types if 'Outlier' not in i])
+
 
 # References
 LIU_2020_TEXT = 'Liu, Zhou et al. 2021. "DNA Methylation Atlas of the Mouse Brain at ' \
@@ -72,135 +78,139 @@ jumbotron = dbc.Jumbotron(
     ]
 )
 
-app_cards = dbc.CardDeck(
-    [
-        # gene card
-        dbc.Card(
-            dbc.CardBody(
-                [
-                    dbc.CardImg(src=GENE_BROWSER_IMG_URL, top=True),
-                    html.H5("Gene", className="card-title m-3"),
-                    html.P(GENE_BROWSER_TEXT, className="card-text mx-3"),
-                    dbc.Row(
-                        [
-                            dbc.Col(
-                                [
-                                    dcc.Dropdown(
-                                        id='gene-dropdown',
-                                        placeholder='Input a gene name, e.g. Cux2',
-                                        className='mr-3')
-                                ],
-                                width=10
-                            ),
-                            dbc.Col(
-                                [
-                                    html.A(
-                                        dbc.Button(
-                                            "GO",
-                                            color="success"
-                                        ),
-                                        id='gene-url',
-                                        href='gene?gene=Cux2'
-                                    )
-                                ],
-                                width=10, lg=2  # width is 2 only on large screen
-                            )
-                        ],
-                        className='m-3',
-                        no_gutters=True
-                    ),
-                ],
-                className='p-0 d-flex flex-column'
-            )
-        ),
-        # brain region card
-        dbc.Card(
-            dbc.CardBody(
-                [
-                    dbc.CardImg(src=BRAIN_REGION_BROWSER_IMG_URL, top=True),
-                    html.H5("Brain Region", className="card-title m-3"),
-                    html.P(BRAIN_REGION_BROWSER_TEXT, className="card-text mx-3"),
-                    dbc.Row(
-                        [
-                            dbc.Col(
-                                [
-                                    dcc.Dropdown(
-                                        options=[
-                                            {'label': region, 'value': region}
-                                            for region in
-                                            dataset.region_label_to_dissection_region_dict.keys()
-                                        ],
-                                        placeholder='Select a brain region.',
-                                        id="brain-region-dropdown",
-                                        value='Isocortex',
-                                        className='mr-3'),
-                                ],
-                                width=10
-                            ),
-                            dbc.Col(
-                                [
-                                    html.A(
-                                        dbc.Button(
-                                            "GO",
-                                            color="success"
-                                        ),
-                                        id='brain-region-url',
-                                        href='brain_region?br=MOp'
-                                    )
-                                ],
-                                width=10, lg=2
-                            )
-                        ],
-                        className='m-3',
-                        no_gutters=True
-                    ),
-                ],
-                className='p-0 d-flex flex-column'
-            )
-        ),
-        # cell type card
-        dbc.Card(
-            dbc.CardBody(
-                [
-                    dbc.CardImg(src=CELL_TYPE_BROWSER_IMG_URL, top=True),
-                    html.H5("Cell Type", className="card-title m-3"),
-                    html.P(CELL_TYPE_BROWSER_TEXT, className="card-text mx-3"),
-                    dbc.Row(
-                        [
-                            dbc.Col(
-                                [
-                                    dcc.Dropdown(id='cell-type-dropdown',
-                                                 placeholder='Select a cell type.',
-                                                 options=[{'label': ct, 'value': ct}
-                                                          for ct in ALL_CELL_TYPES],
-                                                 value='IT-L23',
-                                                 className='mr-3')
-                                ],
-                                width=10
-                            ),
-                            dbc.Col(
-                                [
-                                    html.A(
-                                        dbc.Button(
-                                            "GO",
-                                            color="success"
-                                        ),
-                                        id='cell-type-url',
-                                        href='cell_type?ct=IT-L23'
-                                    )
-                                ],
-                                width=10, lg=2
-                            )
-                        ],
-                        className='m-3',
-                        no_gutters=True
-                    ),
-                ],
-                className='p-0 d-flex flex-column'
-            )
-        ),
-    ]
-)
+
+def _app_cards():
+    # the cell type dropdown list all cell types, built on first visit rather than at import
+    return dbc.CardDeck(
+        [
+            # gene card
+            dbc.Card(
+                dbc.CardBody(
+                    [
+                        dbc.CardImg(src=GENE_BROWSER_IMG_URL, top=True),
+                        html.H5("Gene", className="card-title m-3"),
+                        html.P(GENE_BROWSER_TEXT, className="card-text mx-3"),
+                        dbc.Row(
+                            [
+                                dbc.Col(
+                                    [
+                                        dcc.Dropdown(
+                                            id='gene-dropdown',
+                                            placeholder='Input a gene name, e.g. Cux2',
+                                            className='mr-3')
+                                    ],
+                                    width=10
+                                ),
+                                dbc.Col(
+                                    [
+                                        html.A(
+                                            dbc.Button(
+                                                "GO",
+                                                color="success"
+                                            ),
+                                            id='gene-url',
+                                            href='gene?gene=Cux2'
+                                        )
+                                    ],
+                                    width=10, lg=2  # width is 2 only on large screen
+                                )
+                            ],
+                            className='m-3',
+                            no_gutters=True
+                        ),
+                    ],
+                    className='p-0 d-flex flex-column'
+                )
+            ),
+            # brain region card
+            dbc.Card(
+                dbc.CardBody(
+                    [
+                        dbc.CardImg(src=BRAIN_REGION_BROWSER_IMG_URL, top=True),
+                        html.H5("Brain Region", className="card-title m-3"),
+                        html.P(BRAIN_REGION_BROWSER_TEXT, className="card-text mx-3"),
+                        dbc.Row(
+                            [
+                                dbc.Col(
+                                    [
+                                        dcc.Dropdown(
+                                            options=[
+                                                {'label': region, 'value': region}
+                                                for region in
+                                                dataset.region_label_to_dissection_region_dict.keys()
+                                            ],
+                                            placeholder='Select a brain region.',
+                                            id="brain-region-dropdown",
+                                            value='Isocortex',
+                                            className='mr-3'),
+                                    ],
+                                    width=10
+                                ),
+                                dbc.Col(
+                                    [
+                                        html.A(
+                                            dbc.Button(
+                                                "GO",
+                                                color="success"
+                                            ),
+                                            id='brain-region-url',
+                                            href='brain_region?br=MOp'
+                                        )
+                                    ],
+                                    width=10, lg=2
+                                )
+                            ],
+                            className='m-3',
+                            no_gutters=True
+                        ),
+                    ],
+                    className='p-0 d-flex flex-column'
+                )
+            ),
+            # cell type card
+            dbc.Card(
+                dbc.CardBody(
+                    [
+                        dbc.CardImg(src=CELL_TYPE_BROWSER_IMG_URL, top=True),
+                        html.H5("Cell Type", className="card-title m-3"),
+                        html.P(CELL_TYPE_BROWSER_TEXT, className="card-text mx-3"),
+                        dbc.Row(
+                            [
+                                dbc.Col(
+                                    [
+                                        dcc.Dropdown(id='cell-type-dropdown',
+                                                     placeholder='Select a cell type.',
+                                                     options=[{'label': ct, 'value': ct}
+                                                              for ct in all_cell_types()],
+                                                     value='IT-L23',
+                                                     className='mr-3')
+                                    ],
+                                    width=10
+                                ),
+                                dbc.Col(
+                                    [
+                                        html.A(
+                                            dbc.Button(
+                                                "GO",
+                                                color="success"
+                                            ),
+                                            id='cell-type-url',
+                                            href='cell_type?ct=IT-L23'
+                                        )
+                                    ],
+                                    width=10, lg=2
+                                )
+                            ],
+                            className='m-3',
+                            no_gutters=True
+                        ),
+                    ],
+                    className='p-0 d-flex flex-column'
+                )
+            ),
+        ]
+    )
+
 
 info_cards = dbc.Row(
     [
@@ -246,16 +256,18 @@ info_cards = dbc.Row(
     className='my-4'
 )
 
-layout = html.Div(
-    children=[
-        # first row is title and introduction
-        jumbotron,
-        # second row is link to three different browser
-        app_cards,
-        # third row is about reference
-        info_cards
-    ]
-)
+def create_home_layout():
+    layout = html.Div(
+        children=[
+            # first row is title and introduction
+            jumbotron,
+            # second row is link to three different browser
+            _app_cards(),
+            # third row is about reference
+            info_cards
+        ]
+    )
+    return layout
 
 
 @app.callback(
@@ -266,7 +278,7 @@ def update_gene_options(search_value):
     if not search_value:
         raise PreventUpdate
 
-    this_options = [o for o in TOTAL_GENE_OPTIONS if search_value.lower() in o["label"].lower()]
+    this_options = [o for o in total_gene_options() if search_value.lower() in o["label"].lower()]
     if len(this_options) > 100:
         return [{'label': 'Keep typing...', 'value': 'NOT A GENE', 'disabled': True}]
     else:
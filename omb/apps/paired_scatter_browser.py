@@ -3,12 +3,14 @@ import dash_core_components as dcc
 import dash_html_components as html
 import plotly.express as px
 import plotly.graph_objects as go
+from dash import callback_context, no_update
 from dash.dependencies import Input, Output, State
 from dash.exceptions import PreventUpdate
 
-from .cell_type_browser import TOTAL_GENE_OPTIONS
+from .cell_type_browser import total_gene_options
 from .default_values import *
-from .utilities import n_cell_to_marker_size
+from .raster import SCATTER_MODE_OPTIONS, get_raster_ranges, raster_scatter_fig
+from .utilities import compact_figure, n_cell_to_marker_size, update_scatter_layout
 from ..app import app
 
 
@@ -41,7 +43,6 @@ def _get_active_and_background_data(coords, downsample,
                                     cell_types, brain_regions,
                                     cell_meta_hue, gene_int,
                                     gene_mc_type):
-    plot_data = dataset.get_coords(coords)
     gene_name = dataset.gene_meta_table.loc[gene_int, 'gene_name']
 
     # get unique selected subtypes and dissection regions
@@ -63,25 +64,30 @@ def _get_active_and_background_data(coords, downsample,
     selected_dissection_regions = set(selected_dissection_regions)
 
     # judge active cells
-    plot_data['SubType'] = dataset.get_variables('SubType').astype(str)
-    plot_data['RegionName'] = dataset.get_variables('RegionName').astype(str)
-    plot_data['active'] = (plot_data['SubType'].isin(selected_subtypes)) & (
-        plot_data['RegionName'].isin(selected_dissection_regions))
+    cell_meta = dataset.get_variables(['SubType', 'RegionName'])
+    active = (cell_meta['SubType'].astype(str).isin(selected_subtypes)) & (
+        cell_meta['RegionName'].astype(str).isin(selected_dissection_regions))
 
-    # add cell meta and gene color data
-    if cell_meta_hue not in plot_data.columns:
-        plot_data[cell_meta_hue] = dataset.get_variables(cell_meta_hue)
-        if cell_meta_hue in CATEGORICAL_VAR:
-            plot_data[cell_meta_hue] = plot_data[cell_meta_hue].astype(str)
-    plot_data[gene_name] = dataset.get_gene_rate(gene_int, mc_type=gene_mc_type)
+    # downsample first, only the sampled cells are collected
+    downsample = int(downsample)
+    active_cells = dataset.downsample_cells(coords, downsample, mask=active)
+    background_cells = dataset.downsample_cells(coords, downsample, mask=~active)
 
-    # split active and background
-    active_data = plot_data[plot_data['active']].copy()
-    background_data = plot_data[~plot_data['active']].copy()
-    if active_data.shape[0] > downsample:
-        active_data = active_data.sample(downsample, random_state=0)
-    if background_data.shape[0] > downsample:
-        background_data = background_data.sample(downsample, random_state=0)
+    gene_rate = dataset.get_gene_rate(gene_int, mc_type=gene_mc_type)
+    data_list = []
+    for cells in [active_cells, background_cells]:
+        plot_data = dataset.get_coords(coords, cells)
+        plot_data['SubType'] = cell_meta['SubType'].reindex(cells).astype(str)
+        plot_data['RegionName'] = cell_meta['RegionName'].reindex(cells).astype(str)
+
+        # add cell meta and gene color data
+        if cell_meta_hue not in plot_data.columns:
+            plot_data[cell_meta_hue] = dataset.get_variables(cell_meta_hue, cells)
+            if cell_meta_hue in CATEGORICAL_VAR:
+                plot_data[cell_meta_hue] = plot_data[cell_meta_hue].astype(str)
+        plot_data[gene_name] = gene_rate.reindex(cells)
+        data_list.append(plot_data)
+    active_data, background_data = data_list
     return active_data, background_data
 
 
@@ -123,6 +129,18 @@ def create_paired_scatter_layout(coords='L1UMAP', downsample=10000,
                     ),
                     dbc.FormText('Number of cells plotted on each scatter plot.')
                 ]
+            ),
+            dbc.FormGroup(
+                [
+                    dbc.Label('Scatter Mode', html_for='paired-scatter-mode-radio'),
+                    dbc.RadioItems(
+                        id='paired-scatter-mode-radio',
+                        options=SCATTER_MODE_OPTIONS,
+                        value='scatter',
+                        inline=True
+                    ),
+                    dbc.FormText('Image mode plot all cells and ignore down sample, re-renders on zoom.')
+                ]
             )
         ]
     )
@@ -371,7 +389,7 @@ def update_gene_options(search_value):
     if not search_value:
         raise PreventUpdate
 
-    this_options = [o for o in TOTAL_GENE_OPTIONS if search_value.lower() in o["label"].lower()]
+    this_options = [o for o in total_gene_options() if search_value.lower() in o["label"].lower()]
     if len(this_options) > 100:
         return [{'label': 'Keep typing...', 'value': 'NOT A GENE', 'disabled': True}]
     else:
@@ -381,7 +399,9 @@ def update_gene_options(search_value):
 @app.callback(
     [Output('cell-meta-graph', 'figure'),
      Output('gene-graph', 'figure')],
-    [Input('update-button', 'n_clicks')],
+    [Input('update-button', 'n_clicks'),
+     Input('cell-meta-graph', 'relayoutData'),
+     Input('gene-graph', 'relayoutData')],
     [State('coords-dropdown', 'value'),
      State('down-sample-dropdown', 'value'),
      State('cell-type-select-dropdown', 'value'),
@@ -389,16 +409,52 @@ def update_gene_options(search_value):
      State('cell-meta-dropdown', 'value'),
      State('scatter-gene-dropdown', 'value'),
      State('scatter-mc-type-dropdown', 'value'),
-     State('gene-color-range-slider', 'value')]
+     State('gene-color-range-slider', 'value'),
+     State('paired-scatter-mode-radio', 'value')]
 )
-def update_both_scatters(_n_clicks, coords, downsample,
+def update_both_scatters(_n_clicks, cell_meta_relayout, gene_relayout,
+                         coords, downsample,
                          cell_types, brain_regions,
                          cell_meta_hue, gene_int,
-                         gene_mc_type, cnorm):
+                         gene_mc_type, cnorm, scatter_mode):
+    cell_meta_x_range, cell_meta_y_range = get_raster_ranges(scatter_mode, cell_meta_relayout, 'cell-meta-graph')
+    gene_x_range, gene_y_range = get_raster_ranges(scatter_mode, gene_relayout, 'gene-graph')
     if gene_int is None:
         gene_int = dataset.gene_name_to_int['Cux2']
     gene_name = dataset.gene_meta_table.loc[gene_int, 'gene_name']
 
+    if scatter_mode == 'raster':
+        active_data, background_data = _get_active_and_background_data(
+            coords=coords, downsample=dataset.n_cells,
+            cell_types=cell_types, brain_regions=brain_regions,
+            cell_meta_hue=cell_meta_hue, gene_int=gene_int,
+            gene_mc_type=gene_mc_type)
+        # zoom on one graph only re-render that graph
+        triggered = [t['prop_id'] for t in callback_context.triggered]
+        fig_cell_meta = no_update
+        fig_gene = no_update
+        if 'gene-graph.relayoutData' not in triggered:
+            if cell_meta_hue in CONTINUOUS_VAR:
+                fig_cell_meta = raster_scatter_fig(active_data, hue=cell_meta_hue,
+                                                   cnorm=CONTINUOUS_VAR_NORMS.get(cell_meta_hue, None),
+                                                   background_data=background_data,
+                                                   x_range=cell_meta_x_range, y_range=cell_meta_y_range,
+                                                   uirevision=coords)
+            else:
+                fig_cell_meta = raster_scatter_fig(active_data, hue=cell_meta_hue,
+                                                   palette=dataset.get_palette(cell_meta_hue),
+                                                   background_data=background_data,
+                                                   x_range=cell_meta_x_range, y_range=cell_meta_y_range,
+                                                   uirevision=coords)
+            update_scatter_layout(fig_cell_meta)
+        if 'cell-meta-graph.relayoutData' not in triggered:
+            fig_gene = raster_scatter_fig(active_data, hue=gene_name, cnorm=cnorm,
+                                          background_data=background_data,
+                                          x_range=gene_x_range, y_range=gene_y_range,
+                                          uirevision=coords)
+            update_scatter_layout(fig_gene)
+        return fig_cell_meta, fig_gene
+
     # print(_n_clicks)
     active_data, background_data = _get_active_and_background_data(
         coords=coords, downsample=downsample,
@@ -440,18 +496,7 @@ def update_both_scatters(_n_clicks, coords, downsample,
                                     hovertemplate='<b>%{hovertext}</b><br>'
                                                   f'<b>{cell_meta_hue}: </b>%{{customdata[0]}}')
 
-    fig_cell_meta.update_layout(showlegend=False,
-                                margin=dict(t=15, l=0, r=0, b=15),
-                                xaxis=go.layout.XAxis(title='',
-                                                      showticklabels=False,
-                                                      showgrid=False,
-                                                      zeroline=False),
-                                yaxis=go.layout.YAxis(title='',
-                                                      showticklabels=False,
-                                                      showgrid=False,
-                                                      zeroline=False),
-                                plot_bgcolor='rgba(0,0,0,0)',
-                                paper_bgcolor='rgba(0,0,0,0)')
+    update_scatter_layout(fig_cell_meta)
     # unselected_plot_df is gray background, no hover
     if background_data.shape[0] > 10:
         fig_cell_meta.add_trace(
@@ -481,18 +526,7 @@ def update_both_scatters(_n_clicks, coords, downsample,
                            marker_size=n_cell_to_marker_size(active_data.shape[0]),
                            hovertemplate='<b>%{hovertext}</b><br>'
                                          f'<b>{gene_name} m{gene_mc_type[:-1]}: </b>%{{customdata[0]:.3f}}')
-    fig_gene.update_layout(showlegend=False,
-                           margin=dict(t=15, l=0, r=0, b=15),
-                           xaxis=go.layout.XAxis(title='',
-                                                 showticklabels=False,
-                                                 showgrid=False,
-                                                 zeroline=False),
-                           yaxis=go.layout.YAxis(title='',
-                                                 showticklabels=False,
-                                                 showgrid=False,
-                                                 zeroline=False),
-                           plot_bgcolor='rgba(0,0,0,0)',
-                           paper_bgcolor='rgba(0,0,0,0)')
+    update_scatter_layout(fig_gene)
     # unselected_plot_df is gray background, no hover
     if background_data.shape[0] > 10:
         fig_gene.add_trace(
@@ -508,4 +542,4 @@ def update_both_scatters(_n_clicks, coords, downsample,
     # reorder data to put the background trace in first (bottom)
     fig_gene.data = fig_gene.data[::-1]
 
-    return fig_cell_meta, fig_gene
+    return compact_figure(fig_cell_meta), compact_figure(fig_gene)
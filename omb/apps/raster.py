@@ -0,0 +1,182 @@
+"""
+Rasterized scatter, aggregate all the cells into an image server-side with datashader.
+
+Plotly JSON for 100k+ points is too heavy, so the scatter plots are downsampled by default.
+In raster mode the figure only contain one PNG layout image plus an invisible trace that hold the axes range
+and the colorbar, the payload is a few hundred KB no matter how many cells are plotted.
+Zooming triggers a re-render of the zoomed range through the graph's relayoutData.
+"""
+import base64
+import io
+
+import datashader as ds
+import datashader.transfer_functions as tf
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import plotly.graph_objects as go
+from dash import callback_context
+from dash.exceptions import PreventUpdate
+
+RASTER_WIDTH = 600
+RASTER_MIN_HEIGHT = 150
+RASTER_MAX_HEIGHT = 1200
+BACKGROUND_COLOR = '#C8C8C8'
+SCATTER_MODE_OPTIONS = [{'label': 'Downsample', 'value': 'scatter'},
+                        {'label': 'All Cells (Image)', 'value': 'raster'}]
+
+
+def relayout_to_ranges(relayout_data):
+    """
+    Parse the graph relayoutData into axis ranges
+
+    Returns
+    -------
+    (x_range, y_range), both are None if the view is reset to autorange;
+    None if the relayout event is not a view change (e.g. autosize)
+    """
+    if not relayout_data:
+        return None
+    if relayout_data.get('xaxis.autorange') or relayout_data.get('yaxis.autorange'):
+        return None, None
+    try:
+        x_range = (relayout_data['xaxis.range[0]'], relayout_data['xaxis.range[1]'])
+        y_range = (relayout_data['yaxis.range[0]'], relayout_data['yaxis.range[1]'])
+    except KeyError:
+        return None
+    return x_range, y_range
+
+
+def get_raster_ranges(scatter_mode, relayout_data, graph_id):
+    """
+    Decide the range to render in a scatter callback that take the graph's relayoutData as input.
+
+    Zoom events only re-render in raster mode, other inputs re-render the full range.
+    Raise PreventUpdate if nothing need to be re-rendered.
+    """
+    triggered = [t['prop_id'] for t in callback_context.triggered]
+    if f'{graph_id}.relayoutData' not in triggered:
+        return None, None
+    if scatter_mode != 'raster':
+        raise PreventUpdate
+    ranges = relayout_to_ranges(relayout_data)
+    if ranges is None:
+        raise PreventUpdate
+    return ranges
+
+
+def _full_range(values, pad=0.02):
+    vmin, vmax = float(np.nanmin(values)), float(np.nanmax(values))
+    delta = max(vmax - vmin, 1e-6) * pad
+    return vmin - delta, vmax + delta
+
+
+def _img_to_uri(img):
+    buffer = io.BytesIO()
+    img.to_pil().save(buffer, format='png')
+    return 'data:image/png;base64,' + base64.b64encode(buffer.getvalue()).decode()
+
+
+def _shade(canvas, data, hue, palette, cnorm, colorscale):
+    if hue is None:
+        agg = canvas.points(data, 'x', 'y', agg=ds.count())
+        return tf.shade(agg, cmap=[BACKGROUND_COLOR, BACKGROUND_COLOR], how='eq_hist', min_alpha=80), None
+    elif palette is not None:
+        agg = canvas.points(data, 'x', 'y', agg=ds.count_cat(hue))
+        color_key = {c: palette.get(c, BACKGROUND_COLOR) for c in data[hue].cat.categories}
+        return tf.shade(agg, color_key=color_key, how='eq_hist', min_alpha=160), None
+    else:
+        agg = canvas.points(data, 'x', 'y', agg=ds.mean(hue))
+        if cnorm is None:
+            cnorm = (float(np.nanmin(agg.values)), float(np.nanmax(agg.values)))
+        cmap = getattr(px.colors.sequential, colorscale)
+        return tf.shade(agg, cmap=cmap, how='linear', span=cnorm), cnorm
+
+
+def _standardize_data(data, hue, palette):
+    # datashader do not aggregate float16, categorical hue need category dtype
+    _data = pd.DataFrame({'x': data['x'].astype(np.float32),
+                          'y': data['y'].astype(np.float32)})
+    if hue is not None:
+        if palette is not None:
+            _data[hue] = data[hue].astype(str).astype('category')
+        else:
+            _data[hue] = data[hue].astype(np.float32)
+    return _data
+
+
+def raster_scatter_fig(data, hue, palette=None, cnorm=None, colorscale='Viridis',
+                       background_data=None, x_range=None, y_range=None, uirevision=None):
+    """
+    Rasterized scatter figure of all cells
+
+    Parameters
+    ----------
+    data
+        Dataframe contain x, y and hue columns
+    hue
+        Color column of data
+    palette
+        Dict of category to color, if provided, hue is categorical, otherwise hue is continuous
+    cnorm
+        Color range of continuous hue, None to use the range of the data
+    colorscale
+        Name of plotly sequential colorscale for continuous hue
+    background_data
+        Dataframe contain x, y, cells drawn in gray under data
+    x_range
+        Rendered x range, None for the full range
+    y_range
+        Rendered y range, None for the full range
+    uirevision
+        Plotly uirevision, user zoom is kept while it is unchanged
+
+    Returns
+    -------
+    go.Figure
+    """
+    data = _standardize_data(data, hue, palette)
+    if background_data is not None:
+        background_data = _standardize_data(background_data, None, None)
+        total_data = pd.concat([data[['x', 'y']], background_data])
+    else:
+        total_data = data
+    if x_range is None or y_range is None:
+        x_range = _full_range(total_data['x'].values)
+        y_range = _full_range(total_data['y'].values)
+    x_range, y_range = tuple(sorted(x_range)), tuple(sorted(y_range))
+
+    plot_height = RASTER_WIDTH * (y_range[1] - y_range[0]) / (x_range[1] - x_range[0])
+    plot_height = int(min(max(plot_height, RASTER_MIN_HEIGHT), RASTER_MAX_HEIGHT))
+    canvas = ds.Canvas(plot_width=RASTER_WIDTH, plot_height=plot_height,
+                       x_range=x_range, y_range=y_range)
+
+    images = []
+    if background_data is not None and background_data.shape[0] > 0:
+        bg_img, _ = _shade(canvas, background_data, None, None, None, None)
+        images.append(tf.dynspread(bg_img, threshold=0.5, max_px=2))
+    if data.shape[0] > 0:
+        img, cnorm = _shade(canvas, data, hue, palette, cnorm, colorscale)
+        images.append(tf.dynspread(img, threshold=0.5, max_px=2))
+    if len(images) == 0:
+        raise PreventUpdate
+    img = tf.stack(*images)
+
+    # invisible corner points make the axes match the image, and hold the colorbar of continuous hue
+    marker = dict(opacity=0)
+    if palette is None and cnorm is not None:
+        marker.update(color=list(cnorm), cmin=cnorm[0], cmax=cnorm[1],
+                      colorscale=colorscale, showscale=True,
+                      colorbar=dict(title=hue))
+    fig = go.Figure(go.Scatter(x=x_range, y=y_range, mode='markers', marker=marker,
+                               hoverinfo='skip', showlegend=False))
+    fig.add_layout_image(source=_img_to_uri(img),
+                         xref='x', yref='y',
+                         x=x_range[0], y=y_range[1],
+                         sizex=x_range[1] - x_range[0],
+                         sizey=y_range[1] - y_range[0],
+                         sizing='stretch', layer='below')
+    fig.update_layout(xaxis=dict(range=x_range),
+                      yaxis=dict(range=y_range),
+                      uirevision=uirevision)
+    return fig
@@ -1,3 +1,13 @@
+import base64
+import pathlib
+import re
+
+import dash
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+
+
 def n_cell_to_marker_size(n_cells):
     if n_cells >= 100000:
         size = 1.5
@@ -22,3 +32,116 @@ def n_cell_to_marker_size(n_cells):
     else:
         size = 9
     return size
+
+
+def update_scatter_layout(fig):
+    """
+    Shared layout of the cell scatter plots, no legend, no axis and transparent background.
+    Axis properties are merged, so the axis range of raster_scatter_fig is kept.
+    """
+    fig.update_layout(showlegend=False,
+                      margin=dict(t=15, l=0, r=0, b=15),
+                      plot_bgcolor='rgba(0,0,0,0)',
+                      paper_bgcolor='rgba(0,0,0,0)')
+    fig.update_xaxes(title='', showticklabels=False, showgrid=False, zeroline=False)
+    fig.update_yaxes(title='', showticklabels=False, showgrid=False, zeroline=False)
+    return
+
+
+def _bundled_plotlyjs_version():
+    """Version of the plotly.js bundle served by dash, read from the header of plotly.min.js"""
+    candidates = []
+    try:
+        import dash_core_components
+        candidates.append(pathlib.Path(dash_core_components.__file__).parent)
+    except ImportError:
+        pass
+    candidates.append(pathlib.Path(dash.__file__).parent / 'dcc')
+    for package_dir in candidates:
+        path = package_dir / 'plotly.min.js'
+        if path.exists():
+            with open(path) as f:
+                match = re.search(r'plotly\.js v(\d+)\.(\d+)\.(\d+)', f.read(200))
+            if match:
+                return tuple(map(int, match.groups()))
+    return 0, 0, 0
+
+
+# plotly.js decode base64 typed array spec {'dtype': ..., 'bdata': ...} since 2.28.0
+BINARY_TRACE_DATA = _bundled_plotlyjs_version() >= (2, 28, 0)
+
+# trace attributes that carry one value per cell
+_ARRAY_TRACE_ATTRS = [('x',), ('y',), ('z',), ('customdata',), ('marker', 'color')]
+
+
+def _to_numeric_array(value):
+    if isinstance(value, dict) and 'bdata' in value:
+        # typed array spec already made by plotly.py>=6
+        array = np.frombuffer(base64.b64decode(value['bdata']), dtype=value['dtype'])
+        if 'shape' in value:
+            array = array.reshape([int(i) for i in str(value['shape']).split(',')])
+        return array
+    if isinstance(value, (list, tuple, np.ndarray, pd.Series, pd.Index)):
+        array = np.asarray(value)
+        if array.dtype.kind in 'iufb' and array.size > 0:
+            return array
+    return None
+
+
+def to_json_list(values, decimals=3):
+    """Numeric values to list, rounding float16/float32 values make the JSON text of each number
+    a few chars instead of ~18"""
+    array = np.asarray(values)
+    if array.dtype.kind == 'f':
+        return np.round(array.astype(np.float64), decimals).tolist()
+    return array.tolist()
+
+
+def _encode_array(array, decimals):
+    if BINARY_TRACE_DATA:
+        if array.dtype.kind == 'f':
+            array = array.astype('<f4')
+        elif array.dtype.kind == 'b':
+            array = array.astype('u1')
+        else:
+            array = array.astype('<i4')
+        spec = {'dtype': array.dtype.str[1:], 'bdata': base64.b64encode(array.tobytes()).decode()}
+        if array.ndim > 1:
+            spec['shape'] = ','.join(map(str, array.shape))
+        return spec
+    else:
+        return to_json_list(array, decimals)
+
+
+def compact_figure(fig, decimals=3):
+    """
+    Convert the per-cell numeric trace arrays of a scatter figure into a compact payload.
+
+    With plotly.js >= 2.28, arrays are sent as base64 typed arrays,
+    otherwise float values are rounded to reduce the JSON length.
+
+    Parameters
+    ----------
+    fig
+        plotly figure or figure dict
+    decimals
+        Rounding decimals of the JSON fallback
+
+    Returns
+    -------
+    figure dict, ready to return from the callback
+    """
+    if isinstance(fig, go.Figure):
+        fig = fig.to_plotly_json()
+    for trace in fig['data']:
+        for attrs in _ARRAY_TRACE_ATTRS:
+            parent = trace
+            for attr in attrs[:-1]:
+                parent = parent.get(attr)
+                if not isinstance(parent, dict):
+                    break
+            else:
+                array = _to_numeric_array(parent.get(attrs[-1]))
+                if array is not None:
+                    parent[attrs[-1]] = _encode_array(array, decimals)
+    return fig
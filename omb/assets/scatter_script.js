@@ -0,0 +1,45 @@
+if (!window.dash_clientside) {
+  window.dash_clientside = {};
+}
+window.dash_clientside.scatter = {
+  // Assemble the gene scatter from the coords store (sent once per coords) and the color store (sent once per gene),
+  // so changing the color range do not resend anything from the server.
+  gene_scatter_figure: function(coords, color, cnorm, scatter_mode, raster_fig) {
+    if (scatter_mode === "raster") {
+      return raster_fig ? raster_fig : window.dash_clientside.no_update;
+    }
+    if (!coords || !color || coords.key !== color.key) {
+      // wait for the stores of the same coords
+      return window.dash_clientside.no_update;
+    }
+    var hidden_axis = {title: "", showticklabels: false, showgrid: false, zeroline: false};
+    return {
+      data: [{
+        type: "scattergl",
+        mode: "markers",
+        x: coords.x,
+        y: coords.y,
+        hovertext: coords.text,
+        marker: {color: color.color, coloraxis: "coloraxis", size: coords.marker_size},
+        hovertemplate: "<b>%{hovertext}</b><br><b>" + color.name + ": </b>%{marker.color:.3f}<extra></extra>",
+        showlegend: false
+      }],
+      layout: {
+        coloraxis: {
+          cmin: cnorm[0],
+          cmax: cnorm[1],
+          colorscale: "Viridis",
+          colorbar: {title: {text: color.name}}
+        },
+        showlegend: false,
+        margin: {t: 15, l: 0, r: 0, b: 15},
+        xaxis: hidden_axis,
+        yaxis: Object.assign({}, hidden_axis),
+        plot_bgcolor: "rgba(0,0,0,0)",
+        paper_bgcolor: "rgba(0,0,0,0)",
+        // keep user zoom while only the color changes
+        uirevision: coords.key
+      }
+    };
+  }
+};
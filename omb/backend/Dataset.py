@@ -2,16 +2,33 @@
 Design:
 Dataset contain everything related to the apps, provides api that's used by dash apps
 Dataset load cell coords, user provided variables, and palettes into memory, assuming they are not large.
+Dataset can load every resource on first access (lazy=True), so worker startup do not pay for unused features.
 Dataset load gene or other large data lazily from xarray netCDF file, with lru_cache
 Dataset only has "getter" but not "setter", TODO let's think about front-end user provided custom info later.
 """
+import hashlib
 import json
+import multiprocessing
+import os
+import re
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from functools import lru_cache
 
 import joblib
 import xarray as xr
 from plyfile import PlyData
 
+from .cache import DiskArrayCache
+from .columnar import ColumnarFrame, read_frame, read_source
+from .dmg_store import PairwiseDMGStore, default_dmg_is_fresh, default_dmg_key, dmg_store_exists, \
+    load_default_dmg
+from .dmr import (bin_codes, count_bin_codes, filter_dmr_by_score, filter_dmr_by_score_parallel, init_dmr_worker,
+                  load_dmr_index)
+from .file_pool import DatasetHandlePool
+from .gene_store import GeneRateStore, gene_rate_store_exists
 from .ingest import *
 from .utilities import *
 
@@ -20,7 +37,7 @@ def _validate_dataset_dir():
     has_error = False
     for path in [DATASET_DIR, COORDS_PATH, CELL_ID_PATH, VARIABLE_PATH, PALETTE_PATH]:
         try:
-            assert pathlib.Path(path).exists()
+            assert pathlib.Path(path).exists() or (_columnar_keys(path) is not None)
         except AssertionError:
             print(f'Dataset related path: {path} do not exist')
             has_error = True
@@ -29,13 +46,40 @@ def _validate_dataset_dir():
     return
 
 
-def _logic_to_number(logic, options):
-    if logic == 'all':
-        return len(options)
-    elif logic == 'any':
-        return 1
-    else:
-        return min(int(logic), len(options))
+def _columnar_keys(hdf_path):
+    """HDF keys that have an up to date columnar copy of the coords or variables HDF, None if no copy can be used"""
+    columnar_path = {COORDS_PATH: COORDS_FEATHER_DIR, VARIABLE_PATH: VARIABLE_FEATHER_PATH}.get(hdf_path)
+    if columnar_path is None:
+        return None
+    return read_source(columnar_path, hdf_path)
+
+
+def _top_genes_from_access_log(access_log_path, top_n):
+    """Count the gene=... parameter in the request urls of a access log, return top_n genes"""
+    gene_pattern = re.compile(r'[?;&]gene=([^;&\s"]+)')
+    counts = Counter()
+    with open(access_log_path, errors='ignore') as f:
+        for line in f:
+            counts.update(gene_pattern.findall(line))
+    return [gene for gene, _ in counts.most_common(top_n)]
+
+
+def _create_lock_file(lock_path, timeout):
+    """Atomically create lock_path, return False if it exists and is younger than timeout seconds"""
+    for _ in range(2):
+        try:
+            # O_EXCL is atomic, only one process create the lock file
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            try:
+                if time.time() - os.stat(lock_path).st_mtime < timeout:
+                    return False
+                # left by a dead process, remove and try once more
+                os.unlink(lock_path)
+            except FileNotFoundError:
+                pass
+    return False
 
 
 def read_allen_ply(region_name):
@@ -81,116 +125,677 @@ def read_cemba_ply(region_id):
     return x, y, z, i, j, k
 
 
+def _pairwise_dmg_weighted_sum(hdf_path, pair_weights):
+    """Same as PairwiseDMGStore.weighted_sum, read one pair at a time from the pairwise DMG HDF"""
+    records = {}
+    with pd.HDFStore(hdf_path) as hdf:
+        for (a, b), weight in pair_weights.items():
+            try:
+                records[(a, b)] = hdf[f'{a} vs {b}'] * weight
+            except KeyError:
+                pass
+    return pd.DataFrame(records).sum(axis=1)
+
+
 class Dataset:
-    def __init__(self, dataset_dir=DATASET_DIR):
+    def __init__(self, dataset_dir=DATASET_DIR, shared_cache_dir=SHARED_CACHE_DIR, lazy=False):
+        """
+        Parameters
+        ----------
+        dataset_dir
+            Ingested dataset dir
+        shared_cache_dir
+            Cache dir shared by all worker processes, None to disable
+        lazy
+            If True, each resource (coords, variables, tables, DMR dataset...) is loaded on first access,
+            otherwise everything is loaded here. See startup_report for the load time of each resource.
+        """
+        init_start = time.time()
         # validate all paths
         _validate_dataset_dir()
         self.dataset_dir = pathlib.Path(dataset_dir)
+        self._shared_cache_dir = shared_cache_dir
+
+        # lazy resources, see lazy_resource
+        self._resource_lock = threading.Lock()
+        self._resource_locks = {}
+        self._load_times = {}
+        # key is coord name, value is coords dataframe, each coord is loaded on first use
+        self._coord_dict = {}
+        # key is variable name, value is variable series, each variable is loaded on first use
+        self._variable_dict = {}
+
+        # opened MCDS chunks, shared by all callbacks, genes in the same chunk reuse the handle
+        self._mcds_pool = DatasetHandlePool(max_open=MAX_OPEN_MCDS)
+        # gene rate read from MCDS chunks is shared with other worker processes through the disk cache
+        if shared_cache_dir is not None:
+            self._gene_cache = DiskArrayCache(pathlib.Path(shared_cache_dir) / 'gene_rate',
+                                              max_bytes=GENE_CACHE_MAX_BYTES)
+        else:
+            self._gene_cache = None
+        # query_dmr results, compressed hit positions, survive restarts and shared by all workers
+        if shared_cache_dir is not None:
+            self._dmr_cache = DiskArrayCache(pathlib.Path(shared_cache_dir) / 'dmr_query',
+                                             max_bytes=DMR_CACHE_MAX_BYTES,
+                                             compress=True)
+        else:
+            self._dmr_cache = None
+        # process pool of the parallel query_dmr, created on the first query with n_jobs > 1
+        self._dmr_executor = None
+        self._dmr_executor_size = 0
+
+        if not lazy:
+            for name, attr in vars(type(self)).items():
+                if isinstance(attr, lazy_resource):
+                    getattr(self, name)
+            for name in self.coord_names:
+                self._get_coords_df(name)
+        self._init_time = time.time() - init_start
+        if not lazy:
+            print(self.startup_report())
+        return
 
-        # load cell coords
-        with pd.HDFStore(self.dataset_dir / COORDS_PATH) as hdf:
-            coord_dict = {k.lstrip('/'): hdf[k] for k in hdf.keys()}
-        self._coord_dict = coord_dict
-        self.coord_names = list(coord_dict.keys())
+    def startup_report(self):
+        """Time used by Dataset init and each loaded resource, resources not loaded yet are not included"""
+        lines = [f'Dataset init: {self._init_time:.2f}s']
+        for name, load_time in sorted(self._load_times.items(), key=lambda i: -i[1]):
+            lines.append(f'  {name}: {load_time:.3f}s')
+        return '\n'.join(lines)
+
+    # load time of a resource include the time of other resources it depends on
+    # cell coords
+    @lazy_resource
+    def _coords_feather_names(self):
+        # coords read from the columnar copy, the others are read from the HDF
+        keys = _columnar_keys(COORDS_PATH)
+        return set(keys) if keys is not None else set()
+
+    @lazy_resource
+    def coord_names(self):
+        if not (self.dataset_dir / COORDS_PATH).exists():
+            return sorted(self._coords_feather_names)
+        with pd.HDFStore(self.dataset_dir / COORDS_PATH, 'r') as hdf:
+            names = [k.lstrip('/') for k in hdf.keys()]
+        missing = [name for name in names if name not in self._coords_feather_names]
+        if (len(missing) > 0) and (len(self._coords_feather_names) > 0):
+            print(f'Coords {missing} do not have a columnar copy, read from {COORDS_PATH}')
+        return names
+
+    def _get_coords_df(self, name):
+        try:
+            return self._coord_dict[name]
+        except KeyError:
+            with resource_lock(self, f'coords/{name}'):
+                if name not in self._coord_dict:
+                    start = time.time()
+                    if name in self._coords_feather_names:
+                        coords_df = read_frame(pathlib.Path(COORDS_FEATHER_DIR) / f'{name}.feather')
+                    else:
+                        coords_df = pd.read_hdf(self.dataset_dir / COORDS_PATH, key=name)
+                    # shared by all callbacks, see get_coords
+                    self._coord_dict[name] = read_only(coords_df)
+                    self._load_times[f'coords/{name}'] = time.time() - start
+            return self._coord_dict[name]
+
+    @lazy_resource
+    def _coord_permutation(self):
+        # key is coord name, value is cell ints of this coord in a fixed random order, see coords_permutation
+        if pathlib.Path(COORDS_PERMUTATION_PATH).exists():
+            with np.load(COORDS_PERMUTATION_PATH) as f:
+                return {k: f[k] for k in f.files}
+        else:
+            return {}
+
+    def _get_coord_permutation(self, name):
+        try:
+            return self._coord_permutation[name]
+        except KeyError:
+            # dataset ingested before the permutation file exist
+            with resource_lock(self, f'coord_permutation/{name}'):
+                if name not in self._coord_permutation:
+                    self._coord_permutation[name] = coords_permutation(self._get_coords_df(name))
+            return self._coord_permutation[name]
+
+    def downsample_cells(self, coord_name, n, mask=None, exclude=None):
+        """
+        Deterministic downsample of the cells in a coords without shuffling the table,
+        return the first n cells of the precomputed random permutation that satisfy the mask.
+
+        Parameters
+        ----------
+        coord_name
+            Name of the coords
+        n
+            Max number of cells to return
+        mask
+            None or boolean series indexed by cell int, cells not in the mask index are treated as False
+        exclude
+            None or list-like of cell ints that should not be returned
+
+        Returns
+        -------
+        pd.Index of cell ints
+        """
+        cells = self._get_coord_permutation(coord_name)
+        if mask is not None:
+            judge = mask.reindex(cells, fill_value=False).values.astype(bool)
+            cells = cells[judge]
+        if exclude is not None:
+            cells = cells[~np.isin(cells, np.asarray(exclude))]
+        return pd.Index(cells[:int(n)], name='cell')
+
+    @lazy_resource
+    def coord_cell_type_occur(self):
         # key is coord name, value is cell type list that occur in this coord
-        self.coord_cell_type_occur = joblib.load(COORDS_CELL_TYPE_PATH)
-
-        # load cell ids
-        self._cell_id_to_int = read_msgpack(self.dataset_dir / CELL_ID_PATH)
-        self._int_to_cell_id = {v: k for k, v in self._cell_id_to_int.items()}
-        self.n_cells = len(self._cell_id_to_int)
-
-        # load cell tidy table
-        self._variables = pd.read_hdf(self.dataset_dir / VARIABLE_PATH, key='data')
-        # Categorical var
-        self.categorical_var = self._variables.columns[self._variables.dtypes == 'category'].tolist()
-        self.n_categorical_var = len(self.categorical_var)
-        # Continuous var
-        self.continuous_var = self._variables.columns[self._variables.dtypes != 'category'].tolist()
-        self.n_continuous_var = len(self.continuous_var)
-
-        # separate table for region and cluster annotation
-        # brain region table, index is Region Name
-        self._brain_region_table = pd.read_csv(BRAIN_REGION_PATH, index_col=0)
-        self.dissection_regions = self._brain_region_table.index.tolist()
-        self.major_regions = list(self._brain_region_table['Major Region'].unique())
-        self.sub_regions = list(self._brain_region_table['Sub-Region'].unique())
-        self.region_label_to_cemba_name = self._brain_region_table['Dissection Region ID'].to_dict()
-        self.cemba_name_to_region_label = {v: k for k, v in self.region_label_to_cemba_name.items()}
-        self.dissection_region_to_major_region = self._brain_region_table['Major Region'].to_dict()
-        self.dissection_region_to_sub_region = self._brain_region_table['Sub-Region'].to_dict()
-
-        # cell type maps
-        self._cell_type_table = pd.read_csv(CELL_TYPE_PATH, index_col=0)
-        self.child_to_parent = self._cell_type_table.loc[
+        return joblib.load(COORDS_CELL_TYPE_PATH)
+
+    @lazy_resource
+    def _dataset_version(self):
+        return dataset_version()
+
+    # cell ids
+    @lazy_resource
+    def _cell_id_to_int(self):
+        return read_msgpack(self.dataset_dir / CELL_ID_PATH)
+
+    @lazy_resource
+    def _int_to_cell_id(self):
+        return {v: k for k, v in self._cell_id_to_int.items()}
+
+    @lazy_resource
+    def n_cells(self):
+        return len(self._cell_id_to_int)
+
+    # cell tidy table
+    @lazy_resource
+    def _variables_columnar(self):
+        if _columnar_keys(VARIABLE_PATH) is None:
+            return None
+        return ColumnarFrame(VARIABLE_FEATHER_PATH)
+
+    @lazy_resource
+    def _variables(self):
+        # whole table, callbacks read single columns through _get_variables_df
+        if self._variables_columnar is not None:
+            return read_only(self._get_variables_df(self.variable_names))
+        return read_only(pd.read_hdf(self.dataset_dir / VARIABLE_PATH, key='data'))
+
+    @lazy_resource
+    def variable_names(self):
+        if self._variables_columnar is not None:
+            return self._variables_columnar.columns
+        return self._variables.columns.tolist()
+
+    def _get_variable(self, name):
+        if self._variables_columnar is None:
+            return self._variables[name]
+        self._load_variables([name])
+        return self._variable_dict[name]
+
+    def _get_variables_df(self, names):
+        if self._variables_columnar is None:
+            return self._variables[names]
+        self._load_variables(names)
+        return pd.DataFrame({name: self._variable_dict[name] for name in names}, copy=False)
+
+    def _load_variables(self, names):
+        missing = [name for name in names if name not in self._variable_dict]
+        if len(missing) > 0:
+            with resource_lock(self, 'variables'):
+                missing = [name for name in missing if name not in self._variable_dict]
+                if len(missing) > 0:
+                    start = time.time()
+                    for name, data in self._variables_columnar.read_columns(missing).items():
+                        self._variable_dict[name] = read_only(data)
+                    self._load_times[f'variables/{",".join(missing)}'] = time.time() - start
+        return
+
+    @lazy_resource
+    def categorical_var(self):
+        if self._variables_columnar is not None:
+            return self._variables_columnar.categorical_columns
+        return self._variables.columns[self._variables.dtypes == 'category'].tolist()
+
+    @lazy_resource
+    def n_categorical_var(self):
+        return len(self.categorical_var)
+
+    @lazy_resource
+    def continuous_var(self):
+        return [name for name in self.variable_names if name not in self.categorical_var]
+
+    @lazy_resource
+    def n_continuous_var(self):
+        return len(self.continuous_var)
+
+    # separate table for region and cluster annotation
+    # brain region table, index is Region Name
+    @lazy_resource
+    def _brain_region_table(self):
+        return pd.read_csv(BRAIN_REGION_PATH, index_col=0)
+
+    @lazy_resource
+    def dissection_regions(self):
+        return self._brain_region_table.index.tolist()
+
+    @lazy_resource
+    def major_regions(self):
+        return list(self._brain_region_table['Major Region'].unique())
+
+    @lazy_resource
+    def sub_regions(self):
+        return list(self._brain_region_table['Sub-Region'].unique())
+
+    @lazy_resource
+    def region_label_to_cemba_name(self):
+        return self._brain_region_table['Dissection Region ID'].to_dict()
+
+    @lazy_resource
+    def cemba_name_to_region_label(self):
+        return {v: k for k, v in self.region_label_to_cemba_name.items()}
+
+    @lazy_resource
+    def dissection_region_to_major_region(self):
+        return self._brain_region_table['Major Region'].to_dict()
+
+    @lazy_resource
+    def dissection_region_to_sub_region(self):
+        return self._brain_region_table['Sub-Region'].to_dict()
+
+    # cell type maps
+    @lazy_resource
+    def _cell_type_table(self):
+        return pd.read_csv(CELL_TYPE_PATH, index_col=0)
+
+    @lazy_resource
+    def child_to_parent(self):
+        child_to_parent = self._cell_type_table.loc[
             self._cell_type_table['Cluster Level'] == 'SubType', 'Parent'].to_dict()
-        self.child_to_parent.update(self._cell_type_table.loc[
-                                        self._cell_type_table['Cluster Level'] == 'MajorType', 'Parent'].to_dict())
-        self.sub_type_to_cell_class = self._variables.set_index('SubType')['CellClass'].to_dict()
-        self.parent_to_children_list = self._cell_type_table.groupby('Parent').apply(
-            lambda i: i.index.tolist()).to_dict()
-        self.cluster_name_to_level = self._cell_type_table['Cluster Level'].to_dict()
-
-        # load palette for Categorical var
-        with open(self.dataset_dir / PALETTE_PATH) as f:
-            self._palette = json.load(f)
-        self._palette['RegionName'] = {self.cemba_name_to_region_label[k]: v
-                                       for k, v in self._palette['Region'].items()}
+        child_to_parent.update(self._cell_type_table.loc[
+                                   self._cell_type_table['Cluster Level'] == 'MajorType', 'Parent'].to_dict())
+        return child_to_parent
+
+    @lazy_resource
+    def sub_type_to_cell_class(self):
+        return self._get_variables_df(['SubType', 'CellClass']).set_index('SubType')['CellClass'].to_dict()
+
+    @lazy_resource
+    def parent_to_children_list(self):
+        return self._cell_type_table.groupby('Parent').apply(lambda i: i.index.tolist()).to_dict()
 
-        # gene rate
-        self._gene_meta_table = pd.read_hdf(GENE_META_PATH)  # index is gene int gene_id is a column
-        self.gene_id_to_int = {v: k for k, v in self._gene_meta_table['gene_id'].items()}
+    @lazy_resource
+    def cluster_name_to_level(self):
+        return self._cell_type_table['Cluster Level'].to_dict()
+
+    # palette for Categorical var
+    @lazy_resource
+    def _palette(self):
+        with open(self.dataset_dir / PALETTE_PATH) as f:
+            palette = json.load(f)
+        palette['RegionName'] = {self.cemba_name_to_region_label[k]: v
+                                 for k, v in palette['Region'].items()}
+        return palette
+
+    # gene rate
+    @lazy_resource
+    def _gene_meta_table(self):
+        return pd.read_hdf(GENE_META_PATH)  # index is gene int gene_id is a column
+
+    @lazy_resource
+    def gene_id_to_int(self):
+        return {v: k for k, v in self._gene_meta_table['gene_id'].items()}
+
+    @lazy_resource
+    def gene_name_to_int(self):
         # TODO gene name is not unique
-        self.gene_name_to_int = {v: k for k, v in self._gene_meta_table['gene_name'].items()}
+        return {v: k for k, v in self._gene_meta_table['gene_name'].items()}
 
+    @lazy_resource
+    def _gene_to_mcds_path(self):
         with open(GENE_TO_MCDS_PATH) as f:
             gene_to_mcds_name = json.load(f)
-            self._gene_to_mcds_path = {int(g): f'{GENE_MCDS_DIR}/{n}' for g, n in gene_to_mcds_name.items()}
-
-        # Pairwise DMG
-        self._cluster_dist = pd.read_hdf(CLUSTER_DIST_PATH)
+        return {int(g): f'{GENE_MCDS_DIR}/{n}' for g, n in gene_to_mcds_name.items()}
 
-        # AnnoJ metadata
-        self._annoj_track_meta = pd.read_csv(ANNOJ_META_PATH, index_col=0)
-        self._annoj_gene_track_id = self._annoj_track_meta.loc['Gene', 'id']
-        self.cell_type_to_annoj_track_id = self._annoj_track_meta[self._annoj_track_meta['type'] == 'MethTrack'][
-            'id'].to_dict()
-
-        # Allen CCF metadata
-        self._allen_ccf_meta = pd.read_csv(ALLEN_CCF_META_PATH, index_col=0)  # region acronym is the index
-        self.allen_ccf_regions = sorted(self._allen_ccf_meta.index)
+    @lazy_resource
+    def _gene_rate_store(self):
+        if gene_rate_store_exists(GENE_RATE_STORE_DIR):
+            return GeneRateStore(GENE_RATE_STORE_DIR)
+        else:
+            # fall back to MCDS chunks, use gene_store.build_gene_rate_store to make the store
+            return None
+
+    # Pairwise DMG
+    @lazy_resource
+    def _cluster_dist(self):
+        return pd.read_hdf(CLUSTER_DIST_PATH)
+
+    @lazy_resource
+    def _dmg_store(self):
+        # key is protein_coding, fall back to the pairwise DMG HDF if the store not exist,
+        # use dmg_store.build_dmg_store to make the store
+        stores = {}
+        for protein_coding, store_dir in [(True, PROTEIN_CODING_PAIRWISE_DMG_STORE_DIR),
+                                          (False, TOTAL_PAIRWISE_DMG_STORE_DIR)]:
+            stores[protein_coding] = PairwiseDMGStore(store_dir) if dmg_store_exists(store_dir) else None
+        return stores
+
+    @lazy_resource
+    def _default_dmg(self):
+        # precomputed default comparisons and their top_n, see precompute.py
+        if not pathlib.Path(DEFAULT_DMG_PATH).exists():
+            return {}, 0
+        if not default_dmg_is_fresh(DEFAULT_DMG_PATH, self.dmg_source_paths()):
+            print(f'{DEFAULT_DMG_PATH} is older than the DMG files, ignored. '
+                  f'Run precompute.precompute_default_dmg to update it')
+            return {}, 0
+        return load_default_dmg(DEFAULT_DMG_PATH)
+
+    # AnnoJ metadata
+    @lazy_resource
+    def _annoj_track_meta(self):
+        return pd.read_csv(ANNOJ_META_PATH, index_col=0)
+
+    @lazy_resource
+    def _annoj_gene_track_id(self):
+        return self._annoj_track_meta.loc['Gene', 'id']
+
+    @lazy_resource
+    def cell_type_to_annoj_track_id(self):
+        return self._annoj_track_meta[self._annoj_track_meta['type'] == 'MethTrack']['id'].to_dict()
+
+    # Allen CCF metadata
+    @lazy_resource
+    def _allen_ccf_meta(self):
+        return pd.read_csv(ALLEN_CCF_META_PATH, index_col=0)  # region acronym is the index
+
+    @lazy_resource
+    def allen_ccf_regions(self):
+        return sorted(self._allen_ccf_meta.index)
+
+    @lazy_resource
+    def brain_region_acronym_to_name(self):
         with open(ALLEN_CCF_ACRONYM_TO_NAME) as f:
-            self.brain_region_acronym_to_name = json.load(f)
+            acronym_to_name = json.load(f)
         with open(CEMBA_ACRONYM_TO_NAME) as f:
-            self.brain_region_acronym_to_name.update(json.load(f))
+            acronym_to_name.update(json.load(f))
+        return acronym_to_name
+
+    # DMR
+    @lazy_resource
+    def dmr_ds(self):
+        return xr.open_dataset(DMR_DATASET)
+
+    @lazy_resource
+    def dmr_index(self):
+        return self.dmr_ds.get_index('id')
+
+    @lazy_resource
+    def dmr_subtype(self):
+        return self.dmr_ds.get_index('Subtype')
+
+    @lazy_resource
+    def _dmr_index(self):
+        return load_dmr_index(DMR_DATASET, DMR_INDEX_PATH, fallback_dir=self._shared_cache_dir)
+
+    @lazy_resource
+    def _dmr_bin_codes(self):
+        # uint8 bin code of each DMR and the count of all DMRs in each bin, for the DMR browser bar plots
+        length = (self.dmr_ds['end'] - self.dmr_ds['start']).values
+        dms = self.dmr_ds['number_of_dms'].values
+        bin_dict = {}
+        for name, values, bins in [('length', length, DMR_LENGTH_BINS), ('dms', dms, DMS_BINS)]:
+            codes = bin_codes(values, bins)
+            bin_dict[name] = (codes, count_bin_codes(codes, len(bins) - 1))
+        return bin_dict
+
+    def _get_dmr_executor(self, n_jobs):
+        """
+        Process pool of query_dmr with at least n_jobs workers, a larger request replace the pool with a larger one.
+        The old pool is not shut down here, other threads may still be submitting to it,
+        its workers exit once the pool is garbage collected and the submitted queries are done.
+        """
+        # workers are spawned rather than forked from the multi-threaded server process, so they do not inherit
+        # the locks, the open xarray handles and the HDF5 state of this process,
+        # each worker open DMR_DATASET read-only once and close it on exit, see dmr.init_dmr_worker
+        with resource_lock(self, 'dmr_executor'):
+            if (self._dmr_executor is None) or (self._dmr_executor_size < n_jobs):
+                if self._dmr_executor is not None:
+                    print(f'Resizing the DMR query pool from {self._dmr_executor_size} to {n_jobs} workers')
+                self._dmr_executor_size = max(n_jobs, DMR_QUERY_N_JOBS)
+                self._dmr_executor = ProcessPoolExecutor(max_workers=self._dmr_executor_size,
+                                                         mp_context=multiprocessing.get_context('spawn'),
+                                                         initializer=init_dmr_worker,
+                                                         initargs=(DMR_DATASET,))
+            return self._dmr_executor
+
+    def get_dmr_bin_counts(self, name, positions=None):
+        """
+        Number of DMRs in each bin of DMR_LENGTH_BINS (name="length") or DMS_BINS (name="dms")
 
-        # DMR
-        self.dmr_ds = xr.open_dataset(DMR_DATASET)
-        self.dmr_index = self.dmr_ds.get_index('id')
-        self.dmr_subtype = self.dmr_ds.get_index('Subtype')
+        Parameters
+        ----------
+        name
+            "length" or "dms"
+        positions
+            int positions of selected DMRs, e.g. from query_dmr, None for all DMRs
+        """
+        codes, total_counts = self._dmr_bin_codes[name]
+        if positions is None:
+            return total_counts
+        return count_bin_codes(codes[positions], total_counts.size)
 
-        return
+    def get_coords(self, name, cells=None, copy=False):
+        """
+        Return coords dataframe, if cells is provided, only return these cells in the same order
 
-    def get_coords(self, name):
-        return self._coord_dict[name].copy()
+        Without cells, the dataframe is a shallow copy of the shared coords, its values are read-only,
+        adding columns is fine, use copy=True to get a writable deep copy.
+        """
+        if cells is not None:
+            return self._get_coords_df(name).loc[cells]
+        return self._get_coords_df(name).copy(deep=copy)
 
     def get_palette(self, name):
         return self._palette[name]
 
-    def get_variables(self, name):
-        return self._variables[name].copy()
+    def get_variables(self, name, cells=None, copy=False):
+        """
+        Return cell variables, if cells is provided, only return these cells in the same order
+
+        Same as get_coords, without cells the values are read-only unless copy=True.
+        """
+        if isinstance(name, str):
+            variables = self._get_variable(name)
+        else:
+            variables = self._get_variables_df(list(name))
+        if cells is not None:
+            return variables.reindex(cells)
+        return variables.copy(deep=copy)
 
     @lru_cache(maxsize=256)
     def get_gene_rate(self, gene_int, mc_type='CHN'):
+        if (self._gene_rate_store is not None) and self._gene_rate_store.has_gene(gene_int, mc_type):
+            # zero-copy row slice of the memory-mapped gene-major matrix, already np.float16
+            return self._gene_rate_store.get_gene_rate(gene_int, mc_type)
+
         mcds_path = self._gene_to_mcds_path[gene_int]
+        # the disk cache survive restarts, rates cached from an older dataset version or an older MCDS chunk
+        # (e.g. before a re-ingest or an append) are not used
+        cache_key = f'{gene_int}-{mc_type}-{self._dataset_version}-{os.stat(mcds_path).st_mtime_ns}'
+        if self._gene_cache is not None:
+            cached = self._gene_cache.get(cache_key)
+            if cached is not None:
+                return pd.Series(cached['rate'], index=pd.Index(cached['cell'], name='cell'))
 
         # it took 250ms to get a gene value series for 100k cell
         # because MCDS is re chunked and saved based on gene chunks rather than cell chunk
         # see prepare_gene_rate_for_browser.ipynb
-        data = xr.open_dataset(mcds_path)['gene_da'].sel(gene=gene_int, mc_type=mc_type).to_pandas()
+        with self._mcds_pool.open(mcds_path) as mcds:
+            data = mcds['gene_da'].sel(gene=gene_int, mc_type=mc_type).to_pandas()
 
         # return np.float16 to reduce data transfer
-        return data.astype(np.float16)
+        data = data.astype(np.float16)
+        if self._gene_cache is not None:
+            self._gene_cache.set(cache_key, {'cell': data.index.values, 'rate': data.values})
+        return data
+
+    def _gene_to_int(self, gene):
+        try:
+            return int(gene)
+        except ValueError:
+            if gene in self.gene_name_to_int:
+                return self.gene_name_to_int[gene]
+            elif gene in self.gene_id_to_int:
+                return self.gene_id_to_int[gene]
+            else:
+                return None
+
+    def warm_up_gene_cache(self, genes=WARM_UP_GENES, access_log_path=GENE_ACCESS_LOG_PATH, top_n=100,
+                           mc_types=('CHN', 'CGN'), n_workers=4):
+        """
+        Load genes into the gene cache in a background thread pool, so they are not cold after deploy.
+        This function returns immediately, the server can accept requests while warming up.
+        With the shared cache, a lock file make only one of the worker processes starting together load the genes,
+        the lock is removed when the warm up finish, or treated as stale after WARM_UP_LOCK_TIMEOUT seconds,
+        so the next deploy or restart warm up again.
+        Skipped when the gene rate store exists, the store serve genes without the cache.
+
+        Parameters
+        ----------
+        genes
+            Gene names, gene ids or gene ints always loaded
+        access_log_path
+            Web server access log, top_n most requested genes in it are also loaded, skipped if not exist
+        top_n
+            Number of genes to load from the access log
+        mc_types
+            mc_types of each gene to load
+        n_workers
+            Number of threads to load genes
+
+        Returns
+        -------
+        The background thread, None if skipped or another process is warming up the shared cache
+        """
+        if self._gene_rate_store is not None:
+            print('Gene rate store exists, gene cache warm up skipped')
+            return None
+
+        lock_path = None
+        if self._gene_cache is not None:
+            lock_path = self._gene_cache.cache_dir / 'warm_up.lock'
+            if not _create_lock_file(lock_path, WARM_UP_LOCK_TIMEOUT):
+                return None
+
+        def _load_genes():
+            warm_up_genes = list(genes)
+            if (access_log_path is not None) and pathlib.Path(access_log_path).exists():
+                try:
+                    warm_up_genes += _top_genes_from_access_log(access_log_path, top_n)
+                except OSError as e:
+                    print(f'Can not read access log {access_log_path}: {e}')
+
+            gene_ints = []
+            for gene in warm_up_genes:
+                gene_int = self._gene_to_int(gene)
+                if (gene_int is not None) and (gene_int not in gene_ints):
+                    gene_ints.append(gene_int)
+
+            def _load(args):
+                try:
+                    self.get_gene_rate(*args)
+                except Exception as e:
+                    # warm up never break the server
+                    print(f'Warm up gene {args} failed: {e}')
+                return
+
+            start = time.time()
+            with ThreadPoolExecutor(max_workers=n_workers) as executor:
+                list(executor.map(_load, [(g, m) for g in gene_ints for m in mc_types]))
+            print(f'Gene cache warmed up with {len(gene_ints)} genes in {time.time() - start:.1f}s')
+            return
+
+        def _warm_up():
+            try:
+                _load_genes()
+            finally:
+                # the next deploy or restart warm up again
+                if lock_path is not None:
+                    try:
+                        lock_path.unlink()
+                    except FileNotFoundError:
+                        pass
+            return
+
+        thread = threading.Thread(target=_warm_up, name='gene-cache-warm-up', daemon=True)
+        thread.start()
+        return thread
+
+    def gene_cache_stats(self):
+        """Hit and miss counts of the per-process lru_cache and the shared disk cache of get_gene_rate"""
+        lru_info = self.get_gene_rate.cache_info()
+        stats = {'lru_hits': lru_info.hits, 'lru_misses': lru_info.misses}
+        if self._gene_cache is not None:
+            stats.update({f'shared_{k}': v for k, v in self._gene_cache.stats().items()})
+        return stats
+
+    def query_cache_stats(self):
+        """Hit ratio of the canonical memo of the query methods, and of the shared query_dmr cache"""
+        stats = {'query_dmr': self.query_dmr.cache_stats(),
+                 'query_dmg': self.query_dmg.cache_stats()}
+        if self._dmr_cache is not None:
+            stats['query_dmr_shared'] = self._dmr_cache.stats()
+        return stats
+
+    def get_gene_rates(self, gene_ints, mc_type='CHN', n_jobs=1):
+        """
+        Get gene rates of multiple genes, genes are grouped by MCDS chunk and each chunk is read once
+
+        Parameters
+        ----------
+        gene_ints
+            List of gene ints
+        mc_type
+            CHN or CGN
+        n_jobs
+            Number of threads to read different MCDS chunks in parallel
+
+        Returns
+        -------
+        cell by gene dataframe in np.float16, columns in the same order as gene_ints
+        """
+        gene_ints = list(gene_ints)
+        unique_genes = list(dict.fromkeys(gene_ints))
+        if (self._gene_rate_store is not None) and \
+                all(self._gene_rate_store.has_gene(g, mc_type) for g in unique_genes):
+            return self._gene_rate_store.get_gene_rates(gene_ints, mc_type)
+
+        mcds_to_genes = {}
+        for gene_int in unique_genes:
+            mcds_to_genes.setdefault(self._gene_to_mcds_path[gene_int], []).append(gene_int)
+
+        def _read_chunk(mcds_path):
+            with self._mcds_pool.open(mcds_path) as mcds:
+                chunk_data = mcds['gene_da'].sel(gene=mcds_to_genes[mcds_path], mc_type=mc_type)
+                chunk_data = chunk_data.transpose('cell', 'gene').to_pandas()
+            return chunk_data.astype(np.float16)
+
+        if (n_jobs > 1) and (len(mcds_to_genes) > 1):
+            with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                chunks = list(executor.map(_read_chunk, mcds_to_genes.keys()))
+        else:
+            chunks = [_read_chunk(mcds_path) for mcds_path in mcds_to_genes.keys()]
+        data = pd.concat(chunks, axis=1)[gene_ints]
+        return data
+
+    def close(self):
+        """Close all opened files"""
+        self._mcds_pool.close_all()
+        if 'dmr_ds' in self.__dict__:
+            self.dmr_ds.close()
+        if self._dmr_executor is not None:
+            self._dmr_executor.shutdown()
+        return
 
     @property
     def brain_region_table(self):
@@ -215,6 +820,7 @@ class Dataset:
             total_dict[region] = [region]
         return total_dict
 
+    @canonical_memo(maxsize=128, set_args=('hypo_clusters', 'hyper_clusters'), copy=True)
     def query_dmg(self, hypo_clusters, hyper_clusters, cluster_level, top_n=100, protein_coding=True):
         """
         Given two set of clusters in the same level, order CH DMGs and return a gene meta table
@@ -235,41 +841,16 @@ class Dataset:
         -------
         Ranked DMG metadata table
         """
-
-        if protein_coding:
-            hdf_path = PROTEIN_CODING_PAIRWISE_DMG_PATH
+        default_tables, default_top_n = self._default_dmg
+        default_genes = default_tables.get(default_dmg_key(hypo_clusters, hyper_clusters, cluster_level, protein_coding))
+        if (default_genes is not None) and (top_n <= default_top_n):
+            # precomputed default comparison, see precompute.py
+            final_genes = default_genes[:top_n]
         else:
-            hdf_path = TOTAL_PAIRWISE_DMG_PATH
-
-        # rank gene based on all possible pair AUROC weighted by
-        records = {}
-        with pd.HDFStore(hdf_path) as hdf:
-            # this HDF contain pairwise DMG results
-            for hypo in hypo_clusters:
-                for hyper in hyper_clusters:
-                    # if hypo hyper from different cell class, then use the major type to calculate
-                    if cluster_level == 'SubType':
-                        hypo_cell_class = self.sub_type_to_cell_class[hypo]
-                        hyper_cell_class = self.sub_type_to_cell_class[hyper]
-                        if hypo_cell_class != hyper_cell_class:
-                            hypo = self.sub_type_to_major_type[hypo]
-                            hyper = self.sub_type_to_major_type[hyper]
-
-                    # weight on DMG for similar clusters (dist close to 1)
-                    this_dist = self._cluster_dist[(hypo, hyper)]  # this is symmetric
-                    try:
-                        records[(hypo, hyper)] = hdf[f'{hypo} vs {hyper}'] * this_dist  # AUROC * dist
-                    except KeyError:
-                        pass
-                    try:
-                        records[(hyper, hypo)] = hdf[f'{hyper} vs {hypo}'] * -this_dist
-                    except KeyError:
-                        pass
-
-        sorted_genes = pd.DataFrame(records).sum(axis=1).sort_values(ascending=False)
-        final_genes = sorted_genes[sorted_genes > 0][:top_n]  # size <= top_n
+            final_genes = self.rank_dmg(hypo_clusters, hyper_clusters, cluster_level,
+                                        protein_coding=protein_coding)[:top_n]  # size <= top_n
 
-        final_meta_table = self.gene_meta_table.loc[final_genes.index].reset_index(drop=True)
+        final_meta_table = self.gene_meta_table.loc[final_genes].reset_index(drop=True)
         final_meta_table['rank'] = (final_meta_table.index + 1).astype(int)
 
         # add gene size
@@ -277,6 +858,71 @@ class Dataset:
 
         return final_meta_table
 
+    def dmg_source_paths(self):
+        """Files rank_dmg read, the cluster distance and the DMG store matrix or HDF of each gene type"""
+        paths = [CLUSTER_DIST_PATH]
+        for protein_coding in [True, False]:
+            store = self._dmg_store[protein_coding]
+            if store is not None:
+                paths.append(store.store_dir / 'AUROC.npy')
+            else:
+                paths.append(PROTEIN_CODING_PAIRWISE_DMG_PATH if protein_coding else TOTAL_PAIRWISE_DMG_PATH)
+        return [str(p) for p in paths]
+
+    def rank_dmg(self, hypo_clusters, hyper_clusters, cluster_level, protein_coding=True):
+        """Live gene ranking of query_dmg, return gene ints with positive score from high to low"""
+        # rank gene based on all possible pair AUROC weighted by cluster distance
+        pair_weights = {}
+        for hypo in hypo_clusters:
+            for hyper in hyper_clusters:
+                # if hypo hyper from different cell class, then use the major type to calculate
+                if cluster_level == 'SubType' and \
+                        self.sub_type_to_cell_class[hypo] != self.sub_type_to_cell_class[hyper]:
+                    hypo_name = self.child_to_parent[hypo]
+                    hyper_name = self.child_to_parent[hyper]
+                else:
+                    hypo_name, hyper_name = hypo, hyper
+
+                # weight on DMG for similar clusters (dist close to 1)
+                this_dist = self._cluster_dist[(hypo_name, hyper_name)]  # this is symmetric
+                pair_weights[(hypo_name, hyper_name)] = this_dist  # AUROC * dist
+                pair_weights[(hyper_name, hypo_name)] = -this_dist
+
+        store = self._dmg_store[protein_coding]
+        if store is not None:
+            gene_score = store.weighted_sum(pair_weights)
+        else:
+            hdf_path = PROTEIN_CODING_PAIRWISE_DMG_PATH if protein_coding else TOTAL_PAIRWISE_DMG_PATH
+            gene_score = _pairwise_dmg_weighted_sum(hdf_path, pair_weights)
+
+        sorted_genes = gene_score.sort_values(ascending=False, kind='mergesort')
+        return sorted_genes.index[sorted_genes > 0]
+
+    def default_dmg_comparison(self, cell_type_name):
+        """
+        Default DMG comparison of a cell type, the cell type vs its siblings.
+        Cell classes are compared with the major types of the other neuron class.
+
+        Returns
+        -------
+        dmg_level, hypo_clusters, hyper_clusters
+        """
+        cluster_level = self.cluster_name_to_level[cell_type_name]
+        if cluster_level == 'CellClass':
+            dmg_level = 'MajorType'
+            hypo_clusters = self.parent_to_children_list[cell_type_name]
+            hyper_clusters = []
+            for sibling in ['Exc', 'Inh']:
+                if sibling != cell_type_name:
+                    hyper_clusters += self.parent_to_children_list[sibling]
+        else:
+            dmg_level = cluster_level
+            hypo_clusters = [cell_type_name]
+            parent = self.child_to_parent[cell_type_name]
+            hyper_clusters = [ct for ct in self.parent_to_children_list[parent]
+                              if ct != cell_type_name]
+        return dmg_level, hypo_clusters, hyper_clusters
+
     def cluster_name_to_subtype(self, cluster_name):
         total_children = []
         if self.cluster_name_to_level[cluster_name] == 'SubType':
@@ -388,7 +1034,11 @@ class Dataset:
         else:
             raise ValueError(f'{region_name} missing in neither CCF or CEMBA region list')
 
-    @lru_cache()
+    @canonical_memo(maxsize=DMR_MEMORY_CACHE_SIZE,
+                    set_args=('cluster_of_interest', 'cluster_to_exclude'),
+                    logic_args={'coi_logic': 'cluster_of_interest', 'cte_logic': 'cluster_to_exclude'},
+                    copy=True,
+                    ignore_args=('n_jobs',))
     def query_dmr(self,
                   cluster_of_interest,
                   coi_logic='all',
@@ -397,69 +1047,98 @@ class Dataset:
                   number_of_dms=1,
                   reptile_cutoff=0.5,
                   delta_to_robust_mean=0.3,
-                  max_dmr_to_get_frac=500000):
+                  n_jobs=None):
+        """
+        Select DMRs by HypoHits logic, number of DMS, REPTILE score and the difference to robust mean.
+        n_jobs is the number of processes evaluating the score filters, default is DMR_QUERY_N_JOBS,
+        the process pool grows to the largest n_jobs requested.
+
+        Returns
+        -------
+        Sorted int32 positions of the selected DMRs along the id dim, use dmr_ds.isel(id=...)
+        """
+        if n_jobs is None:
+            n_jobs = DMR_QUERY_N_JOBS
         # turn logic into number
-        coi_logic_num = _logic_to_number(coi_logic, cluster_of_interest)
-        cte_logic_num = _logic_to_number(cte_logic, cluster_to_exclude)
+        coi_logic_num = logic_to_number(coi_logic, cluster_of_interest)
+        cte_logic_num = logic_to_number(cte_logic, cluster_to_exclude)
 
         cluster_of_interest = list(cluster_of_interest)
         if cluster_to_exclude is not None:
             cluster_to_exclude = list(cluster_to_exclude)
 
-        # cluster of interest
-        interest_hypo_hits = self.dmr_ds['HypoHits'].sel(Subtype=cluster_of_interest)
-        if len(cluster_of_interest) == 1:
-            coi_judge = interest_hypo_hits.squeeze()
-        else:
-            coi_judge = interest_hypo_hits.sum(dim='Subtype') >= coi_logic_num
-
-        # cluster to exclude
-        if (cluster_to_exclude is not None) and (len(cluster_to_exclude) > 0):
-            exclude_hypo_hits = self.dmr_ds['HypoHits'].sel(Subtype=cluster_to_exclude)
-            if len(cluster_to_exclude) == 1:
-                cte_judge = exclude_hypo_hits.squeeze()
-            else:
-                cte_judge = exclude_hypo_hits.sum(dim='Subtype') < cte_logic_num
-        else:
-            cte_judge = None
-
-        # number of DMS
-        dms_judge = self.dmr_ds['number_of_dms'] >= number_of_dms
-
-        # total judge before get floats matrix
-        if cte_judge is not None:
-            total_judge = coi_judge & cte_judge & dms_judge
+        token = self.dmr_query_token(cluster_of_interest, coi_logic, cluster_to_exclude, cte_logic,
+                                     number_of_dms, reptile_cutoff, delta_to_robust_mean)
+        cached = self.get_dmr_selection(token)
+        if cached is not None:
+            return cached
+
+        use_pos = self._query_dmr_pos(cluster_of_interest, coi_logic_num,
+                                      cluster_to_exclude, cte_logic_num,
+                                      number_of_dms, reptile_cutoff, delta_to_robust_mean, n_jobs)
+        use_pos = use_pos.astype(np.int32)
+        if self._dmr_cache is not None:
+            self._dmr_cache.set(token, {'pos': use_pos})
+        return use_pos
+
+    def dmr_query_token(self,
+                        cluster_of_interest,
+                        coi_logic='all',
+                        cluster_to_exclude=None,
+                        cte_logic='any',
+                        number_of_dms=1,
+                        reptile_cutoff=0.5,
+                        delta_to_robust_mean=0.3):
+        """
+        Short token of a query_dmr query, hash of the canonical parameters and the DMR file mtime,
+        cluster order and logic spelling do not matter, results of an older DMR file are not used.
+        """
+        if isinstance(cluster_of_interest, str):
+            cluster_of_interest = [cluster_of_interest]
+        if isinstance(cluster_to_exclude, str):
+            cluster_to_exclude = [cluster_to_exclude]
+        query = json.dumps({'coi': sorted(set(cluster_of_interest)),
+                            'coi_n': logic_to_number(coi_logic, cluster_of_interest),
+                            'cte': sorted(set(cluster_to_exclude)) if cluster_to_exclude else [],
+                            'cte_n': logic_to_number(cte_logic, cluster_to_exclude),
+                            'dms': float(number_of_dms),
+                            'reptile': float(reptile_cutoff),
+                            'delta': float(delta_to_robust_mean),
+                            'dmr_mtime': os.stat(DMR_DATASET).st_mtime})
+        return hashlib.sha1(query.encode()).hexdigest()[:16]
+
+    def get_dmr_selection(self, token):
+        """
+        Int32 DMR positions of a query_dmr token from the shared cache, any worker process can resolve it.
+        Return None if the token is unknown or evicted, run query_dmr again in that case.
+        """
+        if (token is None) or (self._dmr_cache is None):
+            return None
+        cached = self._dmr_cache.get(token)
+        if cached is None:
+            return None
+        return cached['pos']
+
+    def _query_dmr_pos(self, cluster_of_interest, coi_logic_num, cluster_to_exclude, cte_logic_num,
+                       number_of_dms, reptile_cutoff, delta_to_robust_mean, n_jobs):
+        # HypoHits and number of DMS filters on the bit-packed index, positions along the id dim
+        use_pos = self._dmr_index.query(cluster_of_interest, coi_logic_num,
+                                        cluster_to_exclude, cte_logic_num,
+                                        number_of_dms)
+        if use_pos.size == 0:
+            return use_pos
+
+        # REPTILE and robust mean filters, exact over all the candidates with bounded memory
+        if n_jobs > 1:
+            use_pos = filter_dmr_by_score_parallel(self._get_dmr_executor(n_jobs), DMR_DATASET, use_pos,
+                                                   cluster_of_interest, coi_logic_num,
+                                                   reptile_cutoff=reptile_cutoff,
+                                                   delta_to_robust_mean=delta_to_robust_mean,
+                                                   n_jobs=n_jobs,
+                                                   chunk_size=DMR_QUERY_CHUNK_SIZE)
         else:
-            total_judge = coi_judge & dms_judge
-        # use dmr
-        total_judge = total_judge.to_pandas().astype(bool)
-
-        if int(total_judge.sum()) == 0:
-            return pd.DataFrame([], columns=self.dmr_subtype)
-
-        # reptile
-        reptile_judge = (self.dmr_ds['REPTILE'].sel(
-            {'Subtype': cluster_of_interest, 'id': total_judge[total_judge].index}
-        ) > reptile_cutoff).sum(dim='Subtype') >= coi_logic_num
-        reptile_judge = reptile_judge.to_pandas().astype(bool)
-
-        # agg reptile judge
-        total_judge = total_judge & reptile_judge
-        if int(total_judge.sum()) == 0:
-            return pd.DataFrame([], columns=self.dmr_subtype)
-        use_dmr = total_judge[total_judge]
-
-        # downsample to extract fraction
-        if use_dmr.size > max_dmr_to_get_frac:
-            print(f'Downsample DMR to {max_dmr_to_get_frac}...')
-            use_dmr = use_dmr.sample(max_dmr_to_get_frac, random_state=0)
-        use_dmr = use_dmr.index
-
-        # get dmr frac
-        dmr_frac = self.dmr_ds['mCGFrac'].sel({'id': use_dmr})
-        robust_mean = self.dmr_ds['mCGFracRobustMean'].sel({'id': use_dmr})
-        robust_mean_judge = ((robust_mean - dmr_frac.sel({'Subtype': cluster_of_interest})) > delta_to_robust_mean).sum(
-            dim='Subtype') >= coi_logic_num
-        use_dmr = robust_mean_judge.to_pandas().astype(bool)
-        use_dmr = use_dmr[use_dmr].index.tolist()
-        return use_dmr
+            use_pos = filter_dmr_by_score(self.dmr_ds, use_pos, cluster_of_interest, coi_logic_num,
+                                          reptile_cutoff=reptile_cutoff,
+                                          delta_to_robust_mean=delta_to_robust_mean,
+                                          chunk_size=DMR_QUERY_CHUNK_SIZE)
+        return use_pos
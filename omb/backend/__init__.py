@@ -1,4 +1,7 @@
+import multiprocessing
+
 from .Dataset import Dataset
 from .ingest import *
 
-dataset = Dataset()
+# worker processes spawned by Dataset (e.g. query_dmr) import this package too, they never use the resources
+dataset = Dataset(lazy=LAZY_DATASET or (multiprocessing.parent_process() is not None))
@@ -0,0 +1,161 @@
+"""
+Cache shared by all the worker processes of a deployment
+
+The lru_cache on Dataset methods is per-process, with N WSGI workers every worker pays the same cache miss
+and hold its own copy. The caches here save numpy arrays into a local dir instead, so one worker's miss warms
+all the other workers. All writes are atomic (write to a temp file then rename), eviction is size-based
+and removes the least recently used items first.
+
+To add a new backend, subclass ArrayCache and implement _read, _write and _evict.
+"""
+import hashlib
+import os
+import pathlib
+import tempfile
+import time
+
+import numpy as np
+
+
+class ArrayCache:
+    """Base class of the shared caches, a key map to a dict of numpy arrays"""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def _read(self, key):
+        raise NotImplementedError
+
+    def _write(self, key, arrays):
+        raise NotImplementedError
+
+    def _evict(self):
+        raise NotImplementedError
+
+    def get(self, key):
+        """Return the dict of arrays saved under key, or None if key not in cache"""
+        arrays = self._read(key)
+        if arrays is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return arrays
+
+    def set(self, key, arrays):
+        self._write(key, arrays)
+        self._evict()
+        return
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / total if total > 0 else 0.}
+
+
+class DiskArrayCache(ArrayCache):
+    def __init__(self, cache_dir, max_bytes=2 * 1024 ** 3, compress=False, rescan_interval=60):
+        """
+        Parameters
+        ----------
+        cache_dir
+            Local dir of the cache, all processes use the same dir share the cache
+        max_bytes
+            Total size limit of the cache dir, least recently used items are removed when exceeded
+        compress
+            Whether save arrays with np.savez_compressed
+        rescan_interval
+            Seconds between scans of the cache dir, the total size is tracked from the writes of this process
+            between scans, so writes of other processes are counted by the next scan
+        """
+        super().__init__()
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.cache_dir.mkdir(exist_ok=True, parents=True)
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.rescan_interval = rescan_interval
+        self._scan()
+
+    def _scan(self):
+        """mtime, size and path of all items, also reset the tracked total size"""
+        records = []
+        for path in self.cache_dir.glob('*.npz'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                # removed by other process
+                continue
+            records.append((stat.st_mtime, stat.st_size, path))
+        self._total_bytes = sum(record[1] for record in records)
+        self._last_scan = time.time()
+        return records
+
+    def _key_to_path(self, key):
+        name = hashlib.sha1(str(key).encode()).hexdigest()
+        return self.cache_dir / f'{name}.npz'
+
+    def _read(self, key):
+        path = self._key_to_path(key)
+        try:
+            with np.load(path) as f:
+                arrays = {k: f[k] for k in f.files}
+            # mtime is used as the last access time for eviction
+            os.utime(path)
+        except (FileNotFoundError, OSError, ValueError):
+            # not exist, or removed by other process during reading
+            return None
+        return arrays
+
+    def _write(self, key, arrays):
+        path = self._key_to_path(key)
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                if self.compress:
+                    np.savez_compressed(f, **arrays)
+                else:
+                    np.savez(f, **arrays)
+                size = f.tell()
+            # atomic, other processes either see the old file or the complete new file
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self._total_bytes += size
+        return
+
+    def _evict(self):
+        if (self._total_bytes <= self.max_bytes) and (time.time() - self._last_scan < self.rescan_interval):
+            return
+        records = self._scan()
+        if self._total_bytes <= self.max_bytes:
+            return
+
+        # remove least recently used items until 90% of the limit, so eviction do not happen on every write
+        for _, size, path in sorted(records, key=lambda i: i[0]):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            self._total_bytes -= size
+            if self._total_bytes <= self.max_bytes * 0.9:
+                break
+        return
+
+    def stats(self):
+        stats = super().stats()
+        records = self._scan()
+        stats['n_items'] = len(records)
+        stats['total_bytes'] = self._total_bytes
+        return stats
+
+    def clear(self):
+        for path in self.cache_dir.glob('*.npz'):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+        self._total_bytes = 0
+        return
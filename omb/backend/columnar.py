@@ -0,0 +1,115 @@
+"""
+Columnar (feather) copy of the coords and variables tables, used by Dataset when pyarrow is installed
+
+Variables.h5 is a PyTables table, reading it decode every column of every cell at startup.
+Feather files are saved uncompressed, so they are memory-mapped and only the columns used by the callbacks
+are read. The HDF files are still written by ingest and used when pyarrow is not installed.
+
+Layout
+- Variables.feather: one column per variable, categorical variables are arrow dictionary columns,
+  the cell int index is the INDEX_COLUMN column
+- Coords/{coord_name}.feather: x, y (z) columns and the INDEX_COLUMN column
+- Variables.source.json and Coords/source.json: mtime and size of the HDF the copy is made from, and the HDF keys
+  that have a copy, written by ingest after the HDF is closed. A copy that do not match its HDF is not used.
+"""
+import json
+import os
+import pathlib
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:
+    pa = None
+    feather = None
+
+HAS_PYARROW = feather is not None
+INDEX_COLUMN = '_cell'
+
+
+def write_frame(df, path):
+    """Save a cell indexed dataframe as uncompressed feather, so it can be memory-mapped"""
+    if not HAS_PYARROW:
+        raise ImportError('pyarrow is required to write feather files, install omb[columnar]')
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.append_column(INDEX_COLUMN, pa.array(df.index.values))
+    path = pathlib.Path(path)
+    path.parent.mkdir(exist_ok=True, parents=True)
+    temp_path = path.parent / f'{path.name}.temp'
+    feather.write_feather(table, temp_path, compression='uncompressed')
+    temp_path.replace(path)
+    return
+
+
+def _source_path(columnar_path):
+    columnar_path = pathlib.Path(columnar_path)
+    if columnar_path.suffix == '.feather':
+        return columnar_path.parent / f'{columnar_path.stem}.source.json'
+    return columnar_path / 'source.json'
+
+
+def _hdf_signature(hdf_path):
+    stat = os.stat(hdf_path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def write_source(columnar_path, hdf_path, keys):
+    """Record the HDF and its keys the columnar copy is made from, call after the HDF is closed"""
+    source = {'hdf': _hdf_signature(hdf_path), 'keys': list(keys)}
+    with open(_source_path(columnar_path), 'w') as f:
+        json.dump(source, f)
+    return
+
+
+def read_source(columnar_path, hdf_path):
+    """
+    HDF keys that have an up to date columnar copy,
+    None if pyarrow is not installed, the copy not exist or the HDF is changed after the copy is made
+    """
+    source_path = _source_path(columnar_path)
+    if (not HAS_PYARROW) or (not source_path.exists()):
+        return None
+    with open(source_path) as f:
+        source = json.load(f)
+    if pathlib.Path(hdf_path).exists() and (_hdf_signature(hdf_path) != source['hdf']):
+        # HDF is updated by an ingest without pyarrow
+        return None
+    return source['keys']
+
+
+def read_frame(path, columns=None):
+    """Read columns of a feather file saved by write_frame, None for all columns"""
+    if columns is not None:
+        columns = list(columns) + [INDEX_COLUMN]
+    df = feather.read_table(path, columns=columns, memory_map=True).to_pandas()
+    index = pd.Index(df.pop(INDEX_COLUMN), name='cell')
+    df.index = index
+    return df
+
+
+class ColumnarFrame:
+    """Column-selective reader of a feather file saved by write_frame"""
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        # schema only, no column is read here
+        with pa.memory_map(str(self.path)) as source:
+            schema = pa.ipc.open_file(source).schema
+        self.columns = [name for name in schema.names if name != INDEX_COLUMN]
+        self.categorical_columns = [field.name for field in schema
+                                    if pa.types.is_dictionary(field.type)]
+        self._index = None
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = read_frame(self.path, columns=[]).index
+        return self._index
+
+    def read_columns(self, columns):
+        """Dataframe of the columns, the index is shared by all reads"""
+        df = feather.read_table(self.path, columns=list(columns), memory_map=True).to_pandas()
+        df.index = self.index
+        return df
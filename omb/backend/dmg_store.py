@@ -0,0 +1,210 @@
+"""
+Pairwise DMG store, the on-disk layout used by Dataset.query_dmg for ranking genes
+
+The pairwise DMG HDF keep one AUROC Series per "{a} vs {b}" cluster pair, query_dmg had to read and align
+one Series per selected pair. The pairwise DMG store save all pairs in one dense matrix instead,
+rows are pairs and columns are genes, genes not in a pair's DMG list are 0. The matrix is memory-mapped,
+so ranking genes for any number of pairs is one weighted sum of the selected rows.
+
+Store dir layout
+- AUROC.npy: float32 matrix, shape (n_pairs, n_genes)
+- pairs.npy: str array, shape (n_pairs, 2), the (a, b) cluster pair of each matrix row
+- genes.npy: gene int of each matrix column
+
+The default DMG file keep the ranked genes of the default comparison of each cell type, see precompute.py.
+It is one npz, the ranked gene ints of all comparisons are concatenated in "genes" and split by "offsets".
+The paths and mtimes of the DMG files it was ranked from are kept in "source_paths" and "source_mtimes",
+the file is stale and ignored once any of them changed.
+"""
+import pathlib
+
+import numpy as np
+import pandas as pd
+
+DMG_DTYPE = np.float32
+# number of pair rows read into memory at a time by weighted_sum, 256 rows of 50k genes is ~50MB
+DMG_ROW_BLOCK = 256
+
+
+def _matrix_path(store_dir):
+    return pathlib.Path(store_dir) / 'AUROC.npy'
+
+
+def dmg_store_exists(store_dir):
+    store_dir = pathlib.Path(store_dir)
+    for name in ['AUROC.npy', 'pairs.npy', 'genes.npy']:
+        if not (store_dir / name).exists():
+            return False
+    return True
+
+
+class PairwiseDMGStore:
+    def __init__(self, store_dir):
+        self.store_dir = pathlib.Path(store_dir)
+        self.genes = pd.Index(np.load(self.store_dir / 'genes.npy'), name='gene')
+        pairs = np.load(self.store_dir / 'pairs.npy')
+        self.pair_to_row = {(a, b): i for i, (a, b) in enumerate(pairs)}
+        self.matrix = np.load(_matrix_path(self.store_dir), mmap_mode='r')
+
+    def weighted_sum(self, pair_weights):
+        """
+        Sum of the pair AUROC weighted by pair_weights
+
+        Parameters
+        ----------
+        pair_weights
+            Dict, key is (a, b) cluster pair, value is the weight, pairs not in the store are skipped
+
+        Returns
+        -------
+        pd.Series of all genes
+        """
+        rows, weights = [], []
+        for pair, weight in pair_weights.items():
+            try:
+                rows.append(self.pair_to_row[pair])
+                weights.append(weight)
+            except KeyError:
+                pass
+        rows = np.array(rows, dtype=np.int64)
+        weights = np.array(weights, dtype=DMG_DTYPE)
+        order = np.argsort(rows)
+        rows = rows[order]
+        weights = weights[order]
+        # sorted read is more sequential on disk, rows are read in blocks so the peak memory
+        # do not grow with the number of selected pairs
+        score = np.zeros(self.genes.size, dtype=DMG_DTYPE)
+        for start in range(0, rows.size, DMG_ROW_BLOCK):
+            block_rows = rows[start:start + DMG_ROW_BLOCK]
+            if block_rows[-1] - block_rows[0] + 1 == block_rows.size:
+                # contiguous rows, slice the memory-mapped matrix without copy
+                block = self.matrix[block_rows[0]:block_rows[-1] + 1]
+            else:
+                block = self.matrix[block_rows]
+            score += weights[start:start + DMG_ROW_BLOCK] @ block
+        return pd.Series(score, index=self.genes)
+
+
+def build_dmg_store(hdf_path, store_dir):
+    """
+    Convert the pairwise DMG HDF into the pairwise DMG store
+
+    Parameters
+    ----------
+    hdf_path
+        Pairwise DMG HDF, each key is "{a} vs {b}" and the value is the AUROC Series indexed by gene int
+    store_dir
+        Output dir of the pairwise DMG store
+
+    Returns
+    -------
+    PairwiseDMGStore
+    """
+    store_dir = pathlib.Path(store_dir)
+    store_dir.mkdir(exist_ok=True, parents=True)
+    # remove index of the old store first, so an interrupted build is not recognized as a store
+    for name in ['pairs.npy', 'genes.npy']:
+        if (store_dir / name).exists():
+            (store_dir / name).unlink()
+
+    with pd.HDFStore(hdf_path, 'r') as hdf:
+        keys = [key.lstrip('/') for key in hdf.keys()]
+        genes = set()
+        for key in keys:
+            genes |= set(hdf[key].index)
+        genes = pd.Index(sorted(genes), name='gene')
+        pairs = np.array([key.split(' vs ') for key in keys], dtype=str)
+
+        print(f'Building pairwise DMG store for {len(keys)} pairs and {genes.size} genes from {hdf_path}')
+        matrix = np.lib.format.open_memmap(_matrix_path(store_dir),
+                                           mode='w+',
+                                           dtype=DMG_DTYPE,
+                                           shape=(len(keys), genes.size))
+        for row, key in enumerate(keys):
+            auroc = hdf[key]
+            matrix[row] = 0
+            matrix[row, genes.get_indexer(auroc.index)] = auroc.values.astype(DMG_DTYPE)
+        matrix.flush()
+        del matrix
+
+    # index written last
+    np.save(store_dir / 'pairs.npy', pairs)
+    np.save(store_dir / 'genes.npy', genes.values)
+    return PairwiseDMGStore(store_dir)
+
+
+def default_dmg_key(hypo_clusters, hyper_clusters, cluster_level, protein_coding):
+    """Key of a DMG comparison, cluster order do not matter"""
+    return tuple(sorted(hypo_clusters)), tuple(sorted(hyper_clusters)), cluster_level, bool(protein_coding)
+
+
+def dmg_source_mtimes(source_paths):
+    """mtime_ns of the DMG source files, -1 for missing files"""
+    mtimes = []
+    for path in source_paths:
+        path = pathlib.Path(path)
+        mtimes.append(path.stat().st_mtime_ns if path.exists() else -1)
+    return np.array(mtimes, dtype=np.int64)
+
+
+def save_default_dmg(path, tables, top_n, source_paths=()):
+    """
+    Save ranked DMG genes of the default comparisons
+
+    Parameters
+    ----------
+    path
+        Output npz path
+    tables
+        Dict, key is default_dmg_key, value is the ranked gene ints, at most top_n genes
+    top_n
+        Number of genes ranked for each comparison
+    source_paths
+        DMG files the tables are ranked from, their current mtimes are saved for default_dmg_is_fresh
+    """
+    source_paths = [str(p) for p in source_paths]
+    keys = list(tables.keys())
+    genes = [np.asarray(tables[key], dtype=np.int32) for key in keys]
+    path = pathlib.Path(path)
+    temp_path = path.parent / f'{path.stem}.temp.npz'
+    np.savez(temp_path,
+             hypo=np.array(['|'.join(key[0]) for key in keys], dtype=str),
+             hyper=np.array(['|'.join(key[1]) for key in keys], dtype=str),
+             level=np.array([key[2] for key in keys], dtype=str),
+             protein_coding=np.array([key[3] for key in keys], dtype=bool),
+             offsets=np.cumsum([0] + [g.size for g in genes]),
+             genes=np.concatenate(genes) if len(genes) > 0 else np.array([], dtype=np.int32),
+             top_n=top_n,
+             source_paths=np.array(source_paths, dtype=str),
+             source_mtimes=dmg_source_mtimes(source_paths))
+    temp_path.replace(path)
+    return
+
+
+def default_dmg_is_fresh(path, source_paths):
+    """
+    Whether the default DMG file is ranked from the current DMG files,
+    False if the source paths or any source mtime differ, or the file has no source record.
+    """
+    source_paths = [str(p) for p in source_paths]
+    with np.load(path) as f:
+        if 'source_paths' not in f.files:
+            return False
+        if [str(p) for p in f['source_paths']] != source_paths:
+            return False
+        return bool(np.array_equal(f['source_mtimes'], dmg_source_mtimes(source_paths)))
+
+
+def load_default_dmg(path):
+    """Load the default DMG file, return the tables dict same as save_default_dmg and top_n"""
+    with np.load(path) as f:
+        offsets = f['offsets']
+        genes = f['genes']
+        tables = {}
+        for i, (hypo, hyper, level, protein_coding) in enumerate(
+                zip(f['hypo'], f['hyper'], f['level'], f['protein_coding'])):
+            key = default_dmg_key([c for c in str(hypo).split('|') if c],
+                                  [c for c in str(hyper).split('|') if c],
+                                  str(level), protein_coding)
+            tables[key] = genes[offsets[i]:offsets[i + 1]]
+        return tables, int(f['top_n'])
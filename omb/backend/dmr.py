@@ -0,0 +1,304 @@
+"""
+Bit-packed inverted index of the DMR dataset, used by Dataset.query_dmr
+
+HypoHits is a DMR id by Subtype boolean matrix. Counting hits of the selected subtypes for every new query
+scans the whole matrix. The index keep one packed bitset of DMR positions per subtype instead
+(np.packbits, 1 bit per DMR), so the "all / any / N of" logic of a query is a few AND / OR operations
+on the selected rows. number_of_dms is kept sorted, so the DMS cutoff is a binary search.
+
+Index file layout (npz)
+- hypo_bits: uint8 matrix, shape (n_subtype, ceil(n_dmr / 8)), row i is the packed HypoHits of subtypes[i]
+- subtypes: subtype names of the rows
+- dms_order: DMR positions sorted by number_of_dms
+- dms_sorted: sorted number_of_dms
+"""
+import os
+import pathlib
+import tempfile
+from multiprocessing.util import Finalize
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+
+class DMRIndex:
+    def __init__(self, hypo_bits, subtypes, dms_order, dms_sorted):
+        self.hypo_bits = hypo_bits
+        self.subtypes = pd.Index(subtypes, name='Subtype')
+        self.dms_order = dms_order
+        self.dms_sorted = dms_sorted
+        self.n_dmr = dms_order.size
+
+    @classmethod
+    def from_dataset(cls, dmr_ds, chunk_size=16):
+        """Build the index from the DMR dataset, HypoHits is read chunk_size subtypes at a time"""
+        hypo_hits = dmr_ds['HypoHits'].transpose('Subtype', 'id')
+        subtypes = dmr_ds.get_index('Subtype')
+        n_dmr = hypo_hits.shape[1]
+        hypo_bits = np.zeros((subtypes.size, (n_dmr + 7) // 8), dtype=np.uint8)
+        for start in range(0, subtypes.size, chunk_size):
+            chunk = hypo_hits[start:start + chunk_size].values > 0
+            hypo_bits[start:start + chunk_size] = np.packbits(chunk, axis=1)
+
+        dms = dmr_ds['number_of_dms'].values
+        dms_order = np.argsort(dms, kind='stable')
+        return cls(hypo_bits, subtypes.values, dms_order, dms[dms_order])
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f['hypo_bits'], f['subtypes'], f['dms_order'], f['dms_sorted'])
+
+    def save(self, path):
+        path = pathlib.Path(path)
+        # unique temp file, other processes may save the same index at the same time
+        fd, temp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f,
+                         hypo_bits=self.hypo_bits,
+                         subtypes=np.array(self.subtypes, dtype=str),
+                         dms_order=self.dms_order,
+                         dms_sorted=self.dms_sorted)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return
+
+    def _ones(self):
+        return np.packbits(np.ones(self.n_dmr, dtype=bool))
+
+    def _rows(self, subtypes):
+        rows = self.subtypes.get_indexer(subtypes)
+        if (rows == -1).any():
+            missing = pd.Index(subtypes)[rows == -1]
+            raise KeyError(f'Subtype not found in DMR dataset: {missing.tolist()}')
+        return self.hypo_bits[rows]
+
+    def hypo_at_least(self, subtypes, n):
+        """Packed bitset of DMRs that are hypo-methylated in at least n of the subtypes"""
+        rows = self._rows(subtypes)
+        n = min(n, rows.shape[0])
+        if n <= 0:
+            return self._ones()
+        elif n == 1:
+            return np.bitwise_or.reduce(rows, axis=0)
+        elif n == rows.shape[0]:
+            return np.bitwise_and.reduce(rows, axis=0)
+        else:
+            # counting with bitsets, at_least[k] is the set of DMRs hit in >= k of the rows seen so far
+            at_least = [self._ones()] + [np.zeros_like(rows[0]) for _ in range(n)]
+            for row in rows:
+                for k in range(n, 0, -1):
+                    at_least[k] |= at_least[k - 1] & row
+            return at_least[n]
+
+    def dms_at_least(self, n):
+        """Packed bitset of DMRs that have at least n DMS"""
+        judge = np.zeros(self.n_dmr, dtype=bool)
+        judge[self.dms_order[np.searchsorted(self.dms_sorted, n, side='left'):]] = True
+        return np.packbits(judge)
+
+    def query(self, cluster_of_interest, coi_n, cluster_to_exclude=None, cte_n=1, number_of_dms=1):
+        """
+        DMR positions pass the HypoHits and number_of_dms filters
+
+        Parameters
+        ----------
+        cluster_of_interest
+            Subtypes of interest, DMR need to be hypo in at least coi_n of them
+        coi_n
+            Number of hits in cluster_of_interest
+        cluster_to_exclude
+            Subtypes to exclude, DMR is removed if it is hypo in at least cte_n of them
+        cte_n
+            Number of hits in cluster_to_exclude
+        number_of_dms
+            Min number of DMS
+
+        Returns
+        -------
+        Sorted integer positions along the DMR id dim
+        """
+        bits = self.hypo_at_least(cluster_of_interest, coi_n) & self.dms_at_least(number_of_dms)
+        if (cluster_to_exclude is not None) and (len(cluster_to_exclude) > 0):
+            bits &= ~self.hypo_at_least(cluster_to_exclude, cte_n)
+        return np.flatnonzero(np.unpackbits(bits, count=self.n_dmr))
+
+
+def build_dmr_index(dmr_path):
+    with xr.open_dataset(dmr_path) as ds:
+        return DMRIndex.from_dataset(ds)
+
+
+def load_dmr_index(dmr_path, index_path, fallback_dir=None):
+    """
+    Load the DMR index from index_path or fallback_dir, whichever is newer than the DMR dataset.
+
+    The index is made by precompute.py, if no index is up to date, it is built here and saved to index_path,
+    or to fallback_dir if index_path is not writable (e.g. the package data dir of a deployed server).
+    """
+    dmr_path = pathlib.Path(dmr_path)
+    index_path = pathlib.Path(index_path)
+    paths = [index_path]
+    if fallback_dir is not None:
+        paths.append(pathlib.Path(fallback_dir) / index_path.name)
+    for path in paths:
+        if path.exists() and path.stat().st_mtime >= dmr_path.stat().st_mtime:
+            return DMRIndex.load(path)
+
+    print(f'Building DMR index from {dmr_path}')
+    index = build_dmr_index(dmr_path)
+    for path in paths:
+        try:
+            path.parent.mkdir(exist_ok=True, parents=True)
+            index.save(path)
+            break
+        except OSError as e:
+            print(f'Can not save DMR index to {path}: {e}')
+    return index
+
+
+def filter_dmr_by_score(dmr_ds, positions, cluster_of_interest, n_hits,
+                        reptile_cutoff, delta_to_robust_mean, chunk_size=100000):
+    """
+    Apply the REPTILE and robust mean filters to DMR positions, walking the id dim in fixed-size blocks.
+
+    Each block is one contiguous read of the cluster_of_interest columns, so the peak memory is bounded by
+    chunk_size * len(cluster_of_interest) no matter how many DMRs pass the index filters.
+
+    Parameters
+    ----------
+    dmr_ds
+        DMR dataset
+    positions
+        Sorted integer positions along the id dim, usually from DMRIndex.query
+    cluster_of_interest
+        Subtypes of interest
+    n_hits
+        DMR need to pass both cutoffs in at least n_hits of cluster_of_interest
+    reptile_cutoff
+        REPTILE score > reptile_cutoff
+    delta_to_robust_mean
+        mCGFracRobustMean - mCGFrac > delta_to_robust_mean
+    chunk_size
+        Number of DMR ids in each block
+
+    Returns
+    -------
+    Sorted integer positions pass both filters
+    """
+    subtype_pos = dmr_ds.get_index('Subtype').get_indexer(cluster_of_interest)
+    n_dmr = dmr_ds.sizes['id']
+    keep = []
+    for start in range(0, n_dmr, chunk_size):
+        # positions inside this block, relative to the block start
+        lo, hi = np.searchsorted(positions, [start, start + chunk_size])
+        if lo == hi:
+            continue
+        rel_pos = positions[lo:hi] - start
+        block = {'id': slice(start, start + chunk_size)}
+
+        reptile = dmr_ds['REPTILE'].isel(block).isel(Subtype=subtype_pos).transpose('id', 'Subtype').values
+        judge = (reptile[rel_pos] > reptile_cutoff).sum(axis=1) >= n_hits
+        rel_pos = rel_pos[judge]
+        if rel_pos.size == 0:
+            continue
+
+        frac = dmr_ds['mCGFrac'].isel(block).isel(Subtype=subtype_pos).transpose('id', 'Subtype').values
+        robust_mean = dmr_ds['mCGFracRobustMean'].isel(block)
+        if 'Subtype' in robust_mean.dims:
+            robust_mean = robust_mean.isel(Subtype=subtype_pos).transpose('id', 'Subtype').values
+        else:
+            robust_mean = robust_mean.values[:, None]
+        judge = ((robust_mean[rel_pos] - frac[rel_pos]) > delta_to_robust_mean).sum(axis=1) >= n_hits
+        keep.append(rel_pos[judge] + start)
+    if len(keep) == 0:
+        return np.array([], dtype=np.int64)
+    return np.concatenate(keep)
+
+
+def bin_codes(values, bins):
+    """
+    uint8 code of the right-closed bin (bins[i], bins[i + 1]] each value fall in, same as pd.cut(values, bins).codes.
+    Values out of the bins get code 255.
+    """
+    if len(bins) > 256:
+        raise ValueError(f'At most 255 bins can be coded in uint8, got {len(bins) - 1}')
+    codes = np.searchsorted(np.asarray(bins), values, side='left') - 1
+    codes[(codes < 0) | (codes >= len(bins) - 1)] = 255
+    return codes.astype(np.uint8)
+
+
+def count_bin_codes(codes, n_bins):
+    """Number of values in each bin from the bin_codes, out of bin codes are dropped"""
+    return np.bincount(codes, minlength=n_bins)[:n_bins]
+
+
+# DMR dataset opened in each worker process, key is path
+_worker_datasets = {}
+
+
+def init_dmr_worker(dmr_path):
+    """
+    Initializer of the filter_dmr_by_score_parallel worker processes, open dmr_path read-only once,
+    the handle is kept for the following queries and closed when the worker exit
+    """
+    dmr_path = str(dmr_path)
+    if dmr_path not in _worker_datasets:
+        dmr_ds = xr.open_dataset(dmr_path)
+        _worker_datasets[dmr_path] = dmr_ds
+        # multiprocessing workers do not run atexit, finalizers with exitpriority are run on exit
+        Finalize(dmr_ds, dmr_ds.close, exitpriority=10)
+    return _worker_datasets[dmr_path]
+
+
+def _filter_partition(dmr_path, positions, cluster_of_interest, n_hits,
+                      reptile_cutoff, delta_to_robust_mean, chunk_size):
+    dmr_ds = init_dmr_worker(dmr_path)
+    return filter_dmr_by_score(dmr_ds, positions, cluster_of_interest, n_hits,
+                               reptile_cutoff=reptile_cutoff,
+                               delta_to_robust_mean=delta_to_robust_mean,
+                               chunk_size=chunk_size)
+
+
+def _partition_positions(positions, n_parts, chunk_size):
+    """Split sorted positions into about equal parts, split points are aligned to the id blocks"""
+    if n_parts <= 1 or positions.size == 0:
+        return [positions]
+    targets = positions[np.linspace(0, positions.size, n_parts + 1)[1:-1].astype(int)]
+    cuts = np.unique(np.searchsorted(positions, targets // chunk_size * chunk_size))
+    return [part for part in np.split(positions, cuts) if part.size > 0]
+
+
+def filter_dmr_by_score_parallel(executor, dmr_path, positions, cluster_of_interest, n_hits,
+                                 reptile_cutoff, delta_to_robust_mean, n_jobs, chunk_size=100000):
+    """
+    Same as filter_dmr_by_score, the id axis is partitioned into n_jobs parts evaluated by a process pool.
+
+    Parameters
+    ----------
+    executor
+        concurrent.futures.ProcessPoolExecutor, use init_dmr_worker as the initializer to open dmr_path once
+    dmr_path
+        Path of the DMR dataset
+    n_jobs
+        Number of partitions
+
+    Other parameters are the same as filter_dmr_by_score
+
+    Returns
+    -------
+    Sorted integer positions pass both filters
+    """
+    futures = [executor.submit(_filter_partition, str(dmr_path), part, list(cluster_of_interest), n_hits,
+                               reptile_cutoff, delta_to_robust_mean, chunk_size)
+               for part in _partition_positions(positions, n_jobs, chunk_size)]
+    # partitions are in id order, so the merged hits stay sorted
+    hits = [future.result() for future in futures]
+    if len(hits) == 0:
+        return np.array([], dtype=np.int64)
+    return np.concatenate(hits)
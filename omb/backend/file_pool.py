@@ -0,0 +1,127 @@
+"""
+Bounded pool of opened xarray datasets, so consecutive reads from the same netCDF file
+do not pay the file open and metadata decode again, and the number of open files stays bounded.
+"""
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import xarray as xr
+
+# xarray lock netCDF data reads but not all the metadata decode of open_dataset,
+# so files are opened and closed one at a time, this do not block reads of the opened files
+_OPEN_CLOSE_LOCK = threading.Lock()
+
+
+class _Handle:
+    def __init__(self):
+        self.ds = None
+        # a file is opened, read and closed under its own lock, so there is never two open dataset
+        # of the same file in the process (netCDF4 may crash on that) and a file is not closed while being read
+        self.lock = threading.Lock()
+        # number of threads using or closing this handle, handles with users are never evicted
+        self.n_users = 0
+
+
+class DatasetHandlePool:
+    def __init__(self, max_open=16, **open_kws):
+        """
+        Parameters
+        ----------
+        max_open
+            Max number of opened files, least recently used idle file is closed when exceeded.
+            Files being read are not closed, so more files can be open while all of them are in use.
+        open_kws
+            Passed to xr.open_dataset
+        """
+        self.max_open = max_open
+        self._open_kws = open_kws
+        # key is path, value is _Handle, in the order of last use
+        self._handles = OrderedDict()
+        # pool lock only protect the handle dict and user counts, it is never held while a file is
+        # opened, read or closed, so different files can be opened and read in parallel
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _checkout(self, path):
+        """Get the handle of path and count the user, call without the pool lock"""
+        with self._lock:
+            handle = self._handles.get(path)
+            if handle is None:
+                handle = _Handle()
+                self._handles[path] = handle
+            else:
+                self._handles.move_to_end(path)
+            handle.n_users += 1
+
+            # handles in use count as open, they are opened or going to be opened
+            n_open = sum((h.ds is not None) or (h.n_users > 0) for h in self._handles.values())
+            to_close = []
+            for old_path, old_handle in self._handles.items():
+                if n_open <= self.max_open:
+                    break
+                if (old_handle.ds is not None) and (old_handle.n_users == 0):
+                    old_handle.n_users += 1
+                    to_close.append((old_path, old_handle))
+                    n_open -= 1
+        self._close_handles(to_close)
+        return handle
+
+    def _checkin(self, path, handle):
+        with self._lock:
+            handle.n_users -= 1
+            if (handle.n_users == 0) and (handle.ds is None) and (self._handles.get(path) is handle):
+                # closed and not used, a later open create a new handle
+                del self._handles[path]
+        return
+
+    def _close_handles(self, handles):
+        """Close (path, handle) pairs already counted as used by the caller, wait for the current reader"""
+        for path, handle in handles:
+            with handle.lock:
+                if handle.ds is not None:
+                    with _OPEN_CLOSE_LOCK:
+                        handle.ds.close()
+                    handle.ds = None
+            self._checkin(path, handle)
+        return
+
+    @contextmanager
+    def open(self, path):
+        """Context manager yield the opened dataset of path, do not keep the dataset after the block"""
+        path = str(path)
+        handle = self._checkout(path)
+        try:
+            with handle.lock:
+                if handle.ds is None:
+                    with _OPEN_CLOSE_LOCK:
+                        handle.ds = xr.open_dataset(path, **self._open_kws)
+                    self.misses += 1
+                else:
+                    self.hits += 1
+                yield handle.ds
+        finally:
+            self._checkin(path, handle)
+
+    def close(self, path):
+        path = str(path)
+        with self._lock:
+            handle = self._handles.get(path)
+            if handle is None:
+                return
+            handle.n_users += 1
+        self._close_handles([(path, handle)])
+        return
+
+    def close_all(self):
+        with self._lock:
+            handles = list(self._handles.items())
+            for _, handle in handles:
+                handle.n_users += 1
+        self._close_handles(handles)
+        return
+
+    def __len__(self):
+        """Number of opened files"""
+        return sum(h.ds is not None for h in list(self._handles.values()))
@@ -0,0 +1,139 @@
+"""
+Gene rate store, the on-disk layout used by Dataset.get_gene_rate for fast single gene lookup
+
+MCDS chunks are netCDF files, reading one gene for 100k cells takes ~250ms because of file open,
+metadata decode and netCDF slicing. The gene rate store save one contiguous matrix per mc_type instead,
+rows are genes and columns are cells, so one gene is one contiguous row in the file.
+The matrix is memory-mapped, so getting a gene is a zero-copy row slice, the OS page cache do the rest.
+
+Store dir layout
+- GeneRate.{mc_type}.npy: float16 matrix, shape (n_genes, n_cells)
+- genes.npy: gene int of each matrix row
+- cells.npy: cell int of each matrix column
+"""
+import pathlib
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+GENE_RATE_DTYPE = np.float16
+
+
+def _matrix_path(store_dir, mc_type):
+    return pathlib.Path(store_dir) / f'GeneRate.{mc_type}.npy'
+
+
+def gene_rate_store_exists(store_dir):
+    store_dir = pathlib.Path(store_dir)
+    if not (store_dir / 'genes.npy').exists():
+        return False
+    if not (store_dir / 'cells.npy').exists():
+        return False
+    return len(list(store_dir.glob('GeneRate.*.npy'))) > 0
+
+
+def invalidate_gene_rate_store(store_dir):
+    """Remove the index of a store, so it is not recognized as a store until it is rebuilt"""
+    store_dir = pathlib.Path(store_dir)
+    for name in ['genes.npy', 'cells.npy']:
+        if (store_dir / name).exists():
+            (store_dir / name).unlink()
+    return
+
+
+class GeneRateStore:
+    def __init__(self, store_dir):
+        self.store_dir = pathlib.Path(store_dir)
+        self.genes = pd.Index(np.load(self.store_dir / 'genes.npy'), name='gene')
+        self.cells = pd.Index(np.load(self.store_dir / 'cells.npy'), name='cell')
+        self.mc_types = [p.name.split('.')[1] for p in self.store_dir.glob('GeneRate.*.npy')]
+        # key is mc_type, value is the memory-mapped matrix, open on first use
+        self._matrix = {}
+
+    def _get_matrix(self, mc_type):
+        try:
+            return self._matrix[mc_type]
+        except KeyError:
+            matrix = np.load(_matrix_path(self.store_dir, mc_type), mmap_mode='r')
+            self._matrix[mc_type] = matrix
+            return matrix
+
+    def has_gene(self, gene_int, mc_type):
+        return (mc_type in self.mc_types) and (gene_int in self.genes)
+
+    def get_gene_rate(self, gene_int, mc_type):
+        """Return gene rate series of all cells, values is a read-only view of the memory-mapped row"""
+        row = self.genes.get_loc(gene_int)
+        values = self._get_matrix(mc_type)[row]
+        return pd.Series(values, index=self.cells, name=gene_int, copy=False)
+
+    def get_gene_rates(self, gene_ints, mc_type):
+        """Return cell by gene dataframe, fancy index rows of the matrix, so this one is a copy"""
+        rows = self.genes.get_indexer(gene_ints)
+        if (rows == -1).any():
+            missing = pd.Index(gene_ints)[rows == -1]
+            raise KeyError(f'{missing.size} genes not found in gene rate store, e.g. {missing[:10].tolist()}')
+        values = self._get_matrix(mc_type)[np.sort(rows)]
+        # put rows back to the requested order, sorted read is more sequential on disk
+        values = values[np.argsort(np.argsort(rows))]
+        return pd.DataFrame(values.T, index=self.cells, columns=pd.Index(gene_ints, name='gene'))
+
+
+def build_gene_rate_store(gene_to_mcds_path, store_dir, mc_types=('CHN', 'CGN')):
+    """
+    Convert gene chunk MCDS into the gene rate store.
+    Adding cells change the length of every matrix row, so the store is always rebuilt from all chunks.
+
+    Parameters
+    ----------
+    gene_to_mcds_path
+        Dict, key is gene int, value is the MCDS chunk path that contain this gene,
+        same as Dataset._gene_to_mcds_path
+    store_dir
+        Output dir of the gene rate store
+    mc_types
+        mc_types to save, each mc_type is a separate matrix
+
+    Returns
+    -------
+    GeneRateStore
+    """
+    store_dir = pathlib.Path(store_dir)
+    store_dir.mkdir(exist_ok=True, parents=True)
+    # remove index of the old store first, so an interrupted build is not recognized as a store
+    invalidate_gene_rate_store(store_dir)
+
+    genes = pd.Index(sorted(gene_to_mcds_path.keys()), name='gene')
+    mcds_to_genes = {}
+    for gene, mcds_path in gene_to_mcds_path.items():
+        mcds_to_genes.setdefault(mcds_path, []).append(gene)
+
+    # cell order is taken from the first chunk, all chunks are reindexed to this order
+    with xr.open_dataset(list(mcds_to_genes.keys())[0]) as ds:
+        cells = ds.get_index('cell')
+
+    n_chunks = len(mcds_to_genes)
+    print(f'Building gene rate store for {genes.size} genes and {cells.size} cells '
+          f'from {n_chunks} MCDS chunks')
+    matrices = {mc_type: np.lib.format.open_memmap(_matrix_path(store_dir, mc_type),
+                                                   mode='w+',
+                                                   dtype=GENE_RATE_DTYPE,
+                                                   shape=(genes.size, cells.size))
+                for mc_type in mc_types}
+    for i, (mcds_path, chunk_genes) in enumerate(mcds_to_genes.items()):
+        print(f'Converting chunk {i + 1}/{n_chunks}: {mcds_path}')
+        with xr.open_dataset(mcds_path) as ds:
+            gene_da = ds['gene_da'].sel(gene=chunk_genes, cell=cells)
+            rows = genes.get_indexer(chunk_genes)
+            for mc_type, matrix in matrices.items():
+                data = gene_da.sel(mc_type=mc_type).transpose('gene', 'cell').values
+                matrix[rows] = data.astype(GENE_RATE_DTYPE)
+    for matrix in matrices.values():
+        matrix.flush()
+    del matrices
+
+    # index written last
+    np.save(store_dir / 'cells.npy', cells.values)
+    np.save(store_dir / 'genes.npy', genes.values)
+    return GeneRateStore(store_dir)
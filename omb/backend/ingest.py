@@ -5,7 +5,7 @@ Several main things
 # Coords file
 - The name of the file before first "." char will be the name of the coords set.
 - No header
-- First column must be cell id
+- First column must be cell id, cell ids are str internally, ids in other tables are converted to str to match
 - Second (x), third (y), and forth (z, optional) column are coordinates
 - Each file only contain one set of coordinates, if have multiple views, use multiple coords files.
 - Coords transfer into np.float16
@@ -20,15 +20,38 @@ Several main things
 - Associated with continuous variable, categorical variable, and region values
 
 # Gene
-
+- Input MCDS are cell-major gene rate matrix, dims are cell, gene and mc_type
+- Cell ids are converted to int with the cell map, cells not in coords are dropped
+- Genes are saved in gene-major MCDS chunks, see ingest_genes, GeneToMCDSName.json map gene int to chunk name
+
+# Append mode
+- Ingest functions take append=True to add new data to an ingested dataset
+- Existing cells keep their ints, new cells get new ints, so files keyed by cell int stay valid
+- IngestManifest.json record the sha256 of each ingested input file, unchanged inputs are skipped
+- Every ingest run rewrite IngestManifest.json, its mtime is the dataset version (dataset_version),
+  shared caches of derived data (e.g. the gene rate disk cache) key on it, so they are not reused after an append
+- CellTypeOccurInCoords.lib is made again by ingest_variables from the new coords and variables
 """
+import hashlib
+import json
+import os
 import pathlib
+import resource
+import tempfile
+import time
 import warnings
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 
+import joblib
 import numpy as np
 import pandas as pd
+import xarray as xr
 
 import omb
+from .columnar import HAS_PYARROW, read_source, write_frame, write_source
+from .gene_store import build_gene_rate_store, gene_rate_store_exists, invalidate_gene_rate_store
 from .utilities import *
 
 """
@@ -37,18 +60,47 @@ File names in ingested dataset dir
 DATASET_DIR = f'{omb.__path__[0]}/Data/Dataset/'
 COORDS_PATH = f'{DATASET_DIR}/Coords.h5'
 COORDS_CELL_TYPE_PATH = f'{DATASET_DIR}/CellTypeOccurInCoords.lib'
+COORDS_PERMUTATION_PATH = f'{DATASET_DIR}/CoordsPermutation.npz'  # random order of cells in each coords
 CELL_ID_PATH = f'{DATASET_DIR}/CellIDMap.msg'
 VARIABLE_PATH = f'{DATASET_DIR}/Variables.h5'
+# memory-mapped columnar copies of the coords and variables, written and read when pyarrow is installed
+COORDS_FEATHER_DIR = f'{DATASET_DIR}/Coords'
+VARIABLE_FEATHER_PATH = f'{DATASET_DIR}/Variables.feather'
 PALETTE_PATH = f'{DATASET_DIR}/Palette.json'
 BRAIN_REGION_PATH = f'{DATASET_DIR}/BrainRegion.csv'
 CELL_TYPE_PATH = f'{DATASET_DIR}/CellType.csv'
 GENE_META_PATH = f'{DATASET_DIR}/GeneMeta.h5'
 GENE_TO_MCDS_PATH = f'{DATASET_DIR}/GeneToMCDSName.json'  # int to name of the MCDS chunk that contain this gene
+INGEST_MANIFEST_PATH = f'{DATASET_DIR}/IngestManifest.json'  # sha256 of ingested input files, see append mode
 
 GENE_MCDS_DIR = '/home/hanliu/project/cemba/omb/CEMBA_45_Region'
 if not pathlib.Path(GENE_MCDS_DIR).exists():
     # neomorph location
     GENE_MCDS_DIR = '/home/hanliu/gene_rate_for_app/CEMBA_RS1_45Region'
+# gene-major memory-mapped gene rate matrix, converted from the MCDS chunks, see gene_store.py
+GENE_RATE_STORE_DIR = f'{GENE_MCDS_DIR}/GeneRateStore'
+# max number of MCDS chunks kept open by Dataset
+MAX_OPEN_MCDS = 8
+
+# cache dir shared by all worker processes of the app, see cache.py, set to None to disable
+SHARED_CACHE_DIR = f'{tempfile.gettempdir()}/omb_cache'
+GENE_CACHE_MAX_BYTES = 2 * 1024 ** 3
+DMR_CACHE_MAX_BYTES = 512 * 1024 ** 2
+# number of query_dmr results kept in memory of each process, the rest are read from the shared cache
+DMR_MEMORY_CACHE_SIZE = 32
+
+# load Dataset resources on first access, so worker boot is fast, see Dataset.__init__
+LAZY_DATASET = True
+
+# load genes into the gene cache when the server start, once for all the worker processes sharing SHARED_CACHE_DIR,
+# see Dataset.warm_up_gene_cache, set OMB_WARM_UP_GENE_CACHE=0 to disable
+WARM_UP_GENE_CACHE = os.environ.get('OMB_WARM_UP_GENE_CACHE', '1') != '0'
+# seconds, a warm up lock file older than this is left by a dead process and is removed
+WARM_UP_LOCK_TIMEOUT = 600
+WARM_UP_GENES = ('Cux2',)  # default gene of the nav bar and paired scatter
+# web server access log of the deployment (e.g. /var/log/httpd/access_log), used to find the most requested genes,
+# None to only load WARM_UP_GENES
+GENE_ACCESS_LOG_PATH = os.environ.get('OMB_GENE_ACCESS_LOG')
 
 # pairwise DMG
 PAIRWISE_DMG_DIR = '/home/hanliu/project/cemba/omb/pairwise_dmg'
@@ -58,6 +110,11 @@ if not pathlib.Path(PAIRWISE_DMG_DIR).exists():
 CLUSTER_DIST_PATH = f'{PAIRWISE_DMG_DIR}/ClusterDistance.h5'
 TOTAL_PAIRWISE_DMG_PATH = f'{PAIRWISE_DMG_DIR}/TotalPairwiseDMG.h5'
 PROTEIN_CODING_PAIRWISE_DMG_PATH = f'{PAIRWISE_DMG_DIR}/ProteinCodingPairwiseDMG.h5'
+# pair by gene AUROC matrix converted from the pairwise DMG HDF, see dmg_store.py
+TOTAL_PAIRWISE_DMG_STORE_DIR = f'{PAIRWISE_DMG_DIR}/TotalPairwiseDMGStore'
+PROTEIN_CODING_PAIRWISE_DMG_STORE_DIR = f'{PAIRWISE_DMG_DIR}/ProteinCodingPairwiseDMGStore'
+# ranked DMGs of the default comparison of each cell type, made by precompute.py
+DEFAULT_DMG_PATH = f'{PAIRWISE_DMG_DIR}/DefaultDMG.npz'
 
 # AnnoJ
 ANNOJ_META_PATH = f'{DATASET_DIR}/AnnoJMeta.csv'
@@ -73,6 +130,14 @@ DMR_DATASET = f'/home/hanliu/project/cemba/omb/DMR/DMR.omb_dataset.nc'
 if not pathlib.Path(DMR_DATASET).exists():
     # neomorph location
     DMR_DATASET = '/home/hanliu/gene_rate_for_app/DMR/DMR.omb_dataset.nc'
+# bit-packed HypoHits index made by precompute.py, built at first use (saved to SHARED_CACHE_DIR if DATASET_DIR is
+# not writable) when it is missing or DMR_DATASET is newer
+DMR_INDEX_PATH = f'{DATASET_DIR}/DMRIndex.npz'
+DMR_QUERY_CHUNK_SIZE = 100000  # number of DMR ids read at a time by query_dmr score filters
+DMR_QUERY_N_JOBS = 1  # number of processes of query_dmr, 1 evaluate in the server process
+# right-closed bins of the DMR browser bar plots, DMR out of the bins are not counted
+DMR_LENGTH_BINS = (0, 50, 100, 200, 300, 400, 500, 600, 700, 800, 900, 1000, 99999999999)
+DMS_BINS = (0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 99999999999)
 
 
 """
@@ -81,105 +146,361 @@ Default data types
 COORDS_DTYPE = np.float16
 CONTINUOUS_VAR_DTYPE = np.float32
 
+# cell type levels of the cell types listed in CellTypeOccurInCoords.lib
+COORDS_CELL_TYPE_LEVELS = ('CellClass', 'MajorType', 'SubType')
+
+# number of rows read at a time from the input tables
+INGEST_CHUNK_SIZE = 500000
+
+# number of genes in each gene-major MCDS chunk made by ingest_genes
+GENE_CHUNK_N_GENES = 1000
+# gene rates are float32 in netCDF (no float16 type), quantized to this digit so zlib compress them well
+GENE_RATE_LEAST_SIGNIFICANT_DIGIT = 3
+
+
+@contextmanager
+def _log_stage(name):
+    """Print time and peak RSS of an ingest stage, the peak RSS of worker processes is printed separately"""
+    start = time.time()
+    yield
+    # ru_maxrss is KB on linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    peak_rss_workers = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    print(f'{name} took {time.time() - start:.1f}s, '
+          f'peak RSS {peak_rss:.0f} MB (workers {peak_rss_workers:.0f} MB)')
+
+
+def file_sha256(path, block_size=2 ** 20):
+    """sha256 of the file content"""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _read_manifest():
+    if not pathlib.Path(INGEST_MANIFEST_PATH).exists():
+        return {}
+    with open(INGEST_MANIFEST_PATH) as f:
+        return json.load(f)
+
+
+def _update_manifest(hashes, reset=False):
+    """Record the hash of ingested input files, key is "{stage}/{file name}", reset=True drop all old records"""
+    manifest = {} if reset else _read_manifest()
+    manifest.update(hashes)
+    with open(INGEST_MANIFEST_PATH, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return
+
+
+def dataset_version():
+    """Version of the ingested dataset, changed by every ingest run including append mode"""
+    try:
+        return pathlib.Path(INGEST_MANIFEST_PATH).stat().st_mtime_ns
+    except FileNotFoundError:
+        # dataset ingested before the manifest exist
+        return 0
+
+
+def _changed_inputs(stage, paths):
+    """Input paths whose content is not in the manifest yet, and the hashes of all paths"""
+    manifest = _read_manifest()
+    hashes = {f'{stage}/{pathlib.Path(path).name}': file_sha256(path) for path in paths}
+    changed = [path for path, (key, sha) in zip(paths, hashes.items()) if manifest.get(key) != sha]
+    return changed, hashes
+
 
-def ingest_cell_coords(coords_dir):
+def coords_permutation(coords_df, random_state=0):
+    """Cell ints of a coords table in a fixed random order, first K cells is a deterministic downsample"""
+    return np.random.RandomState(random_state).permutation(coords_df.index.values)
+
+
+def _cell_id_strs(cells):
+    """Cell ids as str, numeric ids read from different tables are the same after conversion"""
+    return pd.Index(cells).astype(str).values
+
+
+def _ordered_map(executor, func, *iterables, max_pending=1):
+    """Same as executor.map, but only max_pending calls are submitted ahead of the result being consumed"""
+    pending = deque()
+    for args in zip(*iterables):
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+        pending.append(executor.submit(func, *args))
+    while len(pending) > 0:
+        yield pending.popleft().result()
+
+
+def _read_coords_file(path, chunk_size=INGEST_CHUNK_SIZE):
+    """
+    Read one coords csv in chunks, return coords name, cell ids and the coords values in COORDS_DTYPE.
+    Each chunk is converted to COORDS_DTYPE before the next one is parsed, so only one chunk is in float64,
+    the whole table is still returned.
+    """
+    coord_name = path.name.split('.')[0]
+    cells = []
+    values = []
+    for chunk in pd.read_csv(path, header=None, index_col=0, chunksize=chunk_size):
+        # str cell ids, cell ids of the other tables are converted to str too, see _cell_id_strs
+        cells.append(_cell_id_strs(chunk.index))
+        values.append(chunk.values.astype(COORDS_DTYPE))
+    cells = np.concatenate(cells)
+    values = np.concatenate(values)
+    if values.shape[1] not in (2, 3):
+        raise NotImplementedError(f'Coords table right now only support 2D or 3D, '
+                                  f'got a table with {values.shape[1]} dims.')
+    return coord_name, cells, values
+
+
+class _CellIDMap:
+    """Cell id to int map, new cell ids get the next ints in order of appearance"""
+
+    def __init__(self, cell_to_int=None):
+        if cell_to_int is None:
+            self.cells = pd.Index([], dtype=object)
+        else:
+            # existing map, position in self.cells is the cell int
+            cells = pd.Series(cell_to_int).sort_values()
+            if not np.array_equal(cells.values, np.arange(cells.size)):
+                raise ValueError('Existing cell ints are not 0 to n - 1, can not append new cells')
+            self.cells = pd.Index(cells.index, dtype=object)
+
+    def update_and_map(self, cells):
+        """Add new cell ids and return the ints of cells"""
+        codes = self.cells.get_indexer(cells)
+        is_new = codes == -1
+        if is_new.any():
+            new_cells = pd.Index(pd.unique(cells[is_new]))
+            self.cells = self.cells.append(new_cells)
+            codes[is_new] = self.cells.get_indexer(cells[is_new])
+        return codes
+
+    def to_dict(self):
+        return dict(zip(self.cells, range(self.cells.size)))
+
+
+def ingest_cell_coords(coords_dir, n_jobs=1, chunk_size=INGEST_CHUNK_SIZE, append=False):
     """
     Load all the coords, use union of cell ids and map all cell id into int internally, return the cell map dict.
+
+    In append mode, existing cells keep their ints and new cells get new ints, coords files with the same content
+    as the last ingest are skipped, new or changed coords tables are added to or replace the ones in Coords.h5.
     Parameters
     ----------
     coords_dir
         User input dir path
+    n_jobs
+        Number of processes reading the coords files in parallel
+    chunk_size
+        Number of rows read at a time from each coords file
+    append
+        If True, update the ingested dataset instead of rebuilding it
     Returns
     -------
     cell_to_int: dict
         cell to int map, use for all other data's cell id validation and conversion
     """
-    # load all the coords
-    print(f'Loading cell coords')
-    coords_dict = {}
-    for path in list(coords_dir.glob('*csv.gz')):
-        coord_name = path.name.split('.')[0]
-        coords_df = pd.read_csv(path, header=None, index_col=0).astype(COORDS_DTYPE)
-        coords_df.index.name = 'cell'
-        if coords_df.shape[1] == 2:
-            coords_df.columns = ['x', 'y']
-        elif coords_df.shape[1] == 3:
-            coords_df.columns = ['x', 'y', 'z']
+    coords_dir = pathlib.Path(coords_dir)
+    paths = sorted(coords_dir.glob('*csv.gz'))
+    append = append and pathlib.Path(CELL_ID_PATH).exists()
+    if append:
+        changed_paths, hashes = _changed_inputs('coords', paths)
+        print(f'{len(paths) - len(changed_paths)} coords files are not changed since the last ingest')
+        paths = changed_paths
+        cell_id_map = _CellIDMap(read_msgpack(CELL_ID_PATH))
+        if pathlib.Path(COORDS_PERMUTATION_PATH).exists():
+            with np.load(COORDS_PERMUTATION_PATH) as f:
+                permutations = dict(f)
         else:
-            raise NotImplementedError(f'Coords table right now only support 2D or 3D, '
-                                      f'got a table with {coords_df.shape[1]} dims.')
-        coords_dict[coord_name] = coords_df
-
-    # generate cell_id map
-    total_cell_ids = set()
-    for k, v in coords_dict.items():
-        total_cell_ids |= set(v.index)
-    cell_to_int = {c: i for i, c in enumerate(total_cell_ids)}
-    del total_cell_ids
-    print(f'Got a total of {len(cell_to_int)} unique cell ids from all coords files')
-
-    # change all the coords table index into int
-    print(f'Standardizing internal cell ids')
-    for k, v in coords_dict.items():
-        v.index = v.index.map(cell_to_int)
-
-    print(f'Saving coords and cell ids')
-    with pd.HDFStore(COORDS_PATH, 'w') as hdf:
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            for k, v in coords_dict.items():
-                hdf[k] = v
-    write_msgpack(CELL_ID_PATH, cell_to_int)
-
+            # dataset ingested before the permutation file exist, made from Coords.h5 below
+            permutations = {}
+    else:
+        hashes = {f'coords/{path.name}': file_sha256(path) for path in paths}
+        cell_id_map = _CellIDMap()
+        permutations = {}
+    print(f'Loading cell coords from {len(paths)} files')
+    # coords that have an up to date columnar copy before this ingest
+    columnar_keys = read_source(COORDS_FEATHER_DIR, COORDS_PATH) if append else None
+    columnar_keys = set(columnar_keys) if columnar_keys is not None else set()
+
+    # files are read by the workers, at most n_jobs files are read ahead of the table being saved here,
+    # so this process hold at most n_jobs + 1 full tables
+    n_jobs = max(n_jobs, 1)
+    with _log_stage('Loading, standardizing and saving coords'), \
+            ProcessPoolExecutor(max_workers=n_jobs) as executor, \
+            pd.HDFStore(COORDS_PATH, 'a' if append else 'w') as hdf:
+        # results keep the file order, so cell ints do not depend on which worker finish first
+        for coord_name, cells, values in _ordered_map(executor, _read_coords_file, paths,
+                                                      [chunk_size] * len(paths), max_pending=n_jobs):
+            columns = ['x', 'y', 'z'][:values.shape[1]]
+            coords_df = pd.DataFrame(values, index=pd.Index(cell_id_map.update_and_map(cells), name='cell'),
+                                     columns=columns)
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                hdf[coord_name] = coords_df
+            columnar_keys.discard(coord_name)
+            permutations[coord_name] = coords_permutation(coords_df)
+            print(f'{coord_name}: {coords_df.shape[0]} cells')
+            del coords_df, cells, values
+    print(f'Got a total of {cell_id_map.cells.size} unique cell ids from all coords files')
+
+    if HAS_PYARROW:
+        # written after the HDF is closed, the source record match the final HDF
+        with _log_stage('Saving columnar coords'):
+            _write_columnar_coords(columnar_keys)
+
+    with _log_stage('Saving cell ids'):
+        cell_to_int = cell_id_map.to_dict()
+        write_msgpack(CELL_ID_PATH, cell_to_int)
+        with pd.HDFStore(COORDS_PATH, 'r') as hdf:
+            for key in hdf.keys():
+                if key.lstrip('/') not in permutations:
+                    permutations[key.lstrip('/')] = coords_permutation(hdf[key])
+        np.savez(COORDS_PERMUTATION_PATH, **permutations)
+    # a rebuild change cell ints, so records of the other stages are dropped
+    _update_manifest(hashes, reset=not append)
     return cell_to_int
 
 
-def ingest_variables(cell_to_int, categorical_path=None, continuous_path=None):
+def _write_columnar_coords(columnar_keys):
+    """Write the feather copy of every coords in Coords.h5 except columnar_keys, which are up to date"""
+    feather_dir = pathlib.Path(COORDS_FEATHER_DIR)
+    with pd.HDFStore(COORDS_PATH, 'r') as hdf:
+        keys = [k.lstrip('/') for k in hdf.keys()]
+    for path in feather_dir.glob('*.feather'):
+        if path.name[:-len('.feather')] not in keys:
+            path.unlink()
+    for key in keys:
+        if (key not in columnar_keys) or (not (feather_dir / f'{key}.feather').exists()):
+            # one table in memory at a time
+            write_frame(pd.read_hdf(COORDS_PATH, key=key), feather_dir / f'{key}.feather')
+    write_source(feather_dir, COORDS_PATH, keys)
+    return
+
+
+def _read_variable_table(path, cell_to_int, var_type, dtype=None, chunk_size=INGEST_CHUNK_SIZE):
+    """Read a variable table in chunks, validate and convert cell ids to int chunk by chunk"""
+    with pd.HDFStore(path, 'r') as hdf:
+        try:
+            chunks = hdf.select('data', chunksize=chunk_size)
+            chunks = iter(chunks)
+        except TypeError:
+            # fixed format HDF can not be read in chunks
+            chunks = [hdf['data']]
+
+        cell_index = pd.Index(cell_to_int.keys())
+        cell_ints = np.fromiter(cell_to_int.values(), dtype=np.int64, count=len(cell_to_int))
+        total_chunks = []
+        for chunk in chunks:
+            codes = cell_index.get_indexer(_cell_id_strs(chunk.index))
+            # validate cell ids before conversion
+            cell_not_in_coords = chunk.index[codes == -1]
+            if cell_not_in_coords.size != 0:
+                error_str = ', '.join(map(str, cell_not_in_coords[:10]))
+                raise KeyError(f'{cell_not_in_coords.size} cell ids found in {var_type} variable table '
+                               f'do not found in any coords table, e.g. {error_str}')
+            chunk.index = cell_ints[codes]
+            if dtype is not None:
+                chunk = chunk.astype(dtype)
+            total_chunks.append(chunk)
+    return pd.concat(total_chunks)
+
+
+def ingest_variables(cell_to_int, categorical_path=None, continuous_path=None, chunk_size=INGEST_CHUNK_SIZE,
+                     append=False):
+    """
+    Load categorical and continuous variables, convert cell ids to int and save Variables.h5
+
+    In append mode, variable tables with the same content as the last ingest are skipped,
+    values of the changed tables are added to the existing Variables.h5, replacing the old values of the same cells.
+    """
+    append = append and pathlib.Path(VARIABLE_PATH).exists()
+    input_paths = {'categorical': categorical_path, 'continuous': continuous_path}
+    input_paths = {k: v for k, v in input_paths.items() if v is not None}
+    hashes = {f'variables/{k}': file_sha256(v) for k, v in input_paths.items()}
+    if append:
+        manifest = _read_manifest()
+        if categorical_path is not None and manifest.get('variables/categorical') == hashes['variables/categorical']:
+            print('Categorical variables are not changed since the last ingest')
+            categorical_path = None
+        if continuous_path is not None and manifest.get('variables/continuous') == hashes['variables/continuous']:
+            print('Continuous variables are not changed since the last ingest')
+            continuous_path = None
+
     variables_to_cat = []
 
     if categorical_path is not None:
         # TODO change to csv
-        categorical_df = pd.read_hdf(categorical_path, key='data').astype('category')
-        # validate cell ids before conversion
-        cell_not_in_coords = categorical_df.index[~categorical_df.index.isin(cell_to_int)]
-        error_str = ', '.join(cell_not_in_coords[:10])
-        try:
-            assert cell_not_in_coords.size == 0
-        except AssertionError:
-            raise KeyError(f'{cell_not_in_coords.size} cell ids found in categorical variable table '
-                           f'do not found in any coords table, e.g. {error_str}')
-        else:
-            categorical_df.index = categorical_df.index.map(cell_to_int)
+        with _log_stage('Loading categorical variables'):
+            # category is set after all chunks are read, so the categories are the same for all chunks
+            categorical_df = _read_variable_table(categorical_path, cell_to_int, 'categorical',
+                                                  chunk_size=chunk_size).astype('category')
             cells, num_vars = categorical_df.shape
             print(f'Got {num_vars} categorical variables for {cells} cells.')
             variables_to_cat.append(categorical_df)
 
     if continuous_path is not None:
         # TODO change to csv
-        continuous_df = pd.read_hdf(continuous_path, key='data').astype(CONTINUOUS_VAR_DTYPE)
-        # validate cell ids before conversion
-        cell_not_in_coords = continuous_df.index[~continuous_df.index.isin(cell_to_int)]
-        error_str = ', '.join(cell_not_in_coords[:10])
-        try:
-            assert cell_not_in_coords.size == 0
-        except AssertionError:
-            raise KeyError(f'{cell_not_in_coords.size} cell ids found in continuous variable table '
-                           f'do not found in any coords table, e.g. {error_str}')
-        else:
-            continuous_df.index = continuous_df.index.map(cell_to_int)
+        with _log_stage('Loading continuous variables'):
+            continuous_df = _read_variable_table(continuous_path, cell_to_int, 'continuous',
+                                                 dtype=CONTINUOUS_VAR_DTYPE, chunk_size=chunk_size)
             cells, num_vars = continuous_df.shape
             print(f'Got {num_vars} continuous variables for {cells} cells.')
             variables_to_cat.append(continuous_df)
 
-    if len(variables_to_cat) != 0:
-        total_variables = pd.concat(variables_to_cat, axis=1, sort=True)
-    else:
-        total_variables = pd.DataFrame([], index=cell_to_int.values())
-
-    total_variables.to_hdf(VARIABLE_PATH, key='data', format="table")
+    with _log_stage('Saving variables'):
+        if len(variables_to_cat) != 0:
+            total_variables = pd.concat(variables_to_cat, axis=1, sort=True)
+        else:
+            total_variables = pd.DataFrame([], index=cell_to_int.values())
+
+        if append:
+            total_variables = _merge_variables(pd.read_hdf(VARIABLE_PATH), total_variables)
+        total_variables.to_hdf(VARIABLE_PATH, key='data', format="table")
+        if HAS_PYARROW:
+            write_frame(total_variables, VARIABLE_FEATHER_PATH)
+            write_source(VARIABLE_FEATHER_PATH, VARIABLE_PATH, ['data'])
+
+    with _log_stage('Saving cell types of each coords'):
+        ingest_coord_cell_types(total_variables)
+    _update_manifest(hashes)
     return total_variables
 
 
+def ingest_coord_cell_types(total_variables, cell_type_levels=COORDS_CELL_TYPE_LEVELS):
+    """
+    Save the cell types that occur in each coords to CellTypeOccurInCoords.lib,
+    key is coords name, value is the set of cell type names of cell_type_levels
+    """
+    cell_type_levels = [level for level in cell_type_levels if level in total_variables.columns]
+    coord_cell_types = {}
+    with pd.HDFStore(COORDS_PATH, 'r') as hdf:
+        for key in hdf.keys():
+            cells = hdf[key].index
+            cell_types = set()
+            for level in cell_type_levels:
+                cell_types |= set(total_variables[level].reindex(cells).dropna().unique())
+            coord_cell_types[key.lstrip('/')] = cell_types
+    joblib.dump(coord_cell_types, COORDS_CELL_TYPE_PATH)
+    return coord_cell_types
+
+
+def _merge_variables(old_variables, new_variables):
+    """Union of cells and variables, values of new_variables replace the old ones"""
+    categorical_columns = set(old_variables.select_dtypes('category').columns) | \
+        set(new_variables.select_dtypes('category').columns)
+    # categories are different in old and new, merge the values and set categories again
+    merged = new_variables.astype(object).combine_first(old_variables.astype(object))
+    for column in merged.columns:
+        if column in categorical_columns:
+            merged[column] = merged[column].astype('category')
+        else:
+            merged[column] = merged[column].astype(CONTINUOUS_VAR_DTYPE)
+    return merged
+
+
 def ingest_palette(total_variables, palette_path=None):
     if palette_path is not None:
         # TODO change to json
@@ -203,11 +524,204 @@ def ingest_palette(total_variables, palette_path=None):
     return
 
 
-def ingest_genes():
-    # TODO
+def _remap_mcds_cells(mcds_paths, cell_to_int, gene_to_int=None):
+    """
+    Ingested cells of each MCDS, their cell ints, the gene ids and gene ints.
+    All MCDS must have the same genes, a cell can only be in one MCDS
+    and all genes must be in gene_to_int when it is given.
+    """
+    file_cells = []
+    total_dropped = 0
+    genes = None
+    for path in mcds_paths:
+        with xr.open_dataset(path) as ds:
+            cells = ds.get_index('cell')
+            file_genes = ds.get_index('gene')
+        if genes is None:
+            genes = file_genes
+        else:
+            # genes are selected by label, so only the gene set need to be the same
+            diff_genes = genes.symmetric_difference(file_genes)
+            if diff_genes.size > 0:
+                raise ValueError(f'{path} do not have the same genes as {mcds_paths[0]}, '
+                                 f'{diff_genes.size} genes are different, e.g. '
+                                 f'{", ".join(map(str, diff_genes[:10]))}')
+        is_ingested = pd.Index(_cell_id_strs(cells)).isin(cell_to_int)
+        total_dropped += int((~is_ingested).sum())
+        # original labels, used to select the cells from this MCDS
+        file_cells.append(cells[is_ingested])
+    cell_ints = pd.Index(np.concatenate([pd.Index(_cell_id_strs(cells)).map(cell_to_int).values
+                                         for cells in file_cells]),
+                         name='cell')
+    if cell_ints.has_duplicates:
+        dup_cells = cell_ints[cell_ints.duplicated()].unique()
+        raise ValueError(f'{dup_cells.size} cells are in more than one MCDS, e.g. cell ints '
+                         f'{", ".join(map(str, dup_cells[:10]))}')
+    if gene_to_int is not None:
+        gene_ints = genes.map(gene_to_int)
+        is_unmapped = pd.isna(gene_ints)
+        if is_unmapped.any():
+            raise KeyError(f'{int(is_unmapped.sum())} genes of the MCDS are not in the gene metadata, e.g. '
+                           f'{", ".join(map(str, genes[is_unmapped][:10]))}')
+        gene_ints = gene_ints.astype(int)
+    else:
+        gene_ints = genes
+    print(f'Got {cell_ints.size} cells and {genes.size} genes, '
+          f'{total_dropped} cells not in coords are dropped')
+    return file_cells, cell_ints, genes, gene_ints
+
+
+def _read_gene_chunk(mcds_paths, file_cells, var_name, genes, mc_types):
+    """Gene rate of genes and all cells of the MCDS, array dims are gene, cell and mc_type"""
+    chunk_data = []
+    for path, cells in zip(mcds_paths, file_cells):
+        with xr.open_dataset(path) as ds:
+            data = ds[var_name].sel(gene=genes, cell=cells, mc_type=mc_types)
+            chunk_data.append(data.transpose('gene', 'cell', 'mc_type').values)
+    return np.concatenate(chunk_data, axis=1)
+
+
+def _save_gene_chunk(path, values, gene_ints, cell_ints, mc_types):
+    chunk_da = xr.DataArray(values,
+                            coords={'gene': np.asarray(gene_ints),
+                                    'cell': np.asarray(cell_ints),
+                                    'mc_type': list(mc_types)},
+                            dims=['gene', 'cell', 'mc_type'])
+    encoding = {'zlib': True,
+                'complevel': 4,
+                'shuffle': True,
+                'dtype': 'float32',
+                'least_significant_digit': GENE_RATE_LEAST_SIGNIFICANT_DIGIT,
+                'chunksizes': (1, chunk_da.sizes['cell'], 1)}
+    # write to a temp file first, so an interrupted ingest do not leave a broken chunk
+    path = pathlib.Path(path)
+    temp_path = path.parent / f'{path.name}.temp'
+    chunk_da.to_dataset(name='gene_da').to_netcdf(temp_path, encoding={'gene_da': encoding})
+    temp_path.replace(path)
     return
 
 
+def ingest_genes(mcds_paths, cell_to_int, gene_to_int=None, output_dir=GENE_MCDS_DIR,
+                 var_name='gene_da', mc_types=('CHN', 'CGN'), genes_per_chunk=GENE_CHUNK_N_GENES,
+                 chunk_prefix='GeneRate', build_store=False, append=False):
+    """
+    Convert cell-major gene rate MCDS into gene-major MCDS chunks used by Dataset.get_gene_rate
+
+    Each output chunk contain genes_per_chunk genes of all cells, the netCDF chunk of the gene rate variable is
+    one gene and one mc_type of all cells, so reading a gene is one zlib chunk per mc_type.
+
+    In append mode, only the input MCDS not ingested before are read, their cells are added to the existing chunks,
+    replacing the old values of the same cells. Genes must be the same as the existing chunks.
+
+    Parameters
+    ----------
+    mcds_paths
+        Input MCDS paths, each one contain gene rate of a group of cells, same genes in all files
+    cell_to_int
+        Cell to int map from ingest_cell_coords, cells not in the map are dropped
+    gene_to_int
+        Gene id to gene int map, same as the index of GeneMeta.h5, None if the gene coords are already ints
+    output_dir
+        Output dir of the MCDS chunks
+    var_name
+        Name of the gene rate variable in the input MCDS, dims are cell, gene and mc_type
+    mc_types
+        mc_types to save
+    genes_per_chunk
+        Number of genes in each output chunk
+    chunk_prefix
+        File name prefix of the output chunks
+    build_store
+        If True, also build the gene rate store at GENE_RATE_STORE_DIR from the new chunks.
+        An existing store is always rebuilt, otherwise it would miss the new cells.
+    append
+        If True, update the existing chunks instead of rebuilding them
+
+    Returns
+    -------
+    gene_to_mcds_name: dict
+        gene int to the file name of the chunk that contain this gene, also saved to GENE_TO_MCDS_PATH
+    """
+    output_dir = pathlib.Path(output_dir)
+    output_dir.mkdir(exist_ok=True, parents=True)
+    mcds_paths = sorted(map(str, mcds_paths))
+    mc_types = list(mc_types)
+
+    append = append and pathlib.Path(GENE_TO_MCDS_PATH).exists()
+    if append:
+        mcds_paths, hashes = _changed_inputs('genes', mcds_paths)
+        print(f'{len(hashes) - len(mcds_paths)} MCDS are not changed since the last ingest')
+        with open(GENE_TO_MCDS_PATH) as f:
+            gene_to_mcds_name = {int(g): n for g, n in json.load(f).items()}
+        if len(mcds_paths) == 0:
+            return gene_to_mcds_name
+    else:
+        hashes = {f'genes/{pathlib.Path(path).name}': file_sha256(path) for path in mcds_paths}
+        gene_to_mcds_name = {}
+
+    # cells of each input file, remapped to cell int
+    print(f'Loading cell and gene ids of {len(mcds_paths)} MCDS')
+    with _log_stage('Remapping cell ids'):
+        file_cells, cell_ints, genes, gene_ints = _remap_mcds_cells(mcds_paths, cell_to_int, gene_to_int)
+
+    if gene_rate_store_exists(GENE_RATE_STORE_DIR):
+        # Dataset use the store over the chunks, invalidate it before the chunks change,
+        # so an interrupted ingest do not leave a store without the new cells
+        build_store = True
+        invalidate_gene_rate_store(GENE_RATE_STORE_DIR)
+
+    if append:
+        int_to_gene = pd.Series(genes, index=gene_ints)
+        if set(int_to_gene.index) != set(gene_to_mcds_name.keys()):
+            raise ValueError('Genes of the new MCDS are different from the ingested genes, '
+                             'ingest all MCDS without append mode')
+        mcds_name_to_genes = {}
+        for gene, name in gene_to_mcds_name.items():
+            mcds_name_to_genes.setdefault(name, []).append(gene)
+
+        n_chunks = len(mcds_name_to_genes)
+        with _log_stage('Adding cells to gene-major MCDS chunks'):
+            for i, (name, chunk_gene_ints) in enumerate(mcds_name_to_genes.items()):
+                print(f'Updating chunk {i + 1}/{n_chunks}: {name}')
+                new_values = _read_gene_chunk(mcds_paths, file_cells, var_name,
+                                              int_to_gene.loc[chunk_gene_ints].values, mc_types)
+                with xr.open_dataset(output_dir / name) as ds:
+                    old_da = ds['gene_da'].sel(gene=chunk_gene_ints, mc_type=mc_types)
+                    old_da = old_da.transpose('gene', 'cell', 'mc_type')
+                    old_cells = old_da.get_index('cell')
+                    keep_cells = ~old_cells.isin(cell_ints)
+                    old_values = old_da.values[:, keep_cells]
+                _save_gene_chunk(output_dir / name,
+                                 np.concatenate([old_values, new_values], axis=1),
+                                 chunk_gene_ints,
+                                 np.concatenate([old_cells[keep_cells].values, cell_ints.values]),
+                                 mc_types)
+    else:
+        n_chunks = (genes.size + genes_per_chunk - 1) // genes_per_chunk
+        with _log_stage('Saving gene-major MCDS chunks'):
+            for i, start in enumerate(range(0, genes.size, genes_per_chunk)):
+                # only one chunk of genes of all cells is in memory
+                chunk_values = _read_gene_chunk(mcds_paths, file_cells, var_name,
+                                                genes[start:start + genes_per_chunk], mc_types)
+                chunk_gene_ints = gene_ints[start:start + genes_per_chunk]
+                name = f'{chunk_prefix}.chunk{i}.mcds'
+                print(f'Saving chunk {i + 1}/{n_chunks}: {name}')
+                _save_gene_chunk(output_dir / name, chunk_values, chunk_gene_ints, cell_ints, mc_types)
+                for gene in chunk_gene_ints:
+                    gene_to_mcds_name[int(gene)] = name
+
+        with open(GENE_TO_MCDS_PATH, 'w') as f:
+            json.dump(gene_to_mcds_name, f)
+
+    if build_store:
+        # the store is a copy of the chunks with cells as columns, new cells change every row, so it is rebuilt
+        with _log_stage('Building gene rate store'):
+            build_gene_rate_store({g: f'{output_dir}/{n}' for g, n in gene_to_mcds_name.items()},
+                                  GENE_RATE_STORE_DIR, mc_types=mc_types)
+    _update_manifest(hashes)
+    return gene_to_mcds_name
+
+
 if __name__ == '__main__':
     # TODO add test here
     pass
@@ -0,0 +1,74 @@
+"""
+Offline batch jobs that precompute query results served by Dataset
+
+Default DMG tables
+The cell type browser always open with the default DMG comparison of the cell type (Dataset.default_dmg_comparison),
+rank the default comparison of every cell type once and save the ranked genes to DEFAULT_DMG_PATH,
+query_dmg serve them directly and only rank custom selections live.
+
+DMR index
+The bit-packed HypoHits index used by query_dmr (dmr.py), built here so servers do not build it at first use.
+
+Run again after the pairwise DMG data or the DMR dataset changed:
+    python -m omb.backend.precompute
+"""
+import time
+
+from . import dataset
+from .dmg_store import default_dmg_key, save_default_dmg
+from .dmr import build_dmr_index
+from .ingest import *
+
+
+def precompute_dmr_index(output_path=DMR_INDEX_PATH):
+    """Build the DMR index of DMR_DATASET and save it to output_path"""
+    print(f'Building DMR index from {DMR_DATASET}')
+    start = time.time()
+    index = build_dmr_index(DMR_DATASET)
+    index.save(output_path)
+    print(f'Saved DMR index of {index.n_dmr} DMRs to {output_path} in {time.time() - start:.0f}s')
+    return index
+
+
+def precompute_default_dmg(output_path=DEFAULT_DMG_PATH, top_n=100):
+    """
+    Rank the default DMG comparison of all cell types, for both protein coding and total genes
+
+    Parameters
+    ----------
+    output_path
+        Output npz path, query_dmg read DEFAULT_DMG_PATH
+    top_n
+        Number of genes saved for each comparison, query_dmg with larger top_n is ranked live
+
+    Returns
+    -------
+    tables dict, key is dmg_store.default_dmg_key, value is the ranked gene ints
+    """
+    cell_types = [cell_type for cell_type, level in dataset.cluster_name_to_level.items()
+                  if level in ('CellClass', 'MajorType', 'SubType')]
+    print(f'Ranking default DMG comparisons of {len(cell_types)} cell types')
+    start = time.time()
+    tables = {}
+    for cell_type in cell_types:
+        try:
+            dmg_level, hypo_clusters, hyper_clusters = dataset.default_dmg_comparison(cell_type)
+        except KeyError:
+            print(f'{cell_type} do not have a default DMG comparison, skipped')
+            continue
+        if len(hyper_clusters) == 0:
+            continue
+        for protein_coding in [True, False]:
+            key = default_dmg_key(hypo_clusters, hyper_clusters, dmg_level, protein_coding)
+            if key in tables:
+                continue
+            genes = dataset.rank_dmg(hypo_clusters, hyper_clusters, dmg_level, protein_coding=protein_coding)
+            tables[key] = genes[:top_n].values
+    save_default_dmg(output_path, tables, top_n, source_paths=dataset.dmg_source_paths())
+    print(f'Saved {len(tables)} DMG tables to {output_path} in {time.time() - start:.0f}s')
+    return tables
+
+
+if __name__ == '__main__':
+    precompute_dmr_index()
+    precompute_default_dmg()
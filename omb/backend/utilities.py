@@ -1,4 +1,12 @@
+import copy
+import functools
+import inspect
+import threading
+import time
+from collections import OrderedDict
+
 import msgpack
+import numpy as np
 
 
 def read_msgpack(path):
@@ -10,3 +18,154 @@ def read_msgpack(path):
 def write_msgpack(path, data):
     with open(path, 'wb') as f:
         f.write(msgpack.packb(data))
+
+
+def resource_lock(instance, name):
+    """RLock of one resource of instance, see lazy_resource"""
+    try:
+        return instance._resource_locks[name]
+    except KeyError:
+        # _resource_lock only guard the creation of the per-resource locks
+        with instance._resource_lock:
+            return instance._resource_locks.setdefault(name, threading.RLock())
+
+
+class lazy_resource:
+    """
+    Decorator of a method that load a resource, the method is called on first access of the attribute,
+    the result is saved into the instance __dict__, so later access is a plain attribute lookup.
+
+    The instance must have a _resource_lock (threading.Lock), a _resource_locks dict and a _load_times dict,
+    loading is thread-safe and only happen once, resources can depend on other resources.
+    Each resource has its own lock, so a slow resource only block the callbacks that need it.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.name = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        with resource_lock(instance, self.name):
+            # check again, other thread may have loaded it while waiting for the lock
+            if self.name not in instance.__dict__:
+                start = time.time()
+                instance.__dict__[self.name] = self.func(instance)
+                instance._load_times[self.name] = time.time() - start
+        return instance.__dict__[self.name]
+
+
+def read_only(data):
+    """
+    Mark the numpy arrays under a dataframe or series read-only and return it.
+    In-place writes raise ValueError, adding columns to a shallow copy is still allowed.
+    Categorical and extension arrays are not changed.
+    """
+    for array in data._mgr.arrays:
+        if isinstance(array, np.ndarray):
+            array.flags.writeable = False
+    return data
+
+
+def logic_to_number(logic, options):
+    """Turn the cluster logic ('all', 'any' or a number) into the min number of options"""
+    if options is None:
+        options = ()
+    if logic == 'all':
+        return len(options)
+    elif logic == 'any':
+        return 1
+    else:
+        return min(int(logic), len(options))
+
+
+def _canonical_set(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = [value]
+    return tuple(sorted(set(value)))
+
+
+class canonical_memo:
+    """
+    Decorator of the Dataset query methods, memoize results by canonicalized arguments.
+
+    lru_cache key on the raw arguments, so the same clusters selected in a different order, or
+    'all' vs the equivalent number, miss the cache. Here set-like arguments are sorted and deduplicated,
+    logic arguments are turned into numbers, the canonical values are also what the method receives.
+
+    Parameters
+    ----------
+    maxsize
+        Max number of results, least recently used result is dropped when exceeded
+    set_args
+        Names of the set-like arguments
+    logic_args
+        Dict, key is the name of a logic argument, value is the name of the set argument it applies to
+    copy
+        Return a copy of the memoized result, for results that callers modify (e.g. DataFrame)
+    ignore_args
+        Names of the arguments that do not change the result (e.g. n_jobs), not part of the key
+    """
+
+    def __init__(self, maxsize=128, set_args=(), logic_args=None, copy=False, ignore_args=()):
+        self.maxsize = maxsize
+        self.set_args = set_args
+        self.logic_args = {} if logic_args is None else logic_args
+        self.copy = copy
+        self.ignore_args = ignore_args
+
+    def __call__(self, func):
+        signature = inspect.signature(func)
+        cache = OrderedDict()
+        lock = threading.Lock()
+        stats = {'hits': 0, 'misses': 0}
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = bound.arguments
+            for name in self.set_args:
+                arguments[name] = _canonical_set(arguments[name])
+            for name, set_name in self.logic_args.items():
+                arguments[name] = logic_to_number(arguments[name], arguments[set_name])
+            key = tuple((name, value) for name, value in arguments.items() if name not in self.ignore_args)
+
+            with lock:
+                try:
+                    result = cache.pop(key)
+                    stats['hits'] += 1
+                    cache[key] = result
+                    hit = True
+                except KeyError:
+                    stats['misses'] += 1
+                    hit = False
+            if not hit:
+                result = func(*bound.args, **bound.kwargs)
+                with lock:
+                    cache[key] = result
+                    while len(cache) > self.maxsize:
+                        cache.popitem(last=False)
+            if self.copy:
+                result = copy.copy(result)
+            return result
+
+        def cache_stats():
+            total = stats['hits'] + stats['misses']
+            return {'hits': stats['hits'],
+                    'misses': stats['misses'],
+                    'hit_ratio': stats['hits'] / total if total > 0 else 0.,
+                    'size': len(cache)}
+
+        def cache_clear():
+            with lock:
+                cache.clear()
+            return
+
+        wrapper.cache_stats = cache_stats
+        wrapper.cache_clear = cache_clear
+        return wrapper
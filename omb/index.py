@@ -9,6 +9,7 @@ from dash.exceptions import PreventUpdate
 
 from omb.app import app, server, APP_ROOT_NAME
 from omb.apps import *
+from omb.backend import dataset, WARM_UP_GENE_CACHE
 
 
 def search_to_dict(search):
@@ -89,6 +90,12 @@ def get_header():
 # all orders matters here
 type(server)
 
+# resources loaded while creating the apps
+print(dataset.startup_report())
+# load popular genes in background, do not block the server from accepting requests
+if WARM_UP_GENE_CACHE:
+    dataset.warm_up_gene_cache()
+
 app.config.suppress_callback_exceptions = True
 app.config.update(
     {
@@ -124,7 +131,7 @@ def display_page(pathname, search, total_url):
         # init callback url is None
         raise PreventUpdate
     elif (pathname == f'/{APP_ROOT_NAME}home') or (pathname == f'/{APP_ROOT_NAME}'):
-        layout = home_layout
+        layout = create_home_layout()
     elif pathname == f'/{APP_ROOT_NAME}brain_region':
         if search_dict is None:
             return '404'
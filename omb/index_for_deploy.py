@@ -113,7 +113,7 @@ def display_page(pathname, search, total_url):
         # init callback url is None
         raise PreventUpdate
     elif (pathname == f'/{APP_ROOT_NAME}/home') or (pathname == f'/{APP_ROOT_NAME}/'):
-        layout = home_layout
+        layout = create_home_layout()
     elif pathname == f'/{APP_ROOT_NAME}/brain_region':
         if search_dict is None:
             return '404'
@@ -24,8 +24,12 @@ setup(
         'msgpack',
         'plotly',
         'joblib',
-        'plyfile', 'datashader', 'scikit-learn', 'scipy'
+        'plyfile', 'datashader', 'pillow', 'scikit-learn', 'scipy'
     ],
+    extras_require={
+        # memory-mapped columnar coords and variables, see omb/backend/columnar.py
+        'columnar': ['pyarrow'],
+    },
 )
 
 if __name__ == '__main__':